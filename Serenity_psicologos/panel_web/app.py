@@ -19,6 +19,12 @@ def verdb():
 import os
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB = os.path.abspath(os.path.join(BASE_DIR, "..", "..", "serenity.db"))
+import sys
+sys.path.insert(0, os.path.dirname(DB))
+from archivo import directorio_archivo, historial_completo
+from busqueda import MARCA_INICIO, MARCA_FIN, consulta_fts, buscar_alertas, buscar_conversaciones
+from markupsafe import Markup, escape
+
 def query(sql, params=()):
     conn = sqlite3.connect(DB)
     cur = conn.cursor()
@@ -27,6 +33,20 @@ def query(sql, params=()):
     conn.close()
     return data
 
+@app.template_filter("resaltar")
+def resaltar(texto):
+    """Escapa el fragmento y convierte los marcadores de FTS5 en <mark>."""
+    html = str(escape(texto or ""))
+    return Markup(html.replace(MARCA_INICIO, "<mark>").replace(MARCA_FIN, "</mark>"))
+
+def historial(user_id):
+    """Transcripción completa (user_message, bot_message, timestamp), incluidos los meses archivados."""
+    conn = sqlite3.connect(DB)
+    try:
+        return [(u, b, t) for _id, _uid, u, b, t in historial_completo(conn, directorio_archivo(DB), user_id)]
+    finally:
+        conn.close()
+
 @app.route("/")
 def login():
     return render_template("login.html")
@@ -120,12 +140,18 @@ def ver_alertas():
     params = facs.copy()
 
     if buscar:
-        sql += " AND (u.user_name LIKE ? OR u.id LIKE ? OR a.descripcion LIKE ?)"
-        params.extend([f"%{buscar}%", f"%{buscar}%", f"%{buscar}%"])
-
-    if tipo:
-        sql += " AND a.tipo_alerta LIKE ?"
-        params.append(f"%{tipo}%")
+        sql += " AND (u.user_name LIKE ? OR CAST(u.id AS TEXT) LIKE ? || '%'"
+        params.extend([f"%{buscar}%", buscar])
+        fts = consulta_fts(buscar)
+        if fts:
+            sql += " OR a.id IN (SELECT rowid FROM alertas_fts WHERE alertas_fts MATCH ?)"
+            params.append(fts)
+        sql += ")"
+
+    fts_tipo = consulta_fts(tipo, "tipo_alerta")
+    if fts_tipo:
+        sql += " AND a.id IN (SELECT rowid FROM alertas_fts WHERE alertas_fts MATCH ?)"
+        params.append(fts_tipo)
 
     if fecha_inicio:
         sql += " AND date(a.fecha) >= date(?)"
@@ -146,6 +172,29 @@ def ver_alertas():
                            inicio=fecha_inicio,
                            fin=fecha_fin)
 
+@app.route("/buscar")
+def buscar():
+    if "user" not in session:
+        return redirect("/")
+
+    facs = session["facultades"]
+    texto = request.args.get("q", "").strip()
+
+    alertas, conversaciones = [], []
+    if texto:
+        conn = sqlite3.connect(DB)
+        try:
+            alertas = buscar_alertas(conn, texto, facs)
+            conversaciones = buscar_conversaciones(conn, texto, facs)
+        finally:
+            conn.close()
+
+    return render_template("busqueda.html",
+                           q=texto,
+                           alertas=alertas,
+                           conversaciones=conversaciones,
+                           user=session["user"])
+
 @app.route("/usuarios")
 def ver_usuarios():
     if "user" not in session:
@@ -157,10 +206,11 @@ def ver_usuarios():
     datos = query(f"""
     SELECT u.id, u.user_name,
         d.facultad,
-        (SELECT COUNT(*) FROM conversaciones c WHERE c.user_id=u.id) AS mensajes,
-        (SELECT MAX(timestamp) FROM conversaciones c WHERE c.user_id=u.id) AS ultima
+        COALESCE(e.total_mensajes, 0) AS mensajes,
+        e.ultimo_mensaje AS ultima
         FROM usuarios u
         JOIN datos d ON d.user_id=u.id
+        LEFT JOIN estadisticas_usuario e ON e.user_id=u.id
         WHERE d.facultad IN ({placeholders})
         ORDER BY ultima DESC
     """, facs)
@@ -196,10 +246,7 @@ def perfil_usuario(id):
         return "⚠ Usuario no encontrado"
     user_name = usuario[0][0]
 
-    chats = query("""
-        SELECT user_message, bot_message, timestamp
-        FROM conversaciones WHERE user_id=? ORDER BY id
-    """, (id,))
+    chats = historial(id)
 
     alertas = query("""
         SELECT tipo_alerta, nivel, fecha, descripcion
@@ -213,8 +260,14 @@ def perfil_usuario(id):
         ORDER BY fecha DESC LIMIT 1
     """, (id,))
 
+    trabajo_perfil = query("""
+        SELECT estado, marca, creado, terminado, error
+        FROM trabajos_perfil WHERE user_id=?
+        ORDER BY marca DESC LIMIT 1
+    """, (id,))
+
     dependencia = query("""
-        SELECT nivel_dependencia, puntaje_total, ultima_evaluacion
+        SELECT nivel_dependencia, puntaje_total, ultima_evaluacion, tendencia, delta
         FROM dependencias WHERE user_id=?
     """, (id,))
 
@@ -226,6 +279,7 @@ def perfil_usuario(id):
         alertas=alertas,
         perfil=perfil[0] if perfil else None,
         dependencia=dependencia[0] if dependencia else None,
+        trabajo_perfil=trabajo_perfil[0] if trabajo_perfil else None,
         user=session["user"]
     )
 
@@ -272,6 +326,9 @@ def reporte_pdf(id):
         FROM conversaciones WHERE user_id=?
         ORDER BY id DESC LIMIT 15
     """, (id,))
+    if len(chats) < 15:
+        # Los turnos más antiguos pueden estar en los archivos mensuales.
+        chats = [(u, b) for u, b, _t in historial(id)[-15:][::-1]]
 
     temp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
     c = canvas.Canvas(temp.name, pagesize=A4)
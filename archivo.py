@@ -0,0 +1,197 @@
+import os
+import sys
+import sqlite3
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("serenity.archivo")
+
+TAMANO_LOTE = 500
+
+ESQUEMA_ARCHIVO = """
+    CREATE TABLE IF NOT EXISTS conversaciones (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        user_message TEXT,
+        bot_message TEXT,
+        timestamp TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_conversaciones_usuario ON conversaciones (user_id, id);
+"""
+
+
+def directorio_archivo(ruta_db):
+    """ARCHIVO_DIR o, por defecto, la carpeta "archivo" junto a la base."""
+    return os.getenv("ARCHIVO_DIR") or os.path.join(os.path.dirname(os.path.abspath(ruta_db)), "archivo")
+
+
+def ruta_mes(directorio, mes):
+    return os.path.join(directorio, f"conversaciones_{mes}.db")
+
+
+def _mes(timestamp):
+    return (timestamp or "")[:7] or "sin-fecha"
+
+
+def _filas_archivadas(conn, directorio, user_id, desde_id, hasta_id):
+    try:
+        meses = conn.execute(
+            "SELECT mes FROM archivo_conversaciones WHERE user_id=? ORDER BY mes", (user_id,)
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return
+    for (mes,) in meses:
+        ruta = ruta_mes(directorio, mes)
+        if not os.path.isfile(ruta):
+            logger.warning(f"[Archivo] Falta el archivo {ruta}")
+            continue
+        conn.execute("ATTACH DATABASE ? AS archivo", (ruta,))
+        cur = conn.execute("""
+            SELECT id, user_id, user_message, bot_message, timestamp FROM archivo.conversaciones
+            WHERE user_id=? AND id>? AND id<? ORDER BY id
+        """, (user_id, desde_id, hasta_id))
+        try:
+            while True:
+                lote = cur.fetchmany(TAMANO_LOTE)
+                if not lote:
+                    break
+                yield from lote
+        finally:
+            cur.close()
+            conn.execute("DETACH DATABASE archivo")
+
+
+def historial_completo(conn, directorio, user_id, desde_id=0):
+    """
+    Recorre toda la conversación de un usuario en orden de id: primero los
+    meses archivados (se adjuntan con ATTACH uno a la vez, solo los que el
+    catálogo indica para ese usuario) y luego la base activa.
+
+    Las filas archivadas con id >= al primer id activo del usuario se omiten,
+    por si un archivado se interrumpió entre la copia y el borrado.
+    """
+    primero = conn.execute("SELECT MIN(id) FROM conversaciones WHERE user_id=?", (user_id,)).fetchone()[0]
+    yield from _filas_archivadas(conn, directorio, user_id, desde_id, primero or sys.maxsize)
+    cur = conn.execute("""
+        SELECT id, user_id, user_message, bot_message, timestamp
+        FROM conversaciones WHERE user_id=? AND id>? ORDER BY id
+    """, (user_id, desde_id))
+    while True:
+        lote = cur.fetchmany(TAMANO_LOTE)
+        if not lote:
+            break
+        yield from lote
+
+
+class Archivador:
+    """
+    Mueve los turnos con más de `dias` de antigüedad de la base activa a
+    archivos mensuales (conversaciones_AAAA-MM.db) y registra en
+    archivo_conversaciones qué meses tiene cada usuario.
+
+    Recorre conversaciones por id (los timestamps crecen con el id), así que
+    no necesita un índice por fecha. Cada lote se copia primero al archivo
+    (INSERT OR IGNORE, idempotente) y luego se borra de la base activa; si se
+    corta entre ambos pasos, la siguiente pasada termina el trabajo.
+    """
+
+    def __init__(self, db, directorio, dias=180, lote=5000, intervalo=86400):
+        self.db = db
+        self.directorio = directorio
+        self.dias = dias
+        self.lote = lote
+        self.intervalo = intervalo
+        self._tarea = None
+
+    def _copiar(self, mes, filas):
+        os.makedirs(self.directorio, exist_ok=True)
+        conn = sqlite3.connect(ruta_mes(self.directorio, mes))
+        try:
+            conn.executescript(ESQUEMA_ARCHIVO)
+            with conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO conversaciones (id, user_id, user_message, bot_message, timestamp) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    filas,
+                )
+        finally:
+            conn.close()
+
+    def archivar(self):
+        corte = (datetime.now() - timedelta(days=self.dias)).isoformat()
+        total = 0
+        while True:
+            filas = self.db.todos("""
+                SELECT id, user_id, user_message, bot_message, timestamp
+                FROM conversaciones ORDER BY id LIMIT ?
+            """, (self.lote,))
+            viejas = []
+            for fila in filas:
+                if (fila[4] or "") >= corte:
+                    break
+                viejas.append(fila)
+            if not viejas:
+                break
+
+            por_mes = defaultdict(list)
+            for fila in viejas:
+                por_mes[_mes(fila[4])].append(fila)
+            for mes, filas_mes in por_mes.items():
+                self._copiar(mes, filas_mes)
+
+            catalogo = defaultdict(int)
+            for fila in viejas:
+                catalogo[(fila[1], _mes(fila[4]))] += 1
+            with self.db.transaccion() as cursor:
+                cursor.execute("DELETE FROM conversaciones WHERE id<=?", (viejas[-1][0],))
+                cursor.executemany("""
+                    INSERT INTO archivo_conversaciones (user_id, mes, filas) VALUES (?, ?, ?)
+                    ON CONFLICT(user_id, mes) DO UPDATE SET filas=filas + excluded.filas
+                """, [(user_id, mes, n) for (user_id, mes), n in catalogo.items()])
+            total += len(viejas)
+            if len(viejas) < len(filas):
+                break
+        if total:
+            logger.info(f"[Archivo] {total} turnos anteriores a {corte[:10]} archivados")
+        return total
+
+    def iniciar(self):
+        self._tarea = asyncio.create_task(self._bucle())
+        return self._tarea
+
+    async def detener(self):
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+
+    async def _bucle(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.archivar)
+            except Exception as e:
+                logger.error(f"[Archivo] Error archivando: {e}")
+            await asyncio.sleep(self.intervalo)
+
+
+if __name__ == "__main__":
+    # Uso: python archivo.py ruta.db dias
+    # Mueve (copia y borra de la base activa) los turnos con más de `dias` días.
+    from basedatos import ConexionSQLite
+    from migraciones import aplicar_migraciones
+
+    if len(sys.argv) != 3:
+        sys.exit("Uso: python archivo.py ruta.db dias")
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    ruta, dias = sys.argv[1], int(sys.argv[2])
+    if not os.path.isfile(ruta):
+        sys.exit(f"No existe la base {ruta}")
+    db = ConexionSQLite(ruta)
+    aplicar_migraciones(db)
+    archivados = Archivador(db, directorio_archivo(ruta), dias=dias).archivar()
+    print(f"{archivados} turnos archivados en {directorio_archivo(ruta)}")
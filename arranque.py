@@ -0,0 +1,52 @@
+import os
+import time
+import logging
+import importlib
+from contextlib import contextmanager
+
+logger = logging.getLogger("serenity.arranque")
+
+INICIO = time.perf_counter()
+ARRANQUE_PRESUPUESTO_MS = float(os.getenv("ARRANQUE_PRESUPUESTO_MS", "1500"))
+
+# nombre -> (milisegundos, momento en que se cargó respecto a INICIO, diferido)
+TIEMPOS = {}
+
+
+@contextmanager
+def medir(nombre, diferido=False):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        t1 = time.perf_counter()
+        TIEMPOS.setdefault(nombre, ((t1 - t0) * 1000, (t0 - INICIO) * 1000, diferido))
+
+
+def importar(nombre):
+    """
+    Importa un módulo pesado en su primer uso y registra cuánto tardó.
+    Las llamadas siguientes devuelven el módulo ya cargado (sys.modules).
+    """
+    if nombre in TIEMPOS:
+        return importlib.import_module(nombre)
+    with medir(nombre, diferido=True):
+        return importlib.import_module(nombre)
+
+
+def reporte_arranque():
+    """
+    Registra en el log el tiempo de cada import medido y el total hasta ahora.
+    Avisa si el arranque supera ARRANQUE_PRESUPUESTO_MS.
+    """
+    total = (time.perf_counter() - INICIO) * 1000
+    lineas = []
+    for nombre, (ms, _en, diferido) in sorted(TIEMPOS.items(), key=lambda x: -x[1][0]):
+        etiqueta = " (diferido)" if diferido else ""
+        lineas.append(f"  {nombre:<24} {ms:8.1f} ms{etiqueta}")
+    logger.info("[Arranque] Tiempos de import:\n" + "\n".join(lineas))
+    if total > ARRANQUE_PRESUPUESTO_MS:
+        logger.warning(f"[Arranque] {total:.0f} ms supera el presupuesto de {ARRANQUE_PRESUPUESTO_MS:.0f} ms")
+    else:
+        logger.info(f"[Arranque] Listo en {total:.0f} ms (presupuesto {ARRANQUE_PRESUPUESTO_MS:.0f} ms)")
+    return total
@@ -0,0 +1,192 @@
+import os
+import sqlite3
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import trazas
+
+logger = logging.getLogger("serenity.db")
+
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "16384"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHED_STATEMENTS = 256
+
+# Registro de sentencias con nombre. Ejecutar siempre el mismo objeto de texto
+# permite que la caché de sentencias preparadas de sqlite3 las reutilice.
+SENTENCIAS = {}
+
+
+def registrar_sentencia(nombre, sql):
+    SENTENCIAS[nombre] = sql
+    return nombre
+
+
+class BloqueoMedido:
+    """
+    RLock que mide cuánto esperan los hilos por la conexión compartida.
+    Si el bloqueo está libre no se mide nada (un acquire no bloqueante basta).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.esperas = 0
+        self.segundos = 0.0
+        self.max_espera = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(blocking=False):
+            return True
+        if not blocking:
+            return False
+        t0 = time.perf_counter()
+        obtenido = self._lock.acquire(timeout=timeout)
+        espera = time.perf_counter() - t0
+        self.esperas += 1
+        self.segundos += espera
+        self.max_espera = max(self.max_espera, espera)
+        return obtenido
+
+    def release(self):
+        self._lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def estadisticas(self):
+        return {"esperas": self.esperas, "segundos": round(self.segundos, 4), "max_espera": round(self.max_espera, 4)}
+
+
+class ConexionSQLite:
+    """
+    Conexión SQLite de larga duración compartida por todos los helpers del bot.
+
+    - Modo WAL: los lectores del panel no se bloquean mientras el bot escribe.
+    - PRAGMAs ajustados (synchronous, mmap_size, cache_size, busy_timeout).
+    - Caché de sentencias preparadas vía SENTENCIAS + cached_statements.
+    - Un RLock serializa el acceso, así que puede usarse desde los handlers
+      asyncio y desde hilos auxiliares (asyncio.to_thread).
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._conn = None
+        self.bloqueo = BloqueoMedido()
+
+    def _abrir(self):
+        conn = sqlite3.connect(
+            self.ruta,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+            timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        logger.info(f"[DB] Conexión abierta en modo WAL: {self.ruta}")
+        return conn
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            with self.bloqueo:
+                if self._conn is None:
+                    self._conn = self._abrir()
+        return self._conn
+
+    @staticmethod
+    def _sql(sentencia):
+        return SENTENCIAS.get(sentencia, sentencia)
+
+    def ejecutar(self, sentencia, params=()):
+        """Ejecuta una escritura fuera de transacción explícita (autocommit)."""
+        with trazas.tramo("db.ejecutar", sql=sentencia), self.bloqueo:
+            cur = self.conn.execute(self._sql(sentencia), params)
+            return cur.lastrowid
+
+    def uno(self, sentencia, params=()):
+        with trazas.tramo("db.uno", sql=sentencia), self.bloqueo:
+            return self.conn.execute(self._sql(sentencia), params).fetchone()
+
+    def todos(self, sentencia, params=()):
+        with trazas.tramo("db.todos", sql=sentencia), self.bloqueo:
+            return self.conn.execute(self._sql(sentencia), params).fetchall()
+
+    @contextmanager
+    def transaccion(self):
+        """
+        Agrupa varias sentencias en una sola transacción (un solo commit/fsync).
+        Devuelve un cursor; hace rollback si ocurre una excepción.
+        """
+        with trazas.tramo("db.transaccion"), self.bloqueo:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.cursor()
+            try:
+                yield _Cursor(cur)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+
+    @contextmanager
+    def lector(self):
+        """
+        Conexión de solo lectura independiente para lecturas largas (exportaciones,
+        reportes). En WAL no bloquea al escritor ni toma el RLock compartido.
+        """
+        conn = sqlite3.connect(
+            f"file:{self.ruta}?mode=ro", uri=True, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000
+        )
+        try:
+            conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            yield conn
+        finally:
+            conn.close()
+
+    def cerrar(self):
+        with self.bloqueo:
+            if self._conn is not None:
+                try:
+                    self._conn.execute("PRAGMA optimize")
+                except sqlite3.Error:
+                    pass
+                self._conn.close()
+                self._conn = None
+
+
+class _Cursor:
+    """Cursor que resuelve nombres de SENTENCIAS igual que ConexionSQLite."""
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, sentencia, params=()):
+        return self._cur.execute(SENTENCIAS.get(sentencia, sentencia), params)
+
+    def executemany(self, sentencia, filas):
+        return self._cur.executemany(SENTENCIAS.get(sentencia, sentencia), filas)
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    @property
+    def lastrowid(self):
+        return self._cur.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
@@ -0,0 +1,86 @@
+import re
+import sys
+
+# Marcadores de resaltado que devuelven snippet(); el panel los cambia por
+# <mark> después de escapar el texto, así que nunca se inyecta HTML.
+MARCA_INICIO = "\x02"
+MARCA_FIN = "\x03"
+PALABRAS_SNIPPET = 24
+
+_PALABRA = re.compile(r"\w+")
+
+
+def consulta_fts(texto, columna=None):
+    """
+    Convierte lo que escribe el psicólogo en una consulta FTS5 segura: cada
+    palabra entre comillas y como prefijo ("ansie" encuentra "ansiedad"),
+    todas requeridas. Devuelve None si no queda ninguna palabra.
+    """
+    palabras = _PALABRA.findall(texto or "")
+    if not palabras:
+        return None
+    consulta = " ".join(f'"{p}"*' for p in palabras)
+    return f"{columna} : ({consulta})" if columna else consulta
+
+
+def _en_facultades(columna, facultades):
+    marcadores = ",".join("?" * len(facultades))
+    return f"{columna} IN (SELECT user_id FROM datos WHERE facultad IN ({marcadores}))"
+
+
+def buscar_alertas(conn, texto, facultades, limite=50):
+    """
+    Alertas de usuarios de `facultades` que coinciden con `texto`, de la más
+    relevante (bm25) a la menos. Filas: (id, user_name, tipo_alerta, nivel,
+    fecha, fragmento de la descripción, tipo resaltado).
+    """
+    consulta = consulta_fts(texto)
+    if not consulta or not facultades:
+        return []
+    return conn.execute(f"""
+        SELECT a.id, u.user_name, a.tipo_alerta, a.nivel, a.fecha,
+               snippet(alertas_fts, 0, ?, ?, '…', {PALABRAS_SNIPPET}),
+               highlight(alertas_fts, 1, ?, ?)
+        FROM alertas_fts
+        JOIN alertas a ON a.id = alertas_fts.rowid
+        JOIN usuarios u ON u.id = a.usuario_id
+        WHERE alertas_fts MATCH ? AND {_en_facultades("a.usuario_id", facultades)}
+        ORDER BY bm25(alertas_fts, 2.0, 1.0)
+        LIMIT ?
+    """, (MARCA_INICIO, MARCA_FIN, MARCA_INICIO, MARCA_FIN, consulta, *facultades, limite)).fetchall()
+
+
+def buscar_conversaciones(conn, texto, facultades, limite=50):
+    """
+    Turnos de usuarios de `facultades` que coinciden con `texto`; lo que
+    escribió el usuario pesa más que la respuesta del bot. Solo cubre la base
+    activa: los meses archivados (archivo.py) no se indexan.
+    Filas: (id, user_id, user_name, timestamp, fragmento del usuario, fragmento del bot).
+    """
+    consulta = consulta_fts(texto)
+    if not consulta or not facultades:
+        return []
+    return conn.execute(f"""
+        SELECT c.id, c.user_id, u.user_name, c.timestamp,
+               snippet(conversaciones_fts, 0, ?, ?, '…', {PALABRAS_SNIPPET}),
+               snippet(conversaciones_fts, 1, ?, ?, '…', {PALABRAS_SNIPPET})
+        FROM conversaciones_fts
+        JOIN conversaciones c ON c.id = conversaciones_fts.rowid
+        JOIN usuarios u ON u.id = c.user_id
+        WHERE conversaciones_fts MATCH ? AND {_en_facultades("c.user_id", facultades)}
+        ORDER BY bm25(conversaciones_fts, 3.0, 1.0)
+        LIMIT ?
+    """, (MARCA_INICIO, MARCA_FIN, MARCA_INICIO, MARCA_FIN, consulta, *facultades, limite)).fetchall()
+
+
+if __name__ == "__main__":
+    # Uso: python busqueda.py ruta.db "texto" facultad [facultad...]
+    import sqlite3
+
+    conn = sqlite3.connect(sys.argv[1])
+    texto, facultades = sys.argv[2], sys.argv[3:]
+    marcar = lambda s: (s or "").replace(MARCA_INICIO, "[").replace(MARCA_FIN, "]")
+    for fila in buscar_alertas(conn, texto, facultades):
+        print(f"alerta {fila[0]} · {fila[1]} · {marcar(fila[6])} · {marcar(fila[5])}")
+    for fila in buscar_conversaciones(conn, texto, facultades):
+        print(f"turno {fila[0]} · {fila[2]} · {marcar(fila[4])} / {marcar(fila[5])}")
@@ -0,0 +1,129 @@
+import time
+import threading
+from collections import OrderedDict, deque
+
+
+def _tamano(fila):
+    return sum(len(v) if isinstance(v, str) else 8 for v in fila) + 64
+
+
+class _Ventana:
+    __slots__ = ("filas", "bytes", "acceso")
+
+    def __init__(self, filas, por_usuario):
+        self.filas = deque(filas, maxlen=por_usuario)
+        self.bytes = sum(_tamano(f) for f in self.filas)
+        self.acceso = time.monotonic()
+
+
+class CacheVentanas:
+    """
+    Caché LRU de los últimos turnos de cada usuario activo.
+
+    Cada usuario tiene un deque con a lo sumo `por_usuario` filas
+    (user_message, bot_message, timestamp), las más recientes al final.
+    Una ventana cargada desde la base siempre contiene los min(total, por_usuario)
+    turnos más recientes, y agregar() la mantiene así (write-through), por lo
+    que cualquier lectura con limite <= por_usuario se sirve desde memoria.
+
+    Se desalojan usuarios por LRU cuando se excede `max_usuarios` o
+    `max_bytes`, y por inactividad tras `ttl` segundos.
+    """
+
+    def __init__(self, cargar, por_usuario=20, max_usuarios=5000, max_bytes=32 * 1024 * 1024, ttl=1800):
+        self._cargar = cargar
+        self.por_usuario = por_usuario
+        self.max_usuarios = max_usuarios
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._ventanas = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, user_id, limite):
+        """Devuelve los últimos `limite` turnos en orden cronológico."""
+        if limite > self.por_usuario:
+            self.fallos += 1
+            return self._cargar(user_id, limite)
+        with self._lock:
+            ventana = self._vigente(user_id)
+            if ventana is not None:
+                self.aciertos += 1
+                filas = list(ventana.filas)
+                return filas[-limite:] if limite else []
+        self.fallos += 1
+        self.purgar()
+        filas = self._cargar(user_id, self.por_usuario)
+        with self._lock:
+            self._guardar(user_id, _Ventana(filas, self.por_usuario))
+        return filas[-limite:] if limite else []
+
+    def agregar(self, user_id, fila):
+        """Write-through: agrega el turno recién guardado si el usuario está en caché."""
+        with self._lock:
+            ventana = self._vigente(user_id)
+            if ventana is None:
+                return
+            if len(ventana.filas) == ventana.filas.maxlen:
+                ventana.bytes -= _tamano(ventana.filas[0])
+                self._bytes -= _tamano(ventana.filas[0])
+            ventana.filas.append(fila)
+            ventana.bytes += _tamano(fila)
+            self._bytes += _tamano(fila)
+            self._desalojar()
+
+    def invalidar(self, user_id):
+        with self._lock:
+            ventana = self._ventanas.pop(user_id, None)
+            if ventana is not None:
+                self._bytes -= ventana.bytes
+
+    def purgar(self):
+        """Elimina las ventanas que llevan más de `ttl` segundos sin uso."""
+        limite = time.monotonic() - self.ttl
+        with self._lock:
+            while self._ventanas:
+                user_id, ventana = next(iter(self._ventanas.items()))
+                if ventana.acceso >= limite:
+                    break
+                self._ventanas.popitem(last=False)
+                self._bytes -= ventana.bytes
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "usuarios": len(self._ventanas),
+                "bytes": self._bytes,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+            }
+
+    def _vigente(self, user_id):
+        ventana = self._ventanas.get(user_id)
+        if ventana is None:
+            return None
+        ahora = time.monotonic()
+        if ahora - ventana.acceso > self.ttl:
+            del self._ventanas[user_id]
+            self._bytes -= ventana.bytes
+            return None
+        ventana.acceso = ahora
+        self._ventanas.move_to_end(user_id)
+        return ventana
+
+    def _guardar(self, user_id, ventana):
+        anterior = self._ventanas.pop(user_id, None)
+        if anterior is not None:
+            self._bytes -= anterior.bytes
+        self._ventanas[user_id] = ventana
+        self._bytes += ventana.bytes
+        self._desalojar()
+
+    def _desalojar(self):
+        while self._ventanas and (
+            len(self._ventanas) > self.max_usuarios or self._bytes > self.max_bytes
+        ):
+            _user_id, ventana = self._ventanas.popitem(last=False)
+            self._bytes -= ventana.bytes
@@ -0,0 +1,672 @@
+"""
+Prueba de carga: reproduce tráfico sintético de Telegram contra el bot real.
+
+Miles de estudiantes simulados envían mensajes de texto y, cuando el bot
+detecta riesgo, recorren el flujo de consentimiento (consent_si/consent_no,
+nombre, número, correo y facultad). Los updates pasan por el mismo
+Application, PlanificadorPorUsuario y handlers que en producción; solo los
+servicios externos se reemplazan por servidores locales de prueba con
+latencia y tasa de error configurables:
+
+  - OpenAI (chat/completions, con y sin streaming)
+  - Bot API de Telegram (sendMessage, editMessageText, answerCallbackQuery)
+  - SMTP (sin TLS) y Twilio (Messages.json)
+
+Los servidores de prueba corren en su propio hilo y event loop para no
+competir con el loop del bot. Al terminar se reportan p50/p95/p99 de latencia
+(desde que el update se encola hasta que su handler termina, y solo el
+handler), updates/s, esperas por el bloqueo de SQLite, retraso del event loop
+y RSS pico, y se agrega una línea JSON a --resultados para comparar corridas
+entre commits (--comparar).
+
+Uso:
+    python carga.py --estudiantes 2000 --mensajes 8 --latencia-openai 0.4
+    python carga.py --comparar 10
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from datetime import datetime
+
+from aiohttp import web
+
+logger = logging.getLogger("serenity.carga")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TOKEN_PRUEBA = "123456:carga"
+
+MENSAJES_NORMALES = [
+    "Hola, ¿cómo estás?",
+    "Hoy tuve un día pesado en la escuela",
+    "Me preocupan mucho los exámenes finales",
+    "Discutí con mi mejor amigo y no sé qué hacer",
+    "Últimamente me cuesta concentrarme en clase",
+    "Gracias por escucharme",
+    "Mi familia espera mucho de mí y siento presión",
+    "No sé si elegí bien mi carrera",
+    "Extraño mi casa, vivo lejos de mi familia",
+    "Hoy me fue mejor, pude dormir un poco más",
+]
+MENSAJES_RIESGO = [
+    "Ya no quiero vivir, siento que nada tiene sentido",
+    "A veces pienso en quitarme la vida",
+    "Mi padrastro me pega cuando llega borracho",
+    "No puedo dejar de tomar, todos los días me emborracho",
+]
+FACULTADES = ["fac_ecoadm", "fac_info", "fac_salud", "fac_educativas", "fac_nat", "fac_derecho", "fac_ing", "fac_quim"]
+
+
+class Perfil:
+    """Latencia (media ± 50 %) y tasa de error de un servicio de prueba."""
+
+    def __init__(self, latencia=0.0, errores=0.0):
+        self.latencia = latencia
+        self.errores = errores
+
+    def demora(self):
+        return self.latencia * random.uniform(0.5, 1.5) if self.latencia else 0
+
+    def falla(self):
+        return random.random() < self.errores
+
+
+def _es_riesgo(texto):
+    return any(frase in texto for frase in MENSAJES_RIESGO)
+
+
+def respuesta_openai(mensajes):
+    """Elige una respuesta plausible según el prompt que armó serenity.py."""
+    sistema = mensajes[0]["content"] if mensajes else ""
+    ultimo = mensajes[-1]["content"] if mensajes else ""
+    if '"respuesta"' in sistema:
+        riesgo = _es_riesgo(ultimo)
+        return json.dumps({
+            "respuesta": "Gracias por contármelo, aquí estoy para escucharte.",
+            "RIESGO": "SI" if riesgo else "NO",
+            "TEMA": "suicidio" if riesgo else "ninguno",
+            "RAZON": "respuesta de prueba",
+        })
+    if '"RIESGO"' in ultimo:
+        actual = ultimo.rsplit("Mensaje actual del usuario:", 1)[-1]
+        riesgo = _es_riesgo(actual)
+        return json.dumps({
+            "RIESGO": "SI" if riesgo else "NO",
+            "TEMA": "suicidio" if riesgo else "ninguno",
+            "RAZON": "evaluación de prueba",
+        })
+    if '"items"' in ultimo:
+        return json.dumps({"items": [1] * 8, "total": 8, "nivel": "baja"})
+    if "estado_emocional_predominante" in ultimo:
+        return json.dumps({
+            "estado_emocional_predominante": "ansiedad",
+            "patrones_expresion": "prueba",
+            "intencion_divulgacion": "media",
+            "rasgos_personalidad": "prueba",
+            "necesidades_esperadas": "acompañamiento",
+            "recomendaciones": "perfil generado por la prueba de carga",
+        })
+    if "Actualiza el resumen" in ultimo:
+        return "El estudiante habla de presión escolar y familiar (resumen de prueba)."
+    return (
+        "Entiendo cómo te sientes, es normal que estas situaciones pesen. "
+        "¿Quieres contarme un poco más sobre lo que pasó?"
+    )
+
+
+class StubOpenAI:
+    def __init__(self, perfil):
+        self.perfil = perfil
+        self.contadores = Counter()
+
+    def rutas(self, app):
+        app.router.add_post("/v1/chat/completions", self._completar)
+
+    async def _completar(self, request):
+        cuerpo = await request.json()
+        self.contadores["llamadas"] += 1
+        await asyncio.sleep(self.perfil.demora())
+        if self.perfil.falla():
+            self.contadores["errores"] += 1
+            return web.json_response({"error": {"message": "falla simulada", "type": "server_error"}}, status=500)
+        texto = respuesta_openai(cuerpo.get("messages") or [])
+        creado = int(time.time())
+        modelo = cuerpo.get("model", "stub")
+        if not cuerpo.get("stream"):
+            entrada = sum(len(m.get("content") or "") for m in cuerpo.get("messages") or []) // 4
+            salida = len(texto) // 4
+            return web.json_response({
+                "id": "chatcmpl-carga", "object": "chat.completion", "created": creado, "model": modelo,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": texto}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": entrada, "completion_tokens": salida, "total_tokens": entrada + salida},
+            })
+
+        respuesta = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await respuesta.prepare(request)
+        palabras = texto.split(" ")
+        for i, palabra in enumerate(palabras):
+            trozo = {
+                "id": "chatcmpl-carga", "object": "chat.completion.chunk", "created": creado, "model": modelo,
+                "choices": [{"index": 0, "delta": {"content": palabra + (" " if i < len(palabras) - 1 else "")},
+                             "finish_reason": None}],
+            }
+            await respuesta.write(f"data: {json.dumps(trozo)}\n\n".encode())
+            await asyncio.sleep(0.005)
+        await respuesta.write(b"data: [DONE]\n\n")
+        await respuesta.write_eof()
+        return respuesta
+
+
+class StubTelegram:
+    """Bot API mínima: responde como Telegram a lo que usan los handlers."""
+
+    def __init__(self, perfil):
+        self.perfil = perfil
+        self.contadores = Counter()
+        self._mensaje_id = 0
+
+    def rutas(self, app):
+        app.router.add_post("/bot{token}/{metodo}", self._metodo)
+
+    def _mensaje(self, datos):
+        self._mensaje_id += 1
+        return {
+            "message_id": int(datos.get("message_id") or self._mensaje_id),
+            "date": int(time.time()),
+            "chat": {"id": int(datos.get("chat_id") or 0), "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Serenity"},
+            "text": datos.get("text", ""),
+        }
+
+    async def _metodo(self, request):
+        metodo = request.match_info["metodo"]
+        datos = dict(await request.post())
+        self.contadores[metodo] += 1
+        await asyncio.sleep(self.perfil.demora())
+        if metodo == "getMe":
+            resultado = {"id": 1, "is_bot": True, "first_name": "Serenity", "username": "serenity_carga_bot"}
+        elif metodo in ("sendMessage", "editMessageText"):
+            resultado = self._mensaje(datos)
+        else:
+            resultado = True
+        return web.json_response({"ok": True, "result": resultado})
+
+
+class StubTwilio:
+    def __init__(self, perfil):
+        self.perfil = perfil
+        self.contadores = Counter()
+
+    def rutas(self, app):
+        app.router.add_post("/2010-04-01/Accounts/{sid}/Messages.json", self._mensaje)
+
+    async def _mensaje(self, request):
+        datos = dict(await request.post())
+        self.contadores["mensajes"] += 1
+        await asyncio.sleep(self.perfil.demora())
+        if self.perfil.falla():
+            self.contadores["errores"] += 1
+            return web.json_response({"code": 20500, "message": "falla simulada", "status": 500}, status=500)
+        return web.json_response({
+            "sid": f"SM{self.contadores['mensajes']:032d}",
+            "account_sid": request.match_info["sid"],
+            "status": "queued",
+            "body": datos.get("Body", ""),
+            "from": datos.get("From", ""),
+            "to": datos.get("To", ""),
+        }, status=201)
+
+
+class StubSMTP:
+    """Servidor SMTP sin TLS que acepta cualquier AUTH y descarta los correos."""
+
+    def __init__(self, perfil):
+        self.perfil = perfil
+        self.contadores = Counter()
+
+    async def sesion(self, lector, escritor):
+        def enviar(linea):
+            escritor.write(f"{linea}\r\n".encode())
+
+        enviar("220 carga ESMTP")
+        await escritor.drain()
+        while True:
+            linea = await lector.readline()
+            if not linea:
+                break
+            verbo = linea.decode(errors="replace").strip()[:4].upper()
+            if verbo == "EHLO":
+                enviar("250-carga")
+                enviar("250-AUTH PLAIN LOGIN")
+                enviar("250 OK")
+            elif verbo == "AUTH":
+                enviar("235 2.7.0 Autenticado")
+            elif verbo == "DATA":
+                enviar("354 Termina con <CR><LF>.<CR><LF>")
+                await escritor.drain()
+                while (await lector.readline()) not in (b".\r\n", b""):
+                    pass
+                await asyncio.sleep(self.perfil.demora())
+                if self.perfil.falla():
+                    self.contadores["errores"] += 1
+                    enviar("451 4.3.0 Falla simulada")
+                else:
+                    self.contadores["correos"] += 1
+                    enviar("250 OK")
+            elif verbo == "QUIT":
+                enviar("221 Adiós")
+                await escritor.drain()
+                break
+            else:
+                enviar("250 OK")
+            await escritor.drain()
+        escritor.close()
+
+
+class ServidoresPrueba:
+    """Levanta los cuatro servidores de prueba en un hilo con su propio event loop."""
+
+    def __init__(self, openai, telegram, smtp, twilio):
+        self.openai = StubOpenAI(openai)
+        self.telegram = StubTelegram(telegram)
+        self.smtp = StubSMTP(smtp)
+        self.twilio = StubTwilio(twilio)
+        self.puertos = {}
+        self._loop = asyncio.new_event_loop()
+        self._listo = threading.Event()
+        self._cerrar = []
+
+    def iniciar(self):
+        threading.Thread(target=self._correr, name="servidores-prueba", daemon=True).start()
+        self._listo.wait()
+        return self.puertos
+
+    def _correr(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._levantar())
+        self._listo.set()
+        self._loop.run_forever()
+
+    async def _levantar(self):
+        for nombre, stub in (("openai", self.openai), ("telegram", self.telegram), ("twilio", self.twilio)):
+            app = web.Application()
+            stub.rutas(app)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            sitio = web.TCPSite(runner, "127.0.0.1", 0)
+            await sitio.start()
+            self.puertos[nombre] = runner.addresses[0][1]
+            self._cerrar.append(runner.cleanup)
+        servidor = await asyncio.start_server(self.smtp.sesion, "127.0.0.1", 0)
+        self.puertos["smtp"] = servidor.sockets[0].getsockname()[1]
+        self._cerrar.append(servidor.wait_closed)
+        self._cerrar.insert(0, self._async(servidor.close))
+
+    @staticmethod
+    def _async(funcion):
+        async def envoltura():
+            funcion()
+        return envoltura
+
+    def detener(self):
+        async def cerrar():
+            for cleanup in self._cerrar:
+                await cleanup()
+        asyncio.run_coroutine_threadsafe(cerrar(), self._loop).result(timeout=10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def contadores(self):
+        return {
+            "openai": dict(self.openai.contadores),
+            "telegram": dict(self.telegram.contadores),
+            "smtp": dict(self.smtp.contadores),
+            "twilio": dict(self.twilio.contadores),
+        }
+
+
+def configurar_entorno(puertos, ruta_db):
+    """Apunta serenity.py a los servidores de prueba. Debe llamarse antes de importarlo."""
+    os.environ.update({
+        "SERENITY_DB": ruta_db,
+        "TELEGRAM_TOKEN": TOKEN_PRUEBA,
+        "OPENAI_API_KEY": "sk-carga",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{puertos['openai']}/v1",
+        "GMAIL_USER": "carga@example.com",
+        "GMAIL_PASS": "carga",
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PUERTO": str(puertos["smtp"]),
+        "SMTP_SSL": "0",
+        "TWILIO_SID": "ACcarga",
+        "TWILIO_TOKEN": "carga",
+        "TWILIO_WHATSAPP_FROM": "whatsapp:+10000000000",
+        "TWILIO_WHATSAPP_TO": "whatsapp:+10000000001",
+        "TWILIO_API_URL": f"http://127.0.0.1:{puertos['twilio']}",
+        "ARCHIVO_DIAS": "0",
+    })
+    # Sin límite de cuota por defecto: se mide el bot, no el planificador de OpenAI.
+    # Exportar OPENAI_RPM/OPENAI_TPM antes de correr para incluirlo.
+    os.environ.setdefault("OPENAI_RPM", "1000000")
+    os.environ.setdefault("OPENAI_TPM", "1000000000")
+    os.environ.setdefault("ALERTAS_ESPERA_BASE", "1")
+
+
+def percentiles(valores):
+    if not valores:
+        return {}
+    ordenados = sorted(valores)
+
+    def p(q):
+        return round(ordenados[min(len(ordenados) - 1, int(q / 100 * len(ordenados)))] * 1000, 1)
+
+    return {"p50": p(50), "p95": p(95), "p99": p(99), "max": round(ordenados[-1] * 1000, 1)}
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=BASE_DIR, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+class Carga:
+    def __init__(self, serenity, args):
+        self.serenity = serenity
+        self.args = args
+        self.app = None
+        self.planificador = None
+        self.enviados = {}
+        self.latencias = []
+        self.latencias_texto = []
+        self.handler = []
+        self.lag = []
+        self.contadores = Counter()
+        self._update_id = 0
+        self._mensaje_id = 0
+
+    # --- updates sintéticos -------------------------------------------------
+
+    def _usuario(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"Estudiante{uid}"}
+
+    def texto(self, uid, texto):
+        from telegram import Update
+
+        self._update_id += 1
+        self._mensaje_id += 1
+        return Update.de_json({
+            "update_id": self._update_id,
+            "message": {
+                "message_id": self._mensaje_id,
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": self._usuario(uid),
+                "text": texto,
+            },
+        }, self.app.bot)
+
+    def callback(self, uid, datos):
+        from telegram import Update
+
+        self._update_id += 1
+        return Update.de_json({
+            "update_id": self._update_id,
+            "callback_query": {
+                "id": str(self._update_id),
+                "from": self._usuario(uid),
+                "chat_instance": str(uid),
+                "data": datos,
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"},
+                    "from": {"id": 1, "is_bot": True, "first_name": "Serenity"},
+                    "text": "¿Autorizas a compartir tus datos?",
+                },
+            },
+        }, self.app.bot)
+
+    def guion(self, uid):
+        """Lista de ("texto"|"callback", valor) que enviará el estudiante `uid`."""
+        pasos = [("texto", random.choice(MENSAJES_NORMALES)) for _ in range(self.args.mensajes)]
+        if random.random() < self.args.riesgo:
+            i = random.randrange(len(pasos) + 1)
+            flujo = [("texto", random.choice(MENSAJES_RIESGO))]
+            if random.random() < self.args.consentimiento:
+                flujo += [
+                    ("callback", "consent_si"),
+                    ("texto", "Ana Sofía López"),
+                    ("texto", f"938{uid % 10_000_000:07d}"),
+                    ("texto", f"est{uid}@mail.unacar.mx"),
+                    ("callback", random.choice(FACULTADES)),
+                ]
+            else:
+                flujo.append(("callback", "consent_no"))
+            pasos[i:i] = flujo
+        return pasos
+
+    # --- ejecución ----------------------------------------------------------
+
+    async def preparar(self, puerto_telegram):
+        from telegram.ext import Application
+        from planificador import PlanificadorPorUsuario
+
+        s = self.serenity
+        s.crear_base_datos()
+        self.planificador = PlanificadorPorUsuario(s.UPDATES_CONCURRENTES, capacidad=s.WEBHOOK_COLA_MAX)
+        self.app = (
+            Application.builder()
+            .token(TOKEN_PRUEBA)
+            .base_url(f"http://127.0.0.1:{puerto_telegram}/bot")
+            .concurrent_updates(self.planificador)
+            .build()
+        )
+        s.telegram_app = self.app
+        self.planificador.conectar(self.app)
+        procesar = self.planificador.procesar
+
+        async def procesar_medido(update):
+            inicio = time.perf_counter()
+            try:
+                await procesar(update)
+            finally:
+                fin = time.perf_counter()
+                enviado, futuro = self.enviados.pop(update.update_id)
+                self.handler.append(fin - inicio)
+                self.latencias.append(fin - enviado)
+                if update.message is not None:
+                    self.latencias_texto.append(fin - enviado)
+                futuro.set_result(None)
+
+        async def contar_error(update, context):
+            self.contadores["errores_handler"] += 1
+            logger.error(f"[Carga] Error en handler: {context.error}")
+
+        self.planificador.procesar = procesar_medido
+        s.registrar_handlers(self.app)
+        self.app.add_error_handler(contar_error)
+        await self.app.initialize()
+        s.registrar_medidores(self.planificador)
+        s.iniciar_servicios()
+
+    async def enviar(self, update):
+        futuro = asyncio.get_running_loop().create_future()
+        self.enviados[update.update_id] = (time.perf_counter(), futuro)
+        while not self.planificador.encolar(update):
+            self.contadores["rechazados"] += 1
+            await asyncio.sleep(0.05)
+        await futuro
+
+    async def estudiante(self, uid, retraso):
+        await asyncio.sleep(retraso)
+        for tipo, valor in self.guion(uid):
+            update = self.texto(uid, valor) if tipo == "texto" else self.callback(uid, valor)
+            self.contadores[tipo] += 1
+            await self.enviar(update)
+            if self.args.pausa:
+                await asyncio.sleep(random.expovariate(1 / self.args.pausa))
+
+    async def medir_lag(self, intervalo=0.05):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(intervalo)
+            self.lag.append(max(0.0, time.perf_counter() - t0 - intervalo))
+
+    async def esperar_alertas(self, espera):
+        limite = time.monotonic() + espera
+        while time.monotonic() < limite:
+            pendientes = self.serenity.db.uno("SELECT COUNT(*) FROM alertas_envios WHERE estado='pendiente'")[0]
+            if not pendientes:
+                return 0
+            await asyncio.sleep(0.2)
+        return pendientes
+
+    async def correr(self, puerto_telegram):
+        await self.preparar(puerto_telegram)
+        monitor = asyncio.create_task(self.medir_lag())
+        n = self.args.estudiantes
+        base = self.args.primer_id
+        inicio = time.perf_counter()
+        await asyncio.gather(*(
+            self.estudiante(base + i, self.args.rampa * i / n) for i in range(n)
+        ))
+        segundos = time.perf_counter() - inicio
+        alertas_pendientes = await self.esperar_alertas(self.args.espera_alertas)
+        monitor.cancel()
+
+        s = self.serenity
+        await s.detener_servicios()
+        await asyncio.to_thread(s.sesion_smtp.cerrar)
+        await self.app.shutdown()
+        resultado = {
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "commit": _commit(),
+            "parametros": {k: v for k, v in vars(self.args).items() if k not in ("comparar", "resultados")},
+            "updates": len(self.latencias),
+            "segundos": round(segundos, 2),
+            "updates_por_segundo": round(len(self.latencias) / segundos, 1),
+            "mensajes_por_segundo": round(len(self.latencias_texto) / segundos, 1),
+            "latencia_ms": percentiles(self.latencias),
+            "latencia_texto_ms": percentiles(self.latencias_texto),
+            "handler_ms": percentiles(self.handler),
+            "lag_event_loop_ms": percentiles(self.lag),
+            "bloqueo_sqlite": s.db.bloqueo.estadisticas(),
+            "rss_pico_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "contadores": dict(self.contadores),
+            "alertas": {
+                "registradas": s.db.uno("SELECT COUNT(*) FROM alertas")[0],
+                "envios_pendientes": alertas_pendientes,
+            },
+            "escritor": s.escritor.estadisticas(),
+            "etapas": s.metricas.resumen_etapas(),
+        }
+        s.db.cerrar()
+        return resultado
+
+
+def imprimir(resultado):
+    print(f"\n{resultado['updates']} updates en {resultado['segundos']} s "
+          f"({resultado['updates_por_segundo']} updates/s, {resultado['mensajes_por_segundo']} mensajes/s)")
+    for clave, titulo in (("latencia_ms", "latencia total"), ("latencia_texto_ms", "latencia mensajes"),
+                          ("handler_ms", "handler"), ("lag_event_loop_ms", "lag event loop")):
+        p = resultado[clave]
+        if p:
+            print(f"  {titulo:<18} p50 {p['p50']:>8} ms  p95 {p['p95']:>8} ms  p99 {p['p99']:>8} ms  max {p['max']:>8} ms")
+    b = resultado["bloqueo_sqlite"]
+    print(f"  bloqueo SQLite     {b['esperas']} esperas, {b['segundos']} s en total, máx {b['max_espera'] * 1000:.1f} ms")
+    print(f"  RSS pico           {resultado['rss_pico_mb']} MB")
+    print(f"  contadores         {resultado['contadores']}")
+    print(f"  alertas            {resultado['alertas']}")
+    for etapa, datos in resultado["etapas"].items():
+        print(f"  {etapa:<32} {datos['n']:>7}  media {datos['media_ms']:>8} ms")
+    print(f"  servicios          {resultado['servicios']}")
+
+
+def comparar(ruta, ultimas):
+    if not os.path.isfile(ruta):
+        print(f"No hay resultados en {ruta}")
+        return
+    with open(ruta, encoding="utf-8") as f:
+        corridas = [json.loads(linea) for linea in f if linea.strip()][-ultimas:]
+    print(f"{'fecha':<20} {'commit':<16} {'estud.':>6} {'upd/s':>7} {'p50':>7} {'p95':>7} {'p99':>7} "
+          f"{'esperas':>8} {'RSS MB':>7}")
+    for c in corridas:
+        lat = c["latencia_ms"]
+        print(f"{c['fecha']:<20} {str(c['commit']):<16} {c['parametros']['estudiantes']:>6} "
+              f"{c['updates_por_segundo']:>7} {lat.get('p50', 0):>7} {lat.get('p95', 0):>7} {lat.get('p99', 0):>7} "
+              f"{c['bloqueo_sqlite']['esperas']:>8} {c['rss_pico_mb']:>7}")
+
+
+def argumentos(argv=None):
+    p = argparse.ArgumentParser(description="Prueba de carga de Serenity con servicios externos simulados.")
+    p.add_argument("--estudiantes", type=int, default=1000)
+    p.add_argument("--mensajes", type=int, default=5, help="mensajes normales por estudiante")
+    p.add_argument("--riesgo", type=float, default=0.05, help="fracción de estudiantes que envían un mensaje de riesgo")
+    p.add_argument("--consentimiento", type=float, default=0.5, help="fracción de esos que aceptan compartir datos")
+    p.add_argument("--pausa", type=float, default=0.5, help="pausa media entre mensajes de un estudiante (s)")
+    p.add_argument("--rampa", type=float, default=5.0, help="segundos en los que se reparten los arranques")
+    p.add_argument("--primer-id", type=int, default=900_000_000, help="user_id del primer estudiante simulado")
+    p.add_argument("--latencia-openai", type=float, default=0.3)
+    p.add_argument("--errores-openai", type=float, default=0.0)
+    p.add_argument("--latencia-telegram", type=float, default=0.03)
+    p.add_argument("--latencia-smtp", type=float, default=0.1)
+    p.add_argument("--errores-smtp", type=float, default=0.0)
+    p.add_argument("--latencia-twilio", type=float, default=0.1)
+    p.add_argument("--errores-twilio", type=float, default=0.0)
+    p.add_argument("--espera-alertas", type=float, default=15.0, help="máximo a esperar que se despachen las alertas (s)")
+    p.add_argument("--db", help="base a usar (por defecto una temporal nueva)")
+    p.add_argument("--semilla", type=int, default=None)
+    p.add_argument("--resultados", default=os.path.join(BASE_DIR, "resultados_carga.jsonl"))
+    p.add_argument("--comparar", type=int, metavar="N", help="muestra las últimas N corridas y termina")
+    p.add_argument("--verbose", action="store_true", help="deja el log del bot en INFO")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = argumentos(argv)
+    if args.comparar:
+        comparar(args.resultados, args.comparar)
+        return
+    if args.semilla is not None:
+        random.seed(args.semilla)
+
+    servidores = ServidoresPrueba(
+        openai=Perfil(args.latencia_openai, args.errores_openai),
+        telegram=Perfil(args.latencia_telegram),
+        smtp=Perfil(args.latencia_smtp, args.errores_smtp),
+        twilio=Perfil(args.latencia_twilio, args.errores_twilio),
+    )
+    puertos = servidores.iniciar()
+    directorio = tempfile.TemporaryDirectory(prefix="serenity_carga_")
+    configurar_entorno(puertos, args.db or os.path.join(directorio.name, "carga.db"))
+
+    import serenity
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    try:
+        resultado = asyncio.run(Carga(serenity, args).correr(puertos["telegram"]))
+    finally:
+        servidores.detener()
+        directorio.cleanup()
+    resultado["servicios"] = servidores.contadores()
+
+    imprimir(resultado)
+    with open(args.resultados, "a", encoding="utf-8") as f:
+        f.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+    print(f"\nResultado agregado a {args.resultados}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
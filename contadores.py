@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger("serenity.contadores")
+
+
+class ContadoresEnLote:
+    """
+    Contadores por clave que viven en memoria y se escriben a SQLite en lote.
+
+    incrementar() no toca la base salvo para leer el valor inicial de una
+    clave que no está en memoria (`leer`, una consulta que devuelve el valor).
+    volcar() escribe todas las claves modificadas en una sola transacción con
+    `escribir(clave, valor, ahora)`, y se ejecuta cada `intervalo` segundos,
+    al acumular `max_pendientes` claves o al detener. Un corte abrupto pierde
+    como máximo los incrementos del último intervalo.
+    """
+
+    def __init__(self, db, leer, escribir, intervalo=30, max_pendientes=500):
+        self.db = db
+        self.leer = leer
+        self.escribir = escribir
+        self.intervalo = intervalo
+        self.max_pendientes = max_pendientes
+        self._valores = {}
+        self._sucios = set()
+        self._lock = threading.Lock()
+        self._tarea = None
+
+    def _valor(self, clave):
+        if clave not in self._valores:
+            fila = self.db.uno(self.leer, (clave,))
+            self._valores[clave] = (fila[0] or 0) if fila else 0
+        return self._valores[clave]
+
+    def incrementar(self, clave, n=1):
+        with self._lock:
+            valor = self._valor(clave) + n
+            self._valores[clave] = valor
+            self._sucios.add(clave)
+            lleno = len(self._sucios) >= self.max_pendientes
+        if lleno:
+            self.volcar()
+        return valor
+
+    def reiniciar(self, clave):
+        """Marca la clave en 0 cuando quien llama ya lo guardó en la base."""
+        with self._lock:
+            self._valores[clave] = 0
+            self._sucios.discard(clave)
+
+    def volcar(self):
+        """
+        Escribe las claves modificadas y devuelve cuántas. El lock se mantiene
+        hasta el commit: si se soltara antes, un incrementar() de otro hilo
+        podría releer de la base el valor viejo y el volcado siguiente
+        pisaría el que se está escribiendo.
+        """
+        with self._lock:
+            if not self._sucios:
+                return 0
+            filas = [(clave, self._valores[clave]) for clave in self._sucios]
+            ahora = datetime.now().isoformat()
+            with self.db.transaccion() as cursor:
+                cursor.executemany(self.escribir, [(clave, valor, ahora) for clave, valor in filas])
+            self._sucios.clear()
+            # Los valores ya están en la base; se vuelven a leer si hacen falta.
+            self._valores.clear()
+        return len(filas)
+
+    def iniciar(self):
+        self._tarea = asyncio.create_task(self._bucle())
+        return self._tarea
+
+    async def detener(self):
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+        self.volcar()
+
+    async def _bucle(self):
+        while True:
+            await asyncio.sleep(self.intervalo)
+            try:
+                self.volcar()
+            except Exception as e:
+                logger.error(f"[Contadores] Error al volcar: {e}")
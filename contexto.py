@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from datetime import datetime
+
+import arranque
+
+logger = logging.getLogger("serenity.contexto")
+
+_codificador = None
+
+
+def contar_tokens(texto):
+    """Tokens de `texto` con tiktoken si está instalado; si no, ~4 caracteres por token."""
+    global _codificador
+    if not texto:
+        return 0
+    if _codificador is None:
+        try:
+            _codificador = arranque.importar("tiktoken").get_encoding("o200k_base")
+        except Exception as e:
+            logger.warning(f"[Contexto] tiktoken no disponible ({e}); se estiman ~4 caracteres por token")
+            _codificador = False
+    if _codificador:
+        return len(_codificador.encode(texto))
+    return (len(texto) + 3) // 4
+
+
+def recortar(texto, max_tokens):
+    """Corta un mensaje largo a unos `max_tokens`, marcando el corte."""
+    texto = texto or ""
+    if contar_tokens(texto) <= max_tokens:
+        return texto
+    return texto[: max_tokens * 4].rstrip() + " […]"
+
+
+def ajustar_turnos(turnos, presupuesto, max_por_mensaje):
+    """
+    Devuelve los turnos (user, bot, fecha) más recientes que caben en
+    `presupuesto` tokens, en orden cronológico, con cada mensaje recortado a
+    `max_por_mensaje`.
+    """
+    elegidos = []
+    usados = 0
+    for u_msg, b_msg, fecha in reversed(turnos):
+        u_msg = recortar(u_msg, max_por_mensaje)
+        b_msg = recortar(b_msg, max_por_mensaje)
+        costo = contar_tokens(u_msg) + contar_tokens(b_msg) + 8
+        if usados + costo > presupuesto:
+            break
+        elegidos.append((u_msg, b_msg, fecha))
+        usados += costo
+    return elegidos[::-1]
+
+
+def sin_resumir(turnos, hasta_fecha):
+    """Descarta los turnos que ya están incluidos en el resumen."""
+    if not hasta_fecha:
+        return turnos
+    return [t for t in turnos if t[2] > hasta_fecha]
+
+
+def construir_mensajes(sistema, resumen, turnos, mensaje_actual, presupuesto, max_por_mensaje):
+    """Arma los mensajes de chat: sistema, resumen previo, turnos recientes y el mensaje actual."""
+    mensaje_actual = recortar(mensaje_actual, max(max_por_mensaje, presupuesto // 3))
+    mensajes = [{"role": "system", "content": sistema}]
+    if resumen:
+        mensajes.append({
+            "role": "system",
+            "content": f"Resumen de las conversaciones anteriores con este usuario:\n{resumen}",
+        })
+    restante = presupuesto - contar_tokens(sistema) - contar_tokens(resumen) - contar_tokens(mensaje_actual)
+    for u_msg, b_msg, _fecha in ajustar_turnos(turnos, restante, max_por_mensaje):
+        mensajes.append({"role": "user", "content": u_msg})
+        mensajes.append({"role": "assistant", "content": b_msg})
+    mensajes.append({"role": "user", "content": mensaje_actual})
+    return mensajes
+
+
+class ResumenesConversacion:
+    """
+    Resumen acumulado por usuario (tabla resumenes) de todos los turnos con
+    id <= hasta_id. Los turnos posteriores se envían tal cual.
+
+    Cuando hay al menos `mantener + cada` turnos sin resumir, programar()
+    lanza en segundo plano una actualización que incorpora al resumen los más
+    antiguos y deja sin resumir los últimos `mantener`. Así el resumen se
+    regenera solo cada `cada` mensajes nuevos.
+
+    programar() se llama en cada mensaje y no consulta la base: lleva en
+    memoria cuántos mensajes faltan para la próxima revisión (la primera vez
+    por usuario en el proceso, o al vencer la cuenta, sí cuenta en SQLite).
+
+    `resumir(resumen_anterior, filas)` es una corrutina que recibe las filas
+    (id, user_message, bot_message, timestamp) y devuelve el resumen nuevo.
+    """
+
+    def __init__(self, db, resumir, mantener=6, cada=10, max_lote=40):
+        self.db = db
+        self.resumir = resumir
+        self.mantener = mantener
+        self.cada = cada
+        self.max_lote = max_lote
+        self._en_curso = set()
+        self._tareas = set()
+        self._faltan = {}
+
+    def obtener(self, user_id):
+        """Devuelve (resumen, hasta_fecha); ("", None) si el usuario aún no tiene."""
+        fila = self.db.uno("SELECT resumen, hasta_fecha FROM resumenes WHERE user_id=?", (user_id,))
+        return (fila[0], fila[1]) if fila else ("", None)
+
+    def programar(self, user_id):
+        """Cuenta un mensaje nuevo del usuario y, si ya toca, actualiza su resumen en segundo plano."""
+        faltan = self._faltan.get(user_id)
+        if faltan is not None and faltan > 1:
+            self._faltan[user_id] = faltan - 1
+            return
+        if user_id in self._en_curso:
+            return
+        self._en_curso.add(user_id)
+        tarea = asyncio.create_task(self._actualizar_en_fondo(user_id))
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+
+    async def _actualizar_en_fondo(self, user_id):
+        try:
+            await self.actualizar(user_id)
+        except Exception as e:
+            self._faltan[user_id] = self.cada
+            logger.error(f"[Resumen] Error actualizando el resumen de {user_id}: {e}")
+        finally:
+            self._en_curso.discard(user_id)
+
+    async def actualizar(self, user_id):
+        fila = self.db.uno("SELECT resumen, hasta_id, turnos FROM resumenes WHERE user_id=?", (user_id,))
+        anterior, hasta_id, turnos = fila if fila else ("", 0, 0)
+        pendientes = self.db.uno(
+            "SELECT COUNT(*) FROM conversaciones WHERE user_id=? AND id>?", (user_id, hasta_id)
+        )[0]
+        if pendientes < self.mantener + self.cada:
+            self._faltan[user_id] = self.mantener + self.cada - pendientes
+            return False
+
+        filas = self.db.todos("""
+            SELECT id, user_message, bot_message, timestamp FROM conversaciones
+            WHERE user_id=? AND id>? ORDER BY id LIMIT ?
+        """, (user_id, hasta_id, min(pendientes - self.mantener, self.max_lote)))
+        nuevo = await self.resumir(anterior, filas)
+        if not nuevo:
+            self._faltan[user_id] = self.cada
+            return False
+
+        ultimo_id, _u, _b, ultima_fecha = filas[-1]
+        self.db.ejecutar("""
+            INSERT INTO resumenes (user_id, resumen, hasta_id, hasta_fecha, turnos, actualizado)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                resumen=excluded.resumen, hasta_id=excluded.hasta_id, hasta_fecha=excluded.hasta_fecha,
+                turnos=excluded.turnos, actualizado=excluded.actualizado
+        """, (user_id, nuevo, ultimo_id, ultima_fecha, turnos + len(filas), datetime.now().isoformat()))
+        self._faltan[user_id] = max(self.mantener + self.cada - (pendientes - len(filas)), 1)
+        logger.info(f"[Resumen] Usuario {user_id}: +{len(filas)} turnos resumidos")
+        return True
@@ -0,0 +1,155 @@
+import json
+import random
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("serenity.despachador")
+
+
+class DespachadorAlertas:
+    """
+    Bandeja de salida durable para las alertas (tabla alertas_envios).
+
+    Cada alerta se encola como una fila por canal. Un worker asyncio reparte
+    los canales en paralelo, reintenta con backoff exponencial y registra el
+    estado real de cada entrega en alertas.enviada_<canal>. Las filas
+    pendientes sobreviven a un reinicio y se reanudan al iniciar.
+
+    `canales` es un dict {nombre: funcion(payload)}. La función se ejecuta en
+    un hilo; devuelve True si entregó, False si el canal no está configurado
+    (la fila queda como 'omitido') y lanza una excepción si falló.
+
+    El payload lleva datos personales (contacto e historial), así que se borra
+    en cuanto la fila llega a un estado final (enviado, omitido o fallido).
+    """
+
+    def __init__(self, db, canales, max_intentos=6, espera_base=30, intervalo=15, lote=20):
+        self.db = db
+        self.canales = canales
+        self.max_intentos = max_intentos
+        self.espera_base = espera_base
+        self.intervalo = intervalo
+        self.lote = lote
+        self._evento = None
+        self._tarea = None
+
+    def encolar(self, alerta_id, payload, canales=None):
+        ahora = datetime.now().isoformat()
+        datos = json.dumps(payload, ensure_ascii=False, default=str)
+        with self.db.transaccion() as cur:
+            for canal in canales or self.canales:
+                cur.execute("""
+                    INSERT INTO alertas_envios (alerta_id, canal, estado, intentos, proximo_intento, payload, creado)
+                    VALUES (?, ?, 'pendiente', 0, ?, ?, ?)
+                """, (alerta_id, canal, ahora, datos, ahora))
+        if self._evento is not None:
+            self._evento.set()
+
+    def olvidar_datos(self, user_id):
+        """
+        Quita los datos de contacto de los envíos pendientes del usuario (cuando
+        pide eliminar sus datos); la alerta se sigue enviando, sin ellos.
+        """
+        with self.db.transaccion() as cur:
+            filas = cur.execute("""
+                SELECT e.id, e.payload FROM alertas_envios e JOIN alertas a ON a.id = e.alerta_id
+                WHERE a.usuario_id=? AND e.estado='pendiente' AND e.payload IS NOT NULL
+            """, (user_id,)).fetchall()
+            for envio_id, payload in filas:
+                datos = json.loads(payload)
+                datos["datos_usuario"] = None
+                cur.execute(
+                    "UPDATE alertas_envios SET payload=? WHERE id=?",
+                    (json.dumps(datos, ensure_ascii=False, default=str), envio_id),
+                )
+        return len(filas)
+
+    def iniciar(self):
+        self._evento = asyncio.Event()
+        self._tarea = asyncio.create_task(self._bucle())
+        return self._tarea
+
+    async def detener(self):
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+
+    async def _bucle(self):
+        pendientes = self.db.uno("SELECT COUNT(*) FROM alertas_envios WHERE estado='pendiente'")[0]
+        if pendientes:
+            logger.info(f"[Despacho] Reanudando {pendientes} envíos pendientes")
+        while True:
+            try:
+                procesados = await self.procesar_pendientes()
+            except Exception as e:
+                logger.error(f"[Despacho] Error en el ciclo: {e}")
+                procesados = 0
+            if procesados:
+                continue
+            self._evento.clear()
+            try:
+                await asyncio.wait_for(self._evento.wait(), timeout=self._espera_siguiente())
+            except asyncio.TimeoutError:
+                pass
+
+    def _espera_siguiente(self):
+        fila = self.db.uno(
+            "SELECT MIN(proximo_intento) FROM alertas_envios WHERE estado='pendiente'"
+        )
+        if not fila or not fila[0]:
+            return self.intervalo
+        faltan = (datetime.fromisoformat(fila[0]) - datetime.now()).total_seconds()
+        return min(max(faltan, 0.1), self.intervalo)
+
+    async def procesar_pendientes(self):
+        filas = self.db.todos("""
+            SELECT id, alerta_id, canal, intentos, payload FROM alertas_envios
+            WHERE estado='pendiente' AND proximo_intento<=?
+            ORDER BY id LIMIT ?
+        """, (datetime.now().isoformat(), self.lote))
+        if filas:
+            await asyncio.gather(*(self._enviar(*fila) for fila in filas))
+        return len(filas)
+
+    async def _enviar(self, envio_id, alerta_id, canal, intentos, payload):
+        funcion = self.canales.get(canal)
+        intentos += 1
+        try:
+            if funcion is None:
+                raise RuntimeError(f"canal desconocido: {canal}")
+            entregado = await asyncio.to_thread(funcion, json.loads(payload))
+        except Exception as e:
+            logger.error(f"[Despacho] Error enviando {canal} (alerta {alerta_id}, intento {intentos}): {e}")
+            self._registrar_fallo(envio_id, intentos, str(e))
+            return
+
+        ahora = datetime.now().isoformat()
+        estado = "enviado" if entregado else "omitido"
+        with self.db.transaccion() as cur:
+            cur.execute(
+                "UPDATE alertas_envios SET estado=?, intentos=?, enviado=?, ultimo_error=NULL, payload=NULL "
+                "WHERE id=?",
+                (estado, intentos, ahora if entregado else None, envio_id),
+            )
+            if entregado and alerta_id:
+                cur.execute(f"UPDATE alertas SET enviada_{canal}=1 WHERE id=?", (alerta_id,))
+
+    def _registrar_fallo(self, envio_id, intentos, error):
+        if intentos >= self.max_intentos:
+            self.db.ejecutar(
+                "UPDATE alertas_envios SET estado='fallido', intentos=?, ultimo_error=?, payload=NULL WHERE id=?",
+                (intentos, error, envio_id),
+            )
+            return
+        espera = self.espera_base * (2 ** (intentos - 1))
+        espera *= random.uniform(0.8, 1.2)
+        proximo = (datetime.now() + timedelta(seconds=espera)).isoformat()
+        self.db.ejecutar(
+            "UPDATE alertas_envios SET intentos=?, proximo_intento=?, ultimo_error=? WHERE id=?",
+            (intentos, proximo, error, envio_id),
+        )
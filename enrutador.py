@@ -0,0 +1,222 @@
+import os
+import sys
+import time
+import bisect
+import asyncio
+import hashlib
+import logging
+from collections import deque
+
+import aiohttp
+
+logger = logging.getLogger("serenity.enrutador")
+
+ESPERA_MAX_REINTENTO = 10
+
+
+def _hash(texto):
+    return int.from_bytes(hashlib.blake2b(texto.encode(), digest_size=8).digest(), "big")
+
+
+class AnilloConsistente:
+    """
+    Hash consistente con `replicas` puntos virtuales por nodo: al agregar o
+    quitar un worker solo cambia de dueño ~1/N de los usuarios, y los demás
+    siguen llegando al mismo proceso (y a sus cachés en memoria).
+    """
+
+    def __init__(self, nodos, replicas=100):
+        puntos = sorted((_hash(f"{nodo}#{i}"), nodo) for nodo in nodos for i in range(replicas))
+        self._claves = [h for h, _ in puntos]
+        self._nodos = [n for _, n in puntos]
+
+    def nodo(self, clave):
+        i = bisect.bisect(self._claves, _hash(str(clave))) % len(self._claves)
+        return self._nodos[i]
+
+
+class Enrutador:
+    """
+    Destino del ServidorWebhook en el proceso de ingreso: reparte cada update
+    al worker que le toca a su usuario según el AnilloConsistente y se lo
+    reenvía por HTTP a `url + ruta` (el mismo webhook que atendería el bot en
+    un solo proceso).
+
+    Cada worker tiene una cola FIFO y una tarea que la reenvía de a uno, así
+    que los updates de un usuario llegan en orden. Si el worker responde 429
+    o 503, o no contesta (se está reiniciando), el update se queda al frente
+    y se reintenta con backoff; si las colas llegan a `capacidad`, encolar()
+    devuelve False y el servidor responde 429 a Telegram. Un 400 (update
+    inválido) se descarta. La entrega es al menos una vez: si un POST vence
+    después de que el worker lo aceptó, se reenvía.
+    """
+
+    def __init__(self, urls, ruta, capacidad=1000, replicas=100, timeout=10):
+        self.urls = list(urls)
+        self.ruta = ruta
+        self.capacidad = capacidad
+        self.timeout = timeout
+        self.anillo = AnilloConsistente(self.urls, replicas)
+        self.pendientes = 0
+        self.reintentos = 0
+        self.descartados = 0
+        self.reenviados = {url: 0 for url in self.urls}
+        self._colas = {url: deque() for url in self.urls}
+        self._eventos = {}
+        self._tareas = []
+        self._sesion = None
+        self._vacio = asyncio.Event()
+        self._vacio.set()
+
+    def iniciar(self):
+        self._sesion = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        for url in self.urls:
+            self._eventos[url] = asyncio.Event()
+            self._tareas.append(asyncio.create_task(self._reenviar(url)))
+
+    async def detener(self):
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+        if self._sesion is not None:
+            await self._sesion.close()
+            self._sesion = None
+
+    def encolar(self, entrada):
+        """`entrada` es (clave de usuario, update en JSON). No bloquea."""
+        if self.pendientes >= self.capacidad:
+            return False
+        clave, datos = entrada
+        url = self.anillo.nodo(clave) if clave is not None else self.urls[0]
+        self._colas[url].append(datos)
+        self.pendientes += 1
+        self._vacio.clear()
+        self._eventos[url].set()
+        return True
+
+    async def _reenviar(self, url):
+        cola = self._colas[url]
+        evento = self._eventos[url]
+        espera = 0.5
+        while True:
+            if not cola:
+                evento.clear()
+                await evento.wait()
+                continue
+            try:
+                async with self._sesion.post(url + self.ruta, json=cola[0]) as respuesta:
+                    estado = respuesta.status
+                    reintentar_en = respuesta.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                estado, reintentar_en = None, None
+                if espera == 0.5:
+                    logger.warning(f"[Enrutador] {url} no responde ({type(e).__name__}); se reintenta")
+
+            if estado == 200 or estado == 400:
+                if estado == 400:
+                    self.descartados += 1
+                    logger.error(f"[Enrutador] {url} rechazó un update inválido, se descarta")
+                else:
+                    self.reenviados[url] += 1
+                cola.popleft()
+                self.pendientes -= 1
+                if not self.pendientes:
+                    self._vacio.set()
+                espera = 0.5
+                continue
+
+            self.reintentos += 1
+            await asyncio.sleep(float(reintentar_en) if reintentar_en else espera)
+            espera = min(espera * 2, ESPERA_MAX_REINTENTO)
+
+    async def vaciar(self, espera=10):
+        """Espera a que se reenvíen los updates en cola (hasta `espera` segundos)."""
+        try:
+            await asyncio.wait_for(self._vacio.wait(), timeout=espera)
+        except asyncio.TimeoutError:
+            logger.warning(f"[Enrutador] Quedan {self.pendientes} updates sin reenviar al detener")
+
+    def estadisticas(self):
+        return {
+            "pendientes": self.pendientes,
+            "capacidad": self.capacidad,
+            "reintentos": self.reintentos,
+            "descartados": self.descartados,
+            "workers": {
+                url: {"en_cola": len(self._colas[url]), "reenviados": self.reenviados[url]} for url in self.urls
+            },
+        }
+
+
+class SupervisorWorkers:
+    """
+    Lanza `n` procesos `python script` en modo worker, cada uno escuchando en
+    127.0.0.1:(puerto_base + i), y los vuelve a lanzar si terminan (con
+    backoff si se caen apenas arrancan). detener() les manda SIGTERM y espera
+    a que vacíen su cola antes de matarlos. Cada worker corre en su propia
+    sesión y usa vigilar_supervisor() para no quedar huérfano si el ingreso muere.
+    """
+
+    def __init__(self, n, puerto_base, script, host="127.0.0.1"):
+        self.n = n
+        self.puerto_base = puerto_base
+        self.script = script
+        self.host = host
+        self.reinicios = 0
+        self._procesos = {}
+        self._tareas = []
+
+    def urls(self):
+        return [f"http://{self.host}:{self.puerto_base + i}" for i in range(self.n)]
+
+    def iniciar(self):
+        self._tareas = [asyncio.create_task(self._vigilar(i)) for i in range(self.n)]
+
+    async def _vigilar(self, i):
+        espera = 1
+        while True:
+            entorno = dict(os.environ, SERENITY_MODO="worker", SERENITY_WORKER=str(i),
+                           PORT=str(self.puerto_base + i), WORKER_HOST=self.host,
+                           SERENITY_SUPERVISOR=str(os.getpid()), SERENITY_WORKERS=str(self.n))
+            inicio = time.monotonic()
+            # En su propia sesión: un Ctrl-C en la terminal no los detiene por fuera del supervisor.
+            proceso = await asyncio.create_subprocess_exec(
+                sys.executable, self.script, env=entorno, start_new_session=True
+            )
+            self._procesos[i] = proceso
+            logger.info(f"[Workers] Worker {i} iniciado (pid {proceso.pid}, puerto {self.puerto_base + i})")
+            codigo = await proceso.wait()
+            self.reinicios += 1
+            espera = 1 if time.monotonic() - inicio > 60 else min(espera * 2, 30)
+            logger.error(f"[Workers] Worker {i} terminó con código {codigo}; se reinicia en {espera} s")
+            await asyncio.sleep(espera)
+
+    async def detener(self, espera=15):
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        vivos = [p for p in self._procesos.values() if p.returncode is None]
+        for proceso in vivos:
+            proceso.terminate()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.wait() for p in vivos)), timeout=espera)
+        except asyncio.TimeoutError:
+            for proceso in vivos:
+                if proceso.returncode is None:
+                    logger.warning(f"[Workers] El worker pid {proceso.pid} no terminó a tiempo, se mata")
+                    proceso.kill()
+        self._procesos = {}
+
+
+async def vigilar_supervisor(detener, intervalo=2):
+    """En un worker lanzado por SupervisorWorkers: activa `detener` si el supervisor ya no existe."""
+    padre = int(os.getenv("SERENITY_SUPERVISOR", "0"))
+    if not padre:
+        return
+    while not detener.is_set():
+        if os.getppid() != padre:
+            logger.error("[Workers] El proceso de ingreso terminó; se detiene el worker")
+            detener.set()
+            return
+        await asyncio.sleep(intervalo)
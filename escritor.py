@@ -0,0 +1,181 @@
+import sys
+import time
+import asyncio
+import logging
+from collections import Counter
+
+import metricas
+import trazas
+
+logger = logging.getLogger("serenity.escritor")
+
+MODOS = ("inmediato", "grupo", "diferido")
+
+
+class EscritorDiferido:
+    """
+    Un solo escritor que agrupa las escrituras de todos los handlers en una
+    transacción (group commit). El commit corre en un hilo; lo que llega
+    mientras tanto forma el siguiente lote, así que con carga los lotes crecen
+    solos y sin carga no se agrega latencia. Con `max_espera_ms` > 0 además
+    espera ese tiempo (o a juntar `max_filas` sentencias) antes de cada lote.
+
+    Modos de durabilidad:
+      - "inmediato": cada escribir() hace su propia transacción (como antes).
+      - "grupo": escribir() espera a que su lote se confirme; al volver, la
+        escritura es tan durable como en "inmediato", pero varios handlers
+        comparten el mismo commit.
+      - "diferido": escribir() vuelve de inmediato; un corte abrupto puede
+        perder el lote en curso y lo encolado (milisegundos de escrituras).
+
+    detener() vuelca lo pendiente antes de terminar. Sin tarea activa (antes
+    de iniciar o después de detener) se escribe de forma inmediata.
+    """
+
+    def __init__(self, db, modo="grupo", max_filas=200, max_espera_ms=0):
+        if modo not in MODOS:
+            raise ValueError(f"modo de escritura desconocido: {modo}")
+        self.db = db
+        self.modo = modo
+        self.max_filas = max_filas
+        self.max_espera = max_espera_ms / 1000
+        self.contadores = Counter()
+        self._pendientes = []
+        self._filas = 0
+        self._evento = None
+        self._lleno = None
+        self._detener = False
+        self._tarea = None
+
+    async def escribir(self, operaciones):
+        """`operaciones` es una lista de (sentencia, params) que se confirma junta."""
+        with trazas.tramo("db.escribir", modo=self.modo, sentencias=len(operaciones)):
+            await self._escribir(operaciones)
+
+    async def _escribir(self, operaciones):
+        if self.modo == "inmediato" or self._tarea is None:
+            self._escribir_lote([(operaciones, None)])
+            return
+        futuro = asyncio.get_running_loop().create_future() if self.modo == "grupo" else None
+        self._pendientes.append((operaciones, futuro))
+        self._filas += len(operaciones)
+        self._evento.set()
+        if self._filas >= self.max_filas:
+            self._lleno.set()
+        if futuro is not None:
+            await futuro
+
+    def _escribir_lote(self, lote):
+        with metricas.Etapa("sqlite_escritura"), self.db.transaccion() as cursor:
+            for operaciones, _futuro in lote:
+                for sentencia, params in operaciones:
+                    cursor.execute(sentencia, params)
+        self.contadores["commits"] += 1
+        self.contadores["filas"] += sum(len(ops) for ops, _f in lote)
+
+    async def _volcar(self):
+        lote, self._pendientes = self._pendientes, []
+        self._filas = 0
+        self._evento.clear()
+        self._lleno.clear()
+        if not lote:
+            return
+        try:
+            await asyncio.to_thread(self._escribir_lote, lote)
+        except Exception as e:
+            # Una operación inválida no debe tumbar al resto del lote: se reintenta por separado.
+            logger.error(f"[Escritor] Falló un lote de {len(lote)} escrituras, se reintentan una a una: {e}")
+            for operaciones, futuro in lote:
+                try:
+                    await asyncio.to_thread(self._escribir_lote, [(operaciones, None)])
+                except Exception as e2:
+                    self.contadores["errores"] += 1
+                    if futuro is not None and not futuro.done():
+                        futuro.set_exception(e2)
+                    else:
+                        logger.error(f"[Escritor] Escritura descartada: {e2}")
+                    continue
+                if futuro is not None and not futuro.done():
+                    futuro.set_result(None)
+            return
+        self.contadores["lotes"] += 1
+        self.contadores["max_lote"] = max(self.contadores["max_lote"], len(lote))
+        for _operaciones, futuro in lote:
+            if futuro is not None and not futuro.done():
+                futuro.set_result(None)
+
+    async def _bucle(self):
+        while True:
+            await self._evento.wait()
+            if self.max_espera and not self._detener:
+                try:
+                    await asyncio.wait_for(self._lleno.wait(), timeout=self.max_espera)
+                except asyncio.TimeoutError:
+                    pass
+            await self._volcar()
+            if self._detener and not self._pendientes:
+                return
+
+    def iniciar(self):
+        if self.modo == "inmediato":
+            return None
+        self._detener = False
+        self._evento = asyncio.Event()
+        self._lleno = asyncio.Event()
+        self._tarea = asyncio.create_task(self._bucle())
+        return self._tarea
+
+    async def detener(self):
+        """Vuelca todo lo pendiente y termina el escritor."""
+        if self._tarea is None:
+            return
+        self._detener = True
+        self._evento.set()
+        await self._tarea
+        self._tarea = None
+        logger.info(f"[Escritor] Detenido: {dict(self.contadores)}")
+
+    def estadisticas(self):
+        return {"modo": self.modo, "pendientes": self._filas, **self.contadores}
+
+
+async def _bench(db, modo, handlers, mensajes):
+    escritor = EscritorDiferido(db, modo=modo)
+    escritor.iniciar()
+
+    async def handler(user_id):
+        for i in range(mensajes):
+            await escritor.escribir([
+                ("INSERT OR IGNORE INTO usuarios (id, user_name, ultima_alerta) VALUES (?, ?, ?)",
+                 (user_id, f"u{user_id}", None)),
+                ("INSERT INTO conversaciones (user_id, user_message, bot_message, timestamp) VALUES (?, ?, ?, ?)",
+                 (user_id, f"mensaje {i}", "respuesta", time.time())),
+            ])
+            await asyncio.sleep(0)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(handler(u) for u in range(1, handlers + 1)))
+    await escritor.detener()
+    return time.perf_counter() - inicio, escritor.contadores["commits"]
+
+
+if __name__ == "__main__":
+    # Uso: python escritor.py [handlers] [mensajes_por_handler]
+    # Compara commits/s y mensajes/s de cada modo sobre una base temporal.
+    import os
+    import tempfile
+    from basedatos import ConexionSQLite
+    from migraciones import aplicar_migraciones
+
+    handlers = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    mensajes = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    print(f"{handlers} handlers x {mensajes} mensajes, synchronous={os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')}")
+    print(f"{'modo':<10} {'segundos':>9} {'commits':>8} {'commits/s':>10} {'mensajes/s':>11}")
+    with tempfile.TemporaryDirectory() as directorio:
+        for modo in MODOS:
+            db = ConexionSQLite(os.path.join(directorio, f"bench_{modo}.db"))
+            aplicar_migraciones(db)
+            segundos, commits = asyncio.run(_bench(db, modo, handlers, mensajes))
+            total = handlers * mensajes
+            print(f"{modo:<10} {segundos:9.2f} {commits:8d} {commits / segundos:10.0f} {total / segundos:11.0f}")
+            db.cerrar()
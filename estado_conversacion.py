@@ -0,0 +1,76 @@
+import json
+import logging
+import functools
+from datetime import datetime
+
+from basedatos import registrar_sentencia
+
+logger = logging.getLogger("serenity.estado")
+
+SQL_CARGAR_ESTADO = registrar_sentencia(
+    "cargar_estado", "SELECT datos FROM estado_conversacion WHERE user_id=?"
+)
+SQL_GUARDAR_ESTADO = registrar_sentencia("guardar_estado", """
+    INSERT INTO estado_conversacion (user_id, datos, actualizado) VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET datos=excluded.datos, actualizado=excluded.actualizado
+""")
+SQL_BORRAR_ESTADO = registrar_sentencia(
+    "borrar_estado", "DELETE FROM estado_conversacion WHERE user_id=?"
+)
+
+
+def _serializar(datos):
+    return json.dumps(datos, ensure_ascii=False, sort_keys=True, default=str)
+
+
+class EstadoConversacion:
+    """
+    Estado del flujo de conversación de cada usuario (estado, riesgo_data,
+    nombre/número/correo capturados) guardado en SQLite en lugar de solo en
+    context.user_data, para que sobreviva al reinicio de un proceso y lo vea
+    cualquier worker que reciba al usuario.
+
+    `envolver(handler)` carga el estado en context.user_data antes del
+    handler y lo escribe al terminar si cambió. Los updates de un mismo
+    usuario llegan en orden a un solo proceso (PlanificadorPorUsuario y el
+    enrutador), así que no hay dos escrituras concurrentes del mismo usuario.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def cargar(self, user_id):
+        fila = self.db.uno(SQL_CARGAR_ESTADO, (user_id,))
+        if not fila:
+            return {}
+        try:
+            return json.loads(fila[0])
+        except ValueError as e:
+            logger.error(f"[Estado] Estado ilegible de {user_id}, se descarta: {e}")
+            return {}
+
+    def guardar(self, user_id, datos):
+        """Guarda el estado; uno vacío (o solo con claves en None) borra la fila."""
+        if not any(v is not None for v in datos.values()):
+            self.borrar(user_id)
+            return
+        self.db.ejecutar(SQL_GUARDAR_ESTADO, (user_id, _serializar(datos), datetime.now().isoformat()))
+
+    def borrar(self, user_id):
+        self.db.ejecutar(SQL_BORRAR_ESTADO, (user_id,))
+
+    def envolver(self, handler):
+        @functools.wraps(handler)
+        async def envuelto(update, context):
+            user_id = update.effective_user.id
+            datos = self.cargar(user_id)
+            antes = _serializar(datos)
+            context.user_data.clear()
+            context.user_data.update(datos)
+            try:
+                return await handler(update, context)
+            finally:
+                despues = dict(context.user_data)
+                if _serializar(despues) != antes:
+                    self.guardar(user_id, despues)
+        return envuelto
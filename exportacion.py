@@ -0,0 +1,174 @@
+import io
+import os
+import csv
+import json
+import time
+import logging
+import threading
+
+import arranque
+from archivo import directorio_archivo, historial_completo
+
+logger = logging.getLogger("serenity.exportacion")
+
+COLUMNAS = ("id", "user_id", "user_message", "bot_message", "timestamp")
+
+
+def _filas_db(db, user_id, desde_id=0):
+    """
+    Recorre las filas con fetchmany: nunca carga el historial completo en
+    memoria. Incluye los meses archivados del usuario.
+    """
+    with db.lector() as conn:
+        yield from historial_completo(conn, directorio_archivo(db.ruta), user_id, desde_id)
+
+
+class CacheExportacion:
+    """
+    Caché incremental por usuario: un CSV con las filas ya exportadas y un
+    archivo de marca con el último id. Cada exportación solo lee de SQLite
+    las filas nuevas y las agrega al final del CSV.
+
+    Los CSV tienen la conversación completa, así que la caché se poda: se
+    borran los usuarios sin exportar en `max_dias` y, si el directorio pasa
+    de `max_mb`, los usados hace más tiempo. borrar() quita la de un usuario.
+    """
+
+    def __init__(self, directorio, max_mb=200, max_dias=7):
+        self.directorio = directorio
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_dias = max_dias
+        os.makedirs(directorio, exist_ok=True)
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _rutas(self, user_id):
+        base = os.path.join(self.directorio, f"conversaciones_{user_id}")
+        return base + ".csv", base + ".json"
+
+    def _lock_usuario(self, user_id):
+        with self._lock:
+            return self._locks.setdefault(user_id, threading.Lock())
+
+    def _ultimo_id(self, ruta_marca, ruta_csv):
+        if not (os.path.isfile(ruta_marca) and os.path.isfile(ruta_csv)):
+            return None
+        try:
+            with open(ruta_marca, "r", encoding="utf-8") as f:
+                return int(json.load(f)["ultimo_id"])
+        except Exception:
+            return None
+
+    def _sincronizar(self, db, user_id):
+        ruta_csv, ruta_marca = self._rutas(user_id)
+        ultimo_id = self._ultimo_id(ruta_marca, ruta_csv)
+        nuevo = ultimo_id is None
+        with open(ruta_csv, "w" if nuevo else "a", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            if nuevo:
+                writer.writerow(COLUMNAS)
+                ultimo_id = 0
+            agregadas = 0
+            for fila in _filas_db(db, user_id, ultimo_id):
+                writer.writerow(fila)
+                ultimo_id = fila[0]
+                agregadas += 1
+        # La marca se reescribe en cada exportación: su mtime es el último uso.
+        with open(ruta_marca, "w", encoding="utf-8") as f:
+            json.dump({"ultimo_id": ultimo_id}, f)
+        if agregadas:
+            logger.info(f"[Exportación] Caché de {user_id}: {agregadas} filas nuevas")
+        return ruta_csv
+
+    def sincronizar(self, db, user_id):
+        """Agrega al CSV del usuario las filas nuevas y devuelve la ruta del CSV."""
+        with self._lock_usuario(user_id):
+            return self._sincronizar(db, user_id)
+
+    def filas(self, db, user_id):
+        self.podar()
+        # El lock se mantiene mientras se lee: podar() y borrar() esperan.
+        with self._lock_usuario(user_id):
+            ruta_csv = self._sincronizar(db, user_id)
+            with open(ruta_csv, "r", encoding="utf-8", newline="") as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                for fila in reader:
+                    yield (int(fila[0]), int(fila[1]), *fila[2:])
+
+    def borrar(self, user_id):
+        """Elimina la caché del usuario (p. ej. cuando pide borrar sus datos)."""
+        with self._lock_usuario(user_id):
+            for ruta in self._rutas(user_id):
+                try:
+                    os.remove(ruta)
+                except FileNotFoundError:
+                    pass
+
+    def podar(self):
+        """Aplica los límites de antigüedad y tamaño; devuelve cuántos usuarios borró."""
+        entradas = []
+        for nombre in os.listdir(self.directorio):
+            if not (nombre.startswith("conversaciones_") and nombre.endswith(".csv")):
+                continue
+            try:
+                user_id = int(nombre[len("conversaciones_"):-len(".csv")])
+                ruta_csv, ruta_marca = self._rutas(user_id)
+                tamano = os.path.getsize(ruta_csv)
+                uso = os.path.getmtime(ruta_marca) if os.path.isfile(ruta_marca) else 0
+            except (ValueError, OSError):
+                continue
+            entradas.append((uso, tamano, user_id))
+
+        entradas.sort()
+        total = sum(tamano for _, tamano, _ in entradas)
+        limite = time.time() - self.max_dias * 86400
+        borrados = 0
+        for uso, tamano, user_id in entradas:
+            if uso >= limite and total <= self.max_bytes:
+                break
+            self.borrar(user_id)
+            total -= tamano
+            borrados += 1
+        if borrados:
+            logger.info(f"[Exportación] Caché podada: {borrados} usuarios, quedan {total // 1024} KB")
+        return borrados
+
+
+def _escribir_xlsx(filas, destino):
+    xlsxwriter = arranque.importar("xlsxwriter")
+    libro = xlsxwriter.Workbook(destino, {"constant_memory": True, "strings_to_numbers": False})
+    hoja = libro.add_worksheet("conversaciones")
+    negrita = libro.add_format({"bold": True})
+    hoja.write_row(0, 0, COLUMNAS, negrita)
+    for i, fila in enumerate(filas, 1):
+        hoja.write_row(i, 0, fila)
+    libro.close()
+
+
+def _escribir_csv(filas, destino):
+    texto = io.TextIOWrapper(destino, encoding="utf-8-sig", newline="", write_through=True)
+    writer = csv.writer(texto)
+    writer.writerow(COLUMNAS)
+    writer.writerows(filas)
+    texto.detach()
+
+
+def exportar_conversaciones(db, user_id, formato="xlsx", cache=None):
+    """
+    Exporta la conversación completa de un usuario a un buffer en memoria.
+    Las filas se transmiten desde un cursor (o desde la caché incremental)
+    directamente al escritor, sin pandas ni archivos temporales con nombre fijo.
+    Devuelve (bytes, nombre_sugerido, mimetype).
+    """
+    filas = cache.filas(db, user_id) if cache else _filas_db(db, user_id)
+    buffer = io.BytesIO()
+    if formato == "csv":
+        _escribir_csv(filas, buffer)
+        return buffer.getvalue(), f"conversaciones_{user_id}.csv", "text/csv"
+    _escribir_xlsx(filas, buffer)
+    return (
+        buffer.getvalue(),
+        f"conversaciones_{user_id}.xlsx",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
@@ -0,0 +1,203 @@
+import time
+import bisect
+import logging
+import threading
+
+import trazas
+
+logger = logging.getLogger("serenity.metricas")
+
+# Límites de los buckets en segundos: de 5 ms (lecturas de caché) a 60 s (análisis largos).
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BUCKETS_TOKENS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+# Métricas registradas en orden de creación; exponer() las recorre todas.
+REGISTRO = []
+
+
+def _etiquetas(nombres, valores, extra=""):
+    pares = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _numero(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+class Contador:
+    """Contador monótono con etiquetas. inc() es seguro desde hilos."""
+
+    tipo = "counter"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def inc(self, cantidad=1, *valores):
+        with self._lock:
+            self._valores[valores] = self._valores.get(valores, 0) + cantidad
+
+    def lineas(self):
+        with self._lock:
+            valores = list(self._valores.items())
+        for clave, valor in valores:
+            yield f"{self.nombre}{_etiquetas(self.etiquetas, clave)} {_numero(valor)}"
+
+
+class Histograma:
+    """
+    Histograma acumulativo al estilo Prometheus. observar() hace una búsqueda
+    binaria en los buckets y suma bajo un lock; el acumulado por bucket se
+    calcula al exponer, no en el camino caliente.
+    """
+
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEGUNDOS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observar(self, valor, *valores):
+        i = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(valores)
+            if serie is None:
+                serie = self._series[valores] = [[0] * (len(self.buckets) + 1), 0.0]
+            serie[0][i] += 1
+            serie[1] += valor
+
+    def lineas(self):
+        with self._lock:
+            series = [(clave, list(conteos), suma) for clave, (conteos, suma) in self._series.items()]
+        for clave, conteos, suma in series:
+            acumulado = 0
+            for limite, n in zip(self.buckets + (float("inf"),), conteos):
+                acumulado += n
+                le = 'le="' + _numero(limite) + '"'
+                yield f"{self.nombre}_bucket{_etiquetas(self.etiquetas, clave, le)} {acumulado}"
+            yield f"{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {_numero(suma)}"
+            yield f"{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {acumulado}"
+
+
+class Medidor:
+    """
+    Valor que se lee al exponer llamando a `funcion()`: un número, o un dict
+    {tupla de valores de etiquetas: número}. `tipo` puede ser "counter" para
+    totales que ya acumula otro objeto (p. ej. esperas del bloqueo de SQLite).
+    """
+
+    def __init__(self, nombre, ayuda, funcion, etiquetas=(), tipo="gauge"):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.funcion = funcion
+        self.etiquetas = tuple(etiquetas)
+        self.tipo = tipo
+
+    def lineas(self):
+        try:
+            valor = self.funcion()
+        except Exception as e:
+            logger.error(f"[Métricas] Error leyendo {self.nombre}: {e}")
+            return
+        if isinstance(valor, dict):
+            for clave, v in valor.items():
+                clave = clave if isinstance(clave, tuple) else (clave,)
+                yield f"{self.nombre}{_etiquetas(self.etiquetas, clave)} {_numero(v)}"
+        elif valor is not None:
+            yield f"{self.nombre} {_numero(valor)}"
+
+
+def _registrar(metrica):
+    REGISTRO[:] = [m for m in REGISTRO if m.nombre != metrica.nombre]
+    REGISTRO.append(metrica)
+    return metrica
+
+
+def contador(nombre, ayuda, etiquetas=()):
+    return _registrar(Contador(nombre, ayuda, etiquetas))
+
+
+def histograma(nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEGUNDOS):
+    return _registrar(Histograma(nombre, ayuda, etiquetas, buckets))
+
+
+def medidor(nombre, ayuda, funcion, etiquetas=(), tipo="gauge"):
+    """Registra (o reemplaza, si ya existe con ese nombre) un valor leído al exponer."""
+    return _registrar(Medidor(nombre, ayuda, funcion, etiquetas, tipo))
+
+
+def exponer():
+    """Todas las métricas en formato de texto de Prometheus (versión 0.0.4)."""
+    lineas = []
+    for metrica in REGISTRO:
+        lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+        lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+        lineas.extend(metrica.lineas())
+    return "\n".join(lineas) + "\n"
+
+
+ETAPAS = histograma(
+    "serenity_etapa_segundos",
+    "Duración de cada etapa del procesamiento de un mensaje, por resultado.",
+    ("etapa", "resultado"),
+)
+
+
+def resumen_etapas():
+    """{"etapa/resultado": {"n", "media_ms"}} de lo observado en ETAPAS (para reportes)."""
+    with ETAPAS._lock:
+        series = {clave: (sum(conteos), suma) for clave, (conteos, suma) in ETAPAS._series.items()}
+    return {
+        "/".join(clave): {"n": n, "media_ms": round(suma / n * 1000, 1)}
+        for clave, (n, suma) in sorted(series.items()) if n
+    }
+
+
+def registrar_etapa(nombre, inicio, resultado="ok"):
+    """Observa en ETAPAS el tiempo desde `inicio` (time.perf_counter())."""
+    ETAPAS.observar(time.perf_counter() - inicio, nombre, resultado)
+
+
+class Etapa:
+    """
+    Mide un bloque como etapa; el resultado es "error" si sale con excepción
+    y "ok" si no, salvo que el bloque asigne otro a `.resultado`. Si hay una
+    traza activa, el bloque también queda como tramo hijo (ver trazas.py).
+
+        with metricas.Etapa("smtp") as e:
+            if not enviar():
+                e.resultado = "omitido"
+    """
+
+    __slots__ = ("nombre", "resultado", "_inicio", "_tramo")
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.resultado = None
+
+    def __enter__(self):
+        self._tramo = trazas.tramo(self.nombre).__enter__()
+        self._inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo_error, error, traza):
+        resultado = self.resultado or ("error" if tipo_error else "ok")
+        registrar_etapa(self.nombre, self._inicio, resultado)
+        self._tramo.atributo("resultado", resultado)
+        self._tramo.__exit__(tipo_error, error, traza)
+        return False
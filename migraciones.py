@@ -0,0 +1,500 @@
+import logging
+
+logger = logging.getLogger("serenity.migraciones")
+
+
+def _tiene_columna(cursor, tabla, columna):
+    return any(fila[1] == columna for fila in cursor.execute(f"PRAGMA table_info({tabla})").fetchall())
+
+
+def _m001_esquema_inicial(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id INTEGER PRIMARY KEY,
+            user_name TEXT,
+            ultima_alerta TEXT,
+            UNIQUE(user_name)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversaciones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            user_message TEXT,
+            bot_message TEXT,
+            timestamp TEXT,
+            FOREIGN KEY (user_id) REFERENCES usuarios (id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS datos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            nombre TEXT,
+            numero TEXT,
+            correo_institucional TEXT,
+            fecha TEXT,
+            facultad TEXT,
+            FOREIGN KEY (user_id) REFERENCES usuarios (id)
+        )
+    """)
+
+    if not _tiene_columna(cursor, "datos", "facultad"):
+        cursor.execute("ALTER TABLE datos ADD COLUMN facultad TEXT")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dependencias (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE,
+            nivel_dependencia TEXT,
+            puntaje_total INTEGER DEFAULT 0,
+            ultima_evaluacion TEXT,
+            contador_mensajes INTEGER DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES usuarios (id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS historial_dependencias (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            nivel_dependencia TEXT,
+            puntaje_total INTEGER DEFAULT 0,
+            fecha_evaluacion TEXT,
+            FOREIGN KEY (user_id) REFERENCES usuarios (id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS alertas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER,
+            tipo_alerta TEXT,
+            nivel TEXT,
+            descripcion TEXT,
+            fecha TEXT,
+            enviada_correo INTEGER DEFAULT 0,
+            enviada_whatsapp INTEGER DEFAULT 0,
+            datos_autorizados INTEGER DEFAULT 0,
+            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS perfil_emocional (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            fecha TEXT,
+            estado_emocional_predominante TEXT,
+            patrones_expresion TEXT,
+            intencion_divulgacion TEXT,
+            rasgos_personalidad TEXT,
+            necesidades_esperadas TEXT,
+            recomendaciones TEXT,
+            FOREIGN KEY (user_id) REFERENCES usuarios (id)
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS psicologos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            usuario TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            activo INTEGER DEFAULT 1
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS psicologos_facultades (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            psicologo_id INTEGER NOT NULL,
+            facultad TEXT NOT NULL,
+            FOREIGN KEY (psicologo_id) REFERENCES psicologos(id)
+        )
+    """)
+
+
+def _m002_bandeja_alertas(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS alertas_envios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            alerta_id INTEGER,
+            canal TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            intentos INTEGER DEFAULT 0,
+            proximo_intento TEXT,
+            ultimo_error TEXT,
+            payload TEXT,
+            creado TEXT,
+            enviado TEXT,
+            FOREIGN KEY (alerta_id) REFERENCES alertas (id)
+        )
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_alertas_envios_pendientes ON alertas_envios (estado, proximo_intento)"
+    )
+
+
+def _m003_estadisticas_usuario(cursor):
+    """
+    Contadores por usuario mantenidos por triggers, para que el bot y el panel
+    lean el total de mensajes y las últimas fechas en O(1) en lugar de COUNT/MAX.
+    """
+    existia = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='estadisticas_usuario'"
+    ).fetchone()
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS estadisticas_usuario (
+            user_id INTEGER PRIMARY KEY,
+            total_mensajes INTEGER NOT NULL DEFAULT 0,
+            ultimo_mensaje TEXT,
+            ultima_alerta TEXT,
+            ultimo_perfil TEXT
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_estadisticas_mensaje AFTER INSERT ON conversaciones
+        BEGIN
+            INSERT INTO estadisticas_usuario (user_id, total_mensajes, ultimo_mensaje)
+            VALUES (NEW.user_id, 1, NEW.timestamp)
+            ON CONFLICT(user_id) DO UPDATE SET
+                total_mensajes=total_mensajes + 1,
+                ultimo_mensaje=NEW.timestamp;
+        END
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_estadisticas_alerta AFTER INSERT ON alertas
+        BEGIN
+            INSERT INTO estadisticas_usuario (user_id, ultima_alerta)
+            VALUES (NEW.usuario_id, NEW.fecha)
+            ON CONFLICT(user_id) DO UPDATE SET ultima_alerta=NEW.fecha;
+        END
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_estadisticas_perfil AFTER INSERT ON perfil_emocional
+        BEGIN
+            INSERT INTO estadisticas_usuario (user_id, ultimo_perfil)
+            VALUES (NEW.user_id, NEW.fecha)
+            ON CONFLICT(user_id) DO UPDATE SET ultimo_perfil=NEW.fecha;
+        END
+    """)
+
+    if existia:
+        return
+
+    cursor.execute("""
+        INSERT INTO estadisticas_usuario (user_id, total_mensajes, ultimo_mensaje)
+        SELECT user_id, COUNT(*), MAX(timestamp) FROM conversaciones GROUP BY user_id
+    """)
+    cursor.execute("""
+        INSERT INTO estadisticas_usuario (user_id, ultima_alerta)
+        SELECT usuario_id, fecha FROM alertas a
+        WHERE a.id = (SELECT MAX(id) FROM alertas WHERE usuario_id=a.usuario_id)
+        ON CONFLICT(user_id) DO UPDATE SET ultima_alerta=excluded.ultima_alerta
+    """)
+    cursor.execute("""
+        INSERT INTO estadisticas_usuario (user_id, ultimo_perfil)
+        SELECT user_id, MAX(fecha) FROM perfil_emocional WHERE true GROUP BY user_id
+        ON CONFLICT(user_id) DO UPDATE SET ultimo_perfil=excluded.ultimo_perfil
+    """)
+
+
+def _m004_indices(cursor):
+    """Índices para cada consulta caliente de serenity.py y panel_web/app.py."""
+    for sql in INDICES:
+        cursor.execute(sql)
+
+
+INDICES = [
+    "CREATE INDEX IF NOT EXISTS idx_conversaciones_usuario ON conversaciones (user_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_alertas_usuario ON alertas (usuario_id, datos_autorizados)",
+    "CREATE INDEX IF NOT EXISTS idx_alertas_fecha ON alertas (fecha)",
+    "CREATE INDEX IF NOT EXISTS idx_datos_usuario ON datos (user_id, facultad)",
+    "CREATE INDEX IF NOT EXISTS idx_datos_facultad ON datos (facultad, user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_perfil_usuario ON perfil_emocional (user_id, fecha)",
+    "CREATE INDEX IF NOT EXISTS idx_historial_dependencias_usuario ON historial_dependencias (user_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_psicologos_facultades ON psicologos_facultades (psicologo_id)",
+]
+
+def _m005_resumenes(cursor):
+    """Resumen acumulado por usuario de los turnos anteriores a la ventana reciente."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS resumenes (
+            user_id INTEGER PRIMARY KEY,
+            resumen TEXT NOT NULL,
+            hasta_id INTEGER NOT NULL,
+            hasta_fecha TEXT,
+            turnos INTEGER DEFAULT 0,
+            actualizado TEXT,
+            FOREIGN KEY (user_id) REFERENCES usuarios (id)
+        )
+    """)
+
+
+def _m006_dependencia_incremental(cursor):
+    """Puntajes por ítem, tendencia y último turno evaluado para la evaluación incremental."""
+    for tabla in ("dependencias", "historial_dependencias"):
+        for columna, tipo in (("items", "TEXT"), ("delta", "INTEGER"), ("tendencia", "TEXT"), ("hasta_id", "INTEGER")):
+            if not _tiene_columna(cursor, tabla, columna):
+                cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}")
+
+
+def _m007_trabajos_perfil(cursor):
+    """Cola de perfiles emocionales en segundo plano, única por (usuario, marca de mensajes)."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS trabajos_perfil (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            marca INTEGER NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            intentos INTEGER DEFAULT 0,
+            error TEXT,
+            creado TEXT,
+            iniciado TEXT,
+            terminado TEXT,
+            UNIQUE (user_id, marca),
+            FOREIGN KEY (user_id) REFERENCES usuarios (id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trabajos_perfil_estado ON trabajos_perfil (estado, id)")
+
+
+def _m008_archivo_conversaciones(cursor):
+    """Catálogo de meses archivados por usuario (ver archivo.py)."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS archivo_conversaciones (
+            user_id INTEGER NOT NULL,
+            mes TEXT NOT NULL,
+            filas INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, mes)
+        ) WITHOUT ROWID
+    """)
+
+
+# unicode61 con remove_diacritics 2 pliega acentos y mayúsculas: "depresion"
+# encuentra "Depresión". Las tablas son de contenido externo (no duplican el
+# texto) y los triggers las mantienen al día con cada INSERT/UPDATE/DELETE.
+TOKENIZADOR_FTS = "unicode61 remove_diacritics 2"
+
+TABLAS_FTS = [
+    # (tabla fts, tabla origen, columnas indexadas)
+    ("alertas_fts", "alertas", ("descripcion", "tipo_alerta")),
+    ("conversaciones_fts", "conversaciones", ("user_message", "bot_message")),
+]
+
+
+def _m009_busqueda_texto(cursor):
+    """Índices FTS5 sobre alertas y conversaciones para la búsqueda del panel."""
+    for fts, origen, columnas in TABLAS_FTS:
+        lista = ", ".join(columnas)
+        nuevos = ", ".join(f"new.{c}" for c in columnas)
+        viejos = ", ".join(f"old.{c}" for c in columnas)
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                {lista}, content='{origen}', content_rowid='id', tokenize='{TOKENIZADOR_FTS}'
+            )
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_ai AFTER INSERT ON {origen} BEGIN
+                INSERT INTO {fts} (rowid, {lista}) VALUES (new.id, {nuevos});
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_ad AFTER DELETE ON {origen} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {lista}) VALUES ('delete', old.id, {viejos});
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_au AFTER UPDATE OF {lista} ON {origen} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {lista}) VALUES ('delete', old.id, {viejos});
+                INSERT INTO {fts} (rowid, {lista}) VALUES (new.id, {nuevos});
+            END
+        """)
+        cursor.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+
+def _m010_estado_conversacion(cursor):
+    """Estado del flujo de consentimiento por usuario (ver estado_conversacion.py)."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS estado_conversacion (
+            user_id INTEGER PRIMARY KEY,
+            datos TEXT NOT NULL,
+            actualizado TEXT
+        )
+    """)
+
+
+def _m011_payload_envios_terminados(cursor):
+    """Los envíos ya terminados no necesitan el payload (datos de contacto e historial)."""
+    cursor.execute("UPDATE alertas_envios SET payload=NULL WHERE estado!='pendiente'")
+
+
+def _m012_marca_inicial_perfiles(cursor):
+    """
+    Los usuarios que ya tenían mensajes parten de su total actual (una fila
+    'omitido' con marca = total_mensajes): la primera recolección después del
+    despliegue no regenera con el LLM el perfil de todos, solo la actividad
+    nueva que cruce el siguiente múltiplo crea trabajos.
+    """
+    cursor.execute("""
+        INSERT OR IGNORE INTO trabajos_perfil (user_id, marca, estado, intentos, creado)
+        SELECT e.user_id, e.total_mensajes, 'omitido', 0, datetime('now', 'localtime')
+        FROM estadisticas_usuario e
+        WHERE e.total_mensajes > 0
+          AND NOT EXISTS (SELECT 1 FROM trabajos_perfil t WHERE t.user_id = e.user_id)
+    """)
+
+
+# Lista ordenada: (versión, descripción, función). Nunca reordenar ni editar una
+# migración ya publicada; los cambios nuevos se agregan al final.
+MIGRACIONES = [
+    (1, "esquema inicial", _m001_esquema_inicial),
+    (2, "bandeja de salida de alertas", _m002_bandeja_alertas),
+    (3, "estadísticas por usuario", _m003_estadisticas_usuario),
+    (4, "índices de consultas calientes", _m004_indices),
+    (5, "resúmenes de conversación", _m005_resumenes),
+    (6, "evaluación incremental de dependencia", _m006_dependencia_incremental),
+    (7, "trabajos de perfil emocional", _m007_trabajos_perfil),
+    (8, "catálogo de conversaciones archivadas", _m008_archivo_conversaciones),
+    (9, "búsqueda de texto completo", _m009_busqueda_texto),
+    (10, "estado de conversación compartido", _m010_estado_conversacion),
+    (11, "payload borrado en envíos terminados", _m011_payload_envios_terminados),
+    (12, "marca inicial de perfiles por usuario", _m012_marca_inicial_perfiles),
+]
+
+
+def version_actual(db):
+    return db.uno("PRAGMA user_version")[0]
+
+
+def aplicar_migraciones(db):
+    """
+    Aplica en orden las migraciones pendientes según PRAGMA user_version.
+    Cada migración corre en su propia transacción junto con el cambio de
+    versión, así que una falla deja la base en la última versión completa.
+    """
+    version = version_actual(db)
+    aplicadas = 0
+    for numero, descripcion, funcion in MIGRACIONES:
+        if numero <= version:
+            continue
+        with db.transaccion() as cursor:
+            # Con varios procesos otro pudo aplicarla mientras se esperaba el bloqueo.
+            if cursor.execute("PRAGMA user_version").fetchone()[0] >= numero:
+                continue
+            funcion(cursor)
+            cursor.execute(f"PRAGMA user_version={numero}")
+        logger.info(f"[Migraciones] v{numero}: {descripcion}")
+        aplicadas += 1
+    return aplicadas
+
+
+# (descripción, sql, parámetros, índice que el plan debe usar; basta un prefijo)
+CONSULTAS_CALIENTES = [
+    ("historial reciente",
+     "SELECT user_message, bot_message, timestamp FROM conversaciones WHERE user_id=? ORDER BY id DESC LIMIT ?",
+     (1, 7), "idx_conversaciones_usuario"),
+    ("exportación incremental",
+     "SELECT id, user_id, user_message, bot_message, timestamp FROM conversaciones WHERE user_id=? AND id>? ORDER BY id ASC",
+     (1, 0), "idx_conversaciones_usuario"),
+    ("estadísticas del usuario",
+     "SELECT total_mensajes FROM estadisticas_usuario WHERE user_id=?",
+     (1,), "INTEGER PRIMARY KEY"),
+    ("estado de conversación",
+     "SELECT datos FROM estado_conversacion WHERE user_id=?",
+     (1,), "INTEGER PRIMARY KEY"),
+    ("datos del usuario",
+     "SELECT nombre, numero, correo_institucional, facultad FROM datos WHERE user_id=? ORDER BY id DESC LIMIT 1",
+     (1,), "idx_datos_usuario"),
+    ("última alerta con datos",
+     "SELECT fecha FROM alertas WHERE usuario_id=? AND datos_autorizados=1 ORDER BY datetime(fecha) DESC LIMIT 1",
+     (1,), "idx_alertas_usuario"),
+    ("contador de dependencia",
+     "SELECT nivel_dependencia, contador_mensajes FROM dependencias WHERE user_id=?",
+     (1,), "sqlite_autoindex_dependencias_1"),
+    ("última evaluación de dependencia",
+     "SELECT items, puntaje_total, nivel_dependencia, hasta_id FROM historial_dependencias "
+     "WHERE user_id=? ORDER BY id DESC LIMIT 1",
+     (1,), "idx_historial_dependencias_usuario"),
+    ("turnos desde la última evaluación",
+     "SELECT user_message, bot_message, timestamp FROM conversaciones WHERE user_id=? AND id>? "
+     "ORDER BY id DESC LIMIT ?",
+     (1, 0, 45), "idx_conversaciones_usuario"),
+    ("trabajos de perfil pendientes",
+     "SELECT id, user_id, marca, intentos FROM trabajos_perfil WHERE estado='pendiente' ORDER BY id LIMIT ?",
+     (50,), "idx_trabajos_perfil_estado"),
+    ("panel: último trabajo de perfil",
+     "SELECT estado, marca, creado, terminado, error FROM trabajos_perfil WHERE user_id=? ORDER BY marca DESC LIMIT 1",
+     (1,), "sqlite_autoindex_trabajos_perfil_1"),
+    ("meses archivados del usuario",
+     "SELECT mes FROM archivo_conversaciones WHERE user_id=? ORDER BY mes",
+     (1,), "PRIMARY KEY"),
+    ("primer turno activo del usuario",
+     "SELECT MIN(id) FROM conversaciones WHERE user_id=?",
+     (1,), "idx_conversaciones_usuario"),
+    ("envíos pendientes",
+     "SELECT id, alerta_id, canal, intentos, payload FROM alertas_envios "
+     "WHERE estado='pendiente' AND proximo_intento<=? ORDER BY id LIMIT ?",
+     ("", 20), "idx_alertas_envios_pendientes"),
+    ("turnos sin resumir",
+     "SELECT COUNT(*) FROM conversaciones WHERE user_id=? AND id>?",
+     (1, 0), "idx_conversaciones_usuario"),
+    ("panel: login",
+     "SELECT id, nombre, password_hash FROM psicologos WHERE usuario=? AND activo=1",
+     ("x",), "sqlite_autoindex_psicologos_1"),
+    ("panel: facultades del psicólogo",
+     "SELECT facultad FROM psicologos_facultades WHERE psicologo_id=?",
+     (1,), "idx_psicologos_facultades"),
+    ("panel: permiso por facultad",
+     "SELECT 1 FROM datos WHERE user_id=? AND facultad IN (?, ?) LIMIT 1",
+     (1, "a", "b"), "idx_datos_"),
+    ("panel: usuarios por facultad",
+     "SELECT COUNT(*) FROM usuarios u JOIN datos d ON d.user_id=u.id WHERE d.facultad IN (?, ?)",
+     ("a", "b"), "idx_datos_facultad"),
+    ("panel: transcripción",
+     "SELECT user_message, bot_message, timestamp FROM conversaciones WHERE user_id=? ORDER BY id",
+     (1,), "idx_conversaciones_usuario"),
+    ("panel: alertas del usuario",
+     "SELECT tipo_alerta, nivel, fecha, descripcion FROM alertas WHERE usuario_id=? ORDER BY fecha DESC",
+     (1,), "idx_alertas_usuario"),
+    ("panel: último perfil",
+     "SELECT estado_emocional_predominante FROM perfil_emocional WHERE user_id=? ORDER BY fecha DESC LIMIT 1",
+     (1,), "idx_perfil_usuario"),
+]
+
+
+def verificar_planes(db):
+    """
+    Ejecuta EXPLAIN QUERY PLAN sobre cada consulta caliente y devuelve la lista
+    de (descripción, plan) cuyo plan no usa el índice esperado.
+    """
+    fallas = []
+    for descripcion, sql, params, indice in CONSULTAS_CALIENTES:
+        plan = " | ".join(fila[3] for fila in db.todos(f"EXPLAIN QUERY PLAN {sql}", params))
+        if indice not in plan:
+            fallas.append((descripcion, plan))
+    return fallas
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import tempfile
+    from basedatos import ConexionSQLite
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    ruta = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tempfile.mkdtemp(), "planes.db")
+    conexion = ConexionSQLite(ruta)
+    aplicar_migraciones(conexion)
+    fallas = verificar_planes(conexion)
+    for descripcion, plan in fallas:
+        print(f"✗ {descripcion}: {plan}")
+    print(f"{len(CONSULTAS_CALIENTES) - len(fallas)}/{len(CONSULTAS_CALIENTES)} consultas usan su índice")
+    sys.exit(1 if fallas else 0)
@@ -0,0 +1,152 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+from telegram.ext import BaseUpdateProcessor
+
+import metricas
+import trazas
+
+logger = logging.getLogger("serenity.planificador")
+
+UPDATES = metricas.histograma(
+    "serenity_update_segundos", "Duración del procesamiento de cada update de Telegram.", ("tipo", "resultado")
+)
+
+
+def tipo_update(update):
+    if getattr(update, "message", None) is not None:
+        return "mensaje"
+    if getattr(update, "callback_query", None) is not None:
+        return "callback"
+    return "otro"
+
+
+def clave_usuario(update):
+    """Clave de orden: el usuario (o el chat) del update; None si no tiene."""
+    usuario = getattr(update, "effective_user", None)
+    if usuario is not None:
+        return usuario.id
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return chat.id
+    return None
+
+
+class PlanificadorPorUsuario(BaseUpdateProcessor):
+    """
+    Procesa en paralelo los updates de usuarios distintos (hasta
+    `max_concurrentes` a la vez) y en estricto orden de llegada los de un
+    mismo usuario, de modo que la máquina de estados de context.user_data
+    (consentimiento, esperando_nombre → esperando_numero → ...) nunca ve dos
+    mensajes del mismo usuario a la vez.
+
+    Cada usuario con trabajo pendiente tiene un deque y una tarea que lo
+    drena de uno en uno; el límite global lo pone el semáforo de
+    BaseUpdateProcessor, que solo se toma cuando le toca al update, así que un
+    usuario con muchos mensajes en cola no bloquea a los demás. `capacidad`
+    acota el total de updates en espera: encolar() devuelve False si se llena.
+    """
+
+    def __init__(self, max_concurrentes=16, capacidad=1000):
+        super().__init__(max_concurrentes)
+        self.capacidad = capacidad
+        self.procesar = None
+        self.pendientes = 0
+        self.en_proceso = 0
+        self.procesados = 0
+        self._colas = {}
+        self._tareas = set()
+        self._vacio = asyncio.Event()
+        self._vacio.set()
+
+    def conectar(self, application):
+        self.procesar = application.process_update
+
+    def encolar(self, update):
+        """Agrega el update a la cola de su usuario. No bloquea."""
+        if self.pendientes >= self.capacidad:
+            return False
+        clave = clave_usuario(update)
+        if clave is None:
+            clave = ("update", id(update))
+        self.pendientes += 1
+        self._vacio.clear()
+        cola = self._colas.get(clave)
+        if cola is not None:
+            cola.append(update)
+            return True
+        self._colas[clave] = deque([update])
+        tarea = asyncio.create_task(self._drenar(clave))
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+        return True
+
+    async def _drenar(self, clave):
+        cola = self._colas[clave]
+        try:
+            while cola:
+                update = cola[0]
+                try:
+                    await self.process_update(update, self.procesar(update))
+                except Exception as e:
+                    logger.error(f"[Planificador] Error procesando update de {clave}: {e}")
+                finally:
+                    cola.popleft()
+                    self.pendientes -= 1
+                    self.procesados += 1
+        finally:
+            self.pendientes -= len(cola)
+            del self._colas[clave]
+            if not self._colas:
+                self._vacio.set()
+
+    async def do_process_update(self, update, coroutine):
+        self.en_proceso += 1
+        inicio = time.perf_counter()
+        resultado = "error"
+        tipo = tipo_update(update)
+        consulta = getattr(update, "callback_query", None)
+        try:
+            with trazas.raiz(f"update.{tipo}", update_id=getattr(update, "update_id", None),
+                             user_id=clave_usuario(update), callback=consulta.data if consulta else None):
+                await coroutine
+            resultado = "ok"
+        finally:
+            self.en_proceso -= 1
+            UPDATES.observar(time.perf_counter() - inicio, tipo, resultado)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        for tarea in list(self._tareas):
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+
+    async def vaciar(self, espera=10):
+        """Espera a que se procesen los updates en cola (hasta `espera` segundos)."""
+        try:
+            await asyncio.wait_for(self._vacio.wait(), timeout=espera)
+        except asyncio.TimeoutError:
+            logger.warning(f"[Planificador] Quedan {self.pendientes} updates sin procesar al detener")
+
+    def profundidad(self, user_id):
+        cola = self._colas.get(user_id)
+        return len(cola) if cola else 0
+
+    def estadisticas(self, top=10):
+        profundidades = sorted(
+            ((clave, len(cola)) for clave, cola in self._colas.items() if not isinstance(clave, tuple)),
+            key=lambda x: -x[1],
+        )
+        return {
+            "en_proceso": self.en_proceso,
+            "max_concurrentes": self.max_concurrent_updates,
+            "pendientes": self.pendientes,
+            "capacidad": self.capacidad,
+            "usuarios_en_cola": len(self._colas),
+            "procesados": self.procesados,
+            "cola_por_usuario": {str(clave): n for clave, n in profundidades[:top]},
+        }
@@ -0,0 +1,210 @@
+import time
+import heapq
+import random
+import asyncio
+import logging
+from collections import Counter, defaultdict
+
+import metricas
+import trazas
+
+logger = logging.getLogger("serenity.planificador_llm")
+
+# Menor número = más prioridad. "combinado" incluye la evaluación de riesgo.
+PRIORIDADES = {
+    "riesgo": 0,
+    "combinado": 0,
+    "chat": 1,
+    "dependencia": 2,
+    "resumen": 2,
+    "otro": 2,
+    "perfil": 3,
+}
+PRIORIDAD_BAJA = 2
+
+LLAMADAS = metricas.histograma(
+    "serenity_openai_segundos", "Duración de cada intento de llamada al modelo.", ("tipo", "resultado")
+)
+ESPERAS = metricas.histograma(
+    "serenity_openai_espera_segundos", "Tiempo esperando turno en el planificador de OpenAI.", ("tipo",)
+)
+TOKENS = metricas.contador("serenity_openai_tokens_total", "Tokens consumidos por tipo de llamada.", ("tipo", "clase"))
+TOKENS_POR_LLAMADA = metricas.histograma(
+    "serenity_openai_tokens_por_llamada", "Tokens (prompt + respuesta) por llamada.", ("tipo",),
+    buckets=metricas.BUCKETS_TOKENS,
+)
+
+
+class CuboTokens:
+    """Token bucket: `capacidad` unidades que se recargan a `por_segundo`. capacidad=0 lo desactiva."""
+
+    def __init__(self, capacidad, por_segundo):
+        self.capacidad = capacidad
+        self.por_segundo = por_segundo
+        self.disponibles = float(capacidad)
+        self._ultimo = time.monotonic()
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        self.disponibles = min(self.capacidad, self.disponibles + (ahora - self._ultimo) * self.por_segundo)
+        self._ultimo = ahora
+
+    def espera(self, n, reserva=0.0):
+        """Segundos hasta poder tomar `n` dejando `reserva` (fracción de la capacidad) sin usar."""
+        if not self.capacidad:
+            return 0.0
+        self._recargar()
+        necesario = min(n + reserva * self.capacidad, self.capacidad)
+        if self.disponibles >= necesario:
+            return 0.0
+        return (necesario - self.disponibles) / self.por_segundo
+
+    def tomar(self, n):
+        if self.capacidad:
+            self._recargar()
+            self.disponibles -= n
+
+    def ajustar(self, diferencia):
+        """Corrige lo tomado con el consumo real (positivo = se gastó más de lo estimado)."""
+        if self.capacidad:
+            self.disponibles = min(self.capacidad, self.disponibles - diferencia)
+
+
+def _es_limite(error):
+    return getattr(error, "status_code", None) == 429
+
+
+def _retry_after(error):
+    respuesta = getattr(error, "response", None)
+    try:
+        return float(respuesta.headers.get("retry-after"))
+    except Exception:
+        return None
+
+
+class PlanificadorLLM:
+    """
+    Coordina todas las llamadas al modelo con dos token buckets (solicitudes
+    por minuto y tokens por minuto) y una cola por prioridad.
+
+    Las llamadas esperan turno en un heap: siempre sale primero la de mayor
+    prioridad (riesgo > respuesta de chat > dependencia > perfil). Las clases
+    de baja prioridad además deben dejar libre una fracción `reserva` de cada
+    bucket, así que se difieren (nunca se descartan) cuando hay poco margen y
+    el riesgo siempre tiene cupo. Un 429 pausa todas las salidas durante el
+    Retry-After (o un backoff exponencial con jitter) y se reintenta.
+
+    `consumo` acumula por clase: llamadas, segundos, segundos_espera, tokens,
+    reintentos y errores.
+    """
+
+    def __init__(self, rpm=0, tpm=0, reserva=0.2, max_reintentos=4, espera_base=1.0, consumo=None):
+        self.solicitudes = CuboTokens(rpm, rpm / 60)
+        self.tokens = CuboTokens(tpm, tpm / 60)
+        self.reserva = reserva
+        self.max_reintentos = max_reintentos
+        self.espera_base = espera_base
+        self.consumo = consumo if consumo is not None else defaultdict(Counter)
+        self._cola = []
+        self._secuencia = 0
+        self._pausa_hasta = 0.0
+        self._evento = None
+        self._tarea = None
+
+    async def ejecutar(self, tipo, llamada, tokens_estimados=0):
+        """Espera turno y ejecuta `llamada()` (una corrutina), reintentando los 429."""
+        with trazas.tramo(f"openai.{tipo}", tokens_estimados=tokens_estimados) as tramo:
+            return await self._ejecutar(tipo, llamada, tokens_estimados, tramo)
+
+    async def _ejecutar(self, tipo, llamada, tokens_estimados, tramo):
+        prioridad = PRIORIDADES.get(tipo, PRIORIDAD_BAJA)
+        consumo = self.consumo[tipo]
+        intento = 0
+        while True:
+            t0 = time.perf_counter()
+            await self._turno(prioridad, tokens_estimados)
+            inicio = time.perf_counter()
+            consumo["segundos_espera"] += inicio - t0
+            ESPERAS.observar(inicio - t0, tipo)
+            tramo.atributo("espera_ms", round((inicio - t0) * 1000, 1))
+            try:
+                resp = await llamada()
+            except Exception as e:
+                limite = _es_limite(e)
+                LLAMADAS.observar(time.perf_counter() - inicio, tipo, "limite" if limite else "error")
+                if not limite or intento >= self.max_reintentos:
+                    consumo["errores"] += 1
+                    raise
+                intento += 1
+                consumo["reintentos"] += 1
+                tramo.atributo("reintentos", intento)
+                espera = _retry_after(e) or self.espera_base * (2 ** (intento - 1))
+                espera *= random.uniform(1.0, 1.3)
+                self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + espera)
+                logger.warning(f"[LLM] 429 en {tipo}, reintento {intento} en {espera:.1f}s")
+                await asyncio.sleep(espera)
+                continue
+
+            segundos = time.perf_counter() - inicio
+            consumo["llamadas"] += 1
+            consumo["segundos"] += segundos
+            LLAMADAS.observar(segundos, tipo, "ok")
+            uso = getattr(resp, "usage", None)
+            if uso:
+                consumo["tokens_prompt"] += uso.prompt_tokens
+                consumo["tokens_respuesta"] += uso.completion_tokens
+                TOKENS.inc(uso.prompt_tokens, tipo, "prompt")
+                TOKENS.inc(uso.completion_tokens, tipo, "respuesta")
+                TOKENS_POR_LLAMADA.observar(uso.total_tokens, tipo)
+                tramo.atributo("tokens", uso.total_tokens)
+                self.tokens.ajustar(uso.total_tokens - tokens_estimados)
+            return resp
+
+    async def _turno(self, prioridad, tokens):
+        if not (self.solicitudes.capacidad or self.tokens.capacidad):
+            return
+        if self._tarea is None or self._tarea.done():
+            self._evento = asyncio.Event()
+            self._tarea = asyncio.create_task(self._bucle())
+        turno = asyncio.get_running_loop().create_future()
+        self._secuencia += 1
+        heapq.heappush(self._cola, (prioridad, self._secuencia, tokens, turno))
+        self._evento.set()
+        await turno
+
+    async def _bucle(self):
+        while True:
+            while self._cola and self._cola[0][3].done():
+                heapq.heappop(self._cola)
+            if not self._cola:
+                self._evento.clear()
+                await self._evento.wait()
+                continue
+            prioridad, _sec, tokens, turno = self._cola[0]
+            reserva = self.reserva if prioridad >= PRIORIDAD_BAJA else 0.0
+            espera = max(
+                self._pausa_hasta - time.monotonic(),
+                self.solicitudes.espera(1, reserva),
+                self.tokens.espera(tokens, reserva),
+            )
+            if espera > 0:
+                # Una llegada de mayor prioridad despierta el bucle antes de tiempo.
+                self._evento.clear()
+                try:
+                    await asyncio.wait_for(self._evento.wait(), timeout=espera)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._cola)
+            self.solicitudes.tomar(1)
+            self.tokens.tomar(tokens)
+            turno.set_result(None)
+
+    def estadisticas(self):
+        en_cola = Counter(p for p, _s, _t, f in self._cola if not f.done())
+        return {
+            "en_cola_por_prioridad": dict(en_cola),
+            "solicitudes_disponibles": round(self.solicitudes.disponibles, 1),
+            "tokens_disponibles": round(self.tokens.disponibles),
+            "consumo": {tipo: dict(c) for tipo, c in self.consumo.items()},
+        }
@@ -0,0 +1,316 @@
+import re
+import threading
+import unicodedata
+from collections import deque, Counter, namedtuple
+
+# Léxico curado por tema: (patrón, peso). Los patrones se escriben ya
+# normalizados (minúsculas, sin acentos). Un "*" final indica prefijo
+# (p. ej. "suicid*" cubre suicidio, suicidarme, suicida); si no, la
+# coincidencia debe terminar en límite de palabra.
+LEXICO = {
+    "suicidio": [
+        ("suicid*", 1.0), ("matarme", 1.0), ("quitarme la vida", 1.0), ("acabar con mi vida", 1.0),
+        ("no quiero vivir", 1.0), ("no quiero seguir viviendo", 1.0), ("quiero morir*", 1.0),
+        ("me quiero morir", 1.0), ("desaparecer*", 0.8), ("me rindo", 0.7), ("adios para siempre", 1.0), ("no vale la pena vivir", 1.0),
+        ("mejor muert*", 1.0), ("ya no quiero estar aqui", 1.0), ("despedirme de todos", 0.8),
+        ("cortarme", 1.0), ("me corto", 1.0), ("hacerme dano", 1.0), ("autolesion*", 1.0),
+        ("tomarme todas las pastillas", 1.0), ("aventarme", 0.8), ("colgarme", 1.0),
+        ("morir*", 0.6), ("muerte", 0.5), ("no aguanto mas", 0.7), ("ya no puedo mas", 0.7),
+    ],
+    "drogadiccion": [
+        ("droga*", 0.8), ("drogarme", 1.0), ("cocaina", 1.0), ("coca", 0.5), ("cristal", 0.6),
+        ("metanfetamina*", 1.0), ("mota", 0.6), ("marihuana", 0.7), ("porro*", 0.6), ("perico", 0.7),
+        ("piedra", 0.3), ("heroina", 1.0), ("fentanilo", 1.0), ("pastillas", 0.5), ("sobredosis", 1.0),
+        ("emborrach*", 0.6), ("alcohol*", 0.5), ("adicci*", 0.8), ("adict*", 0.8), ("no puedo dejar de tomar", 1.0),
+    ],
+    "violencia": [
+        ("me pega*", 1.0), ("me golpea*", 1.0), ("golpe*", 0.6), ("me maltrata*", 1.0), ("maltrato", 0.9),
+        ("violencia", 0.8), ("me amenaza*", 1.0), ("amenaz*", 0.6), ("me grita*", 0.5), ("me encierra*", 0.9),
+        ("tengo miedo de mi", 0.9), ("me quiere matar", 1.0), ("lo voy a matar", 1.0), ("la voy a matar", 1.0),
+        ("matar*", 0.7), ("arma", 0.6), ("cuchillo", 0.7), ("pistola", 0.8),
+    ],
+    "abuso": [
+        ("abuso*", 1.0), ("abusaron", 1.0), ("abusa de mi", 1.0), ("viola*", 0.9), ("me toco", 0.8),
+        ("me toca*", 0.6), ("tocamientos", 1.0), ("acoso*", 0.9), ("me acosa*", 1.0), ("me obligo", 0.8),
+        ("me obliga*", 0.8), ("sin mi consentimiento", 1.0), ("fotos intimas", 0.9), ("me chantajea*", 0.9),
+    ],
+    "depresion": [
+        ("depresi*", 0.9), ("deprimid*", 0.9), ("sin esperanza", 0.9), ("no tiene sentido", 0.7),
+        ("nada tiene sentido", 0.9), ("vacio", 0.6), ("vacia", 0.6), ("triste*", 0.5), ("tristeza", 0.5),
+        ("llor*", 0.4), ("sol@", 0.3), ("nadie me quiere", 0.8), ("soy una carga", 1.0), ("no sirvo para nada", 0.9),
+        ("me odio", 0.9), ("ansiedad", 0.4), ("ansios*", 0.4), ("panico", 0.5), ("no puedo dormir", 0.4),
+        ("cansad@ de todo", 0.8), ("harto de todo", 0.8), ("harta de todo", 0.8), ("mal", 0.3),
+        ("no me quiero levantar", 0.7), ("desesperad*", 0.7),
+    ],
+}
+
+# Reemplazos de jerga / abreviaturas por palabra completa (ya normalizadas).
+JERGA = {
+    "q": "que", "k": "que", "ke": "que", "xq": "porque", "pq": "porque", "x": "por",
+    "toy": "estoy", "toi": "estoy", "stoy": "estoy", "nd": "nada", "nadien": "nadie",
+    "tmb": "tambien", "tb": "tambien", "d": "de", "m": "me", "vdd": "verdad",
+    "kiero": "quiero", "qiero": "quiero", "morirme": "morir", "matarm": "matarme",
+    "dep": "depresion", "suic": "suicidio", "autolesionarme": "autolesion",
+}
+
+# Saludos, despedidas y agradecimientos: lo único que por sí solo se omite.
+# No incluye acuses ("si", "ok", "bien") ni palabras de estado ("estoy",
+# "todo"), que pueden ser la respuesta a una pregunta sobre cómo se siente.
+BENIGNAS = {
+    "hola", "holi", "buenas", "buenos", "dias", "tardes", "noches", "buen", "dia", "hey", "que", "tal",
+    "gracias", "muchas", "mil", "igualmente", "saludos", "nos", "vemos", "hasta", "luego", "manana", "pronto",
+}
+
+# Cualquier negación vuelve ambiguo el mensaje ("no estoy bien", "ya no",
+# "nada bien"): se escala aunque el resto sea cortesía o sea muy corto.
+NEGACIONES = {"no", "nada", "nunca", "jamas", "ni", "tampoco", "nadie", "ningun", "ninguna", "ninguno"}
+
+_LEET = str.maketrans({"0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "@": "a"})
+_REPETIDAS = re.compile(r"(\w)\1{2,}")
+_NO_PALABRA = re.compile(r"[^\w\s]")
+_ESPACIOS = re.compile(r"\s+")
+
+Decision = namedtuple("Decision", "escalar puntaje tema coincidencias motivo")
+
+
+def normalizar(texto):
+    """
+    Minúsculas, sin acentos (ñ → n), sin signos, letras repetidas colapsadas
+    ("muyyyy" → "muy"), leetspeak en palabras con letras y jerga expandida.
+    """
+    texto = unicodedata.normalize("NFD", (texto or "").lower())
+    texto = "".join(c for c in texto if unicodedata.category(c) != "Mn")
+    palabras = []
+    for palabra in _NO_PALABRA.sub(" ", texto).split():
+        if any(c.isalpha() for c in palabra):
+            palabra = palabra.translate(_LEET)
+        palabra = _REPETIDAS.sub(r"\1", palabra)
+        palabras.append(JERGA.get(palabra, palabra))
+    return _ESPACIOS.sub(" ", " ".join(palabras)).strip()
+
+
+class AhoCorasick:
+    """
+    Autómata de Aho-Corasick: encuentra todos los patrones en una sola pasada
+    sobre el texto, independientemente de cuántos patrones haya.
+    `patrones` es una lista de (texto, dato); el dato se devuelve en cada match.
+    """
+
+    def __init__(self, patrones):
+        self._goto = [{}]
+        self._falla = [0]
+        self._salida = [[]]
+        for texto, dato in patrones:
+            estado = 0
+            for c in texto:
+                siguiente = self._goto[estado].get(c)
+                if siguiente is None:
+                    siguiente = len(self._goto)
+                    self._goto[estado][c] = siguiente
+                    self._goto.append({})
+                    self._falla.append(0)
+                    self._salida.append([])
+                estado = siguiente
+            self._salida[estado].append((len(texto), dato))
+
+        cola = deque(self._goto[0].values())
+        while cola:
+            estado = cola.popleft()
+            for c, siguiente in self._goto[estado].items():
+                cola.append(siguiente)
+                f = self._falla[estado]
+                while f and c not in self._goto[f]:
+                    f = self._falla[f]
+                destino = self._goto[f].get(c, 0)
+                self._falla[siguiente] = destino if destino != siguiente else 0
+                self._salida[siguiente] = self._salida[siguiente] + self._salida[self._falla[siguiente]]
+
+    def buscar(self, texto):
+        """Genera (inicio, fin, dato) por cada coincidencia."""
+        estado = 0
+        for i, c in enumerate(texto):
+            while estado and c not in self._goto[estado]:
+                estado = self._falla[estado]
+            estado = self._goto[estado].get(c, 0)
+            for largo, dato in self._salida[estado]:
+                yield i - largo + 1, i + 1, dato
+
+
+def _expandir(patron):
+    """'sol@' → ['solo', 'sola']; el resto se devuelve tal cual."""
+    if patron.endswith("@"):
+        return [patron[:-1] + "o", patron[:-1] + "a"]
+    if "@ " in patron:
+        return [patron.replace("@ ", "o "), patron.replace("@ ", "a ")]
+    return [patron]
+
+
+class PrefiltroRiesgo:
+    """
+    Pre-filtro léxico local delante de detectar_riesgo.
+
+    Prioriza la sensibilidad (recall): solo se omite la llamada al LLM cuando
+    el mensaje no coincide con ningún patrón del léxico, los mensajes recientes
+    del usuario tampoco, y el mensaje es claramente benigno: solo saludos o
+    agradecimientos (o, si se configura, como mucho `max_tokens_benigno`
+    palabras) y ninguna negación. Cualquier coincidencia con puntaje >=
+    `umbral` escala al LLM.
+
+    En modo sombra (`sombra=True`) siempre escala pero sigue contando lo que
+    habría omitido, para medir el ahorro antes de activarlo.
+    """
+
+    def __init__(self, lexico=LEXICO, umbral=0.0, max_tokens_benigno=0, sombra=False):
+        patrones = []
+        for tema, entradas in lexico.items():
+            for patron, peso in entradas:
+                prefijo = patron.endswith("*")
+                base = patron.rstrip("*")
+                for variante in _expandir(base):
+                    patrones.append((variante, (tema, peso, prefijo, variante)))
+        self._automata = AhoCorasick(patrones)
+        self.umbral = umbral
+        self.max_tokens_benigno = max_tokens_benigno
+        self.sombra = sombra
+        self._lock = threading.Lock()
+        self.contadores = Counter()
+
+    def coincidencias(self, texto_normalizado):
+        encontrados = []
+        n = len(texto_normalizado)
+        for inicio, fin, (tema, peso, prefijo, patron) in self._automata.buscar(texto_normalizado):
+            if inicio > 0 and texto_normalizado[inicio - 1] != " ":
+                continue
+            if not prefijo and fin < n and texto_normalizado[fin] != " ":
+                continue
+            encontrados.append((tema, patron, peso))
+        return encontrados
+
+    def evaluar(self, mensaje, historial_usuario=()):
+        """
+        Devuelve una Decision. `historial_usuario` son los mensajes previos del
+        usuario (texto), usados para no omitir respuestas cortas a un tema de riesgo.
+        """
+        texto = normalizar(mensaje)
+        encontrados = self.coincidencias(texto)
+        puntajes = Counter()
+        for tema, _patron, peso in encontrados:
+            puntajes[tema] += peso
+        puntaje = sum(puntajes.values())
+        tema = puntajes.most_common(1)[0][0] if puntajes else "ninguno"
+
+        if encontrados and puntaje >= self.umbral:
+            decision = Decision(True, puntaje, tema, encontrados, "coincidencia en el léxico")
+        elif any(self.coincidencias(normalizar(previo)) for previo in historial_usuario):
+            decision = Decision(True, puntaje, tema, encontrados, "contexto reciente con señales")
+        else:
+            palabras = texto.split()
+            negacion = any(p in NEGACIONES for p in palabras)
+            benigno = bool(palabras) and not negacion and (
+                all(p in BENIGNAS for p in palabras) or len(palabras) <= self.max_tokens_benigno
+            )
+            motivo = "mensaje benigno" if benigno else ("negación" if negacion else "ambiguo")
+            decision = Decision(not benigno, puntaje, tema, encontrados, motivo)
+
+        with self._lock:
+            self.contadores["evaluados"] += 1
+            if decision.escalar:
+                self.contadores["escalados"] += 1
+                for t in puntajes:
+                    self.contadores[f"tema_{t}"] += 1
+            else:
+                self.contadores["omitidos"] += 1
+
+        if self.sombra and not decision.escalar:
+            return decision._replace(escalar=True, motivo="sombra: " + decision.motivo)
+        return decision
+
+    def estadisticas(self):
+        with self._lock:
+            datos = dict(self.contadores)
+        evaluados = datos.get("evaluados", 0)
+        datos["tasa_omision"] = datos.get("omitidos", 0) / evaluados if evaluados else 0.0
+        return datos
+
+
+def evaluar_historico(db, prefiltro, ventana_segundos=180, tolerancia_segundos=30, contexto=7):
+    """
+    Evaluación offline sobre conversaciones/alertas almacenadas.
+
+    Cada alerta se asocia al último mensaje del mismo usuario guardado entre
+    `ventana_segundos` antes y `tolerancia_segundos` después de la alerta;
+    esos mensajes son los positivos.
+    Devuelve cuántas llamadas se habrían omitido y cuántos positivos se
+    habrían perdido (lo que debe ser 0 para un umbral aceptable).
+    """
+    from datetime import datetime
+
+    alertas = {}
+    for usuario_id, fecha in db.todos("SELECT usuario_id, fecha FROM alertas"):
+        try:
+            alertas.setdefault(usuario_id, []).append(datetime.fromisoformat(fecha))
+        except (TypeError, ValueError):
+            pass
+
+    positivos = set()
+    for usuario_id, fechas in alertas.items():
+        filas = db.todos("SELECT id, timestamp FROM conversaciones WHERE user_id=?", (usuario_id,))
+        tiempos = []
+        for id_, ts in filas:
+            try:
+                tiempos.append((datetime.fromisoformat(ts), id_))
+            except (TypeError, ValueError):
+                pass
+        for fecha in fechas:
+            # El mensaje activador es el último guardado hasta unos segundos después
+            # de la alerta (en modo paralelo la alerta se registra antes que el mensaje).
+            candidatos = [
+                t for t in tiempos
+                if -ventana_segundos <= (t[0] - fecha).total_seconds() <= tolerancia_segundos
+            ]
+            if candidatos:
+                positivos.add(max(candidatos)[1])
+
+    resultado = Counter()
+    perdidos = []
+    previos = {}
+    with db.lector() as conn:
+        cur = conn.execute("SELECT id, user_id, user_message FROM conversaciones ORDER BY user_id, id")
+        for id_, user_id, mensaje in cur:
+            historial = previos.setdefault(user_id, deque(maxlen=contexto))
+            decision = prefiltro.evaluar(mensaje, list(historial))
+            historial.append(mensaje)
+            resultado["mensajes"] += 1
+            es_positivo = id_ in positivos
+            resultado["positivos"] += es_positivo
+            if decision.escalar:
+                resultado["escalados"] += 1
+            else:
+                resultado["omitidos"] += 1
+                if es_positivo:
+                    resultado["positivos_omitidos"] += 1
+                    perdidos.append((id_, mensaje))
+
+    resultado = dict(resultado)
+    mensajes = resultado.get("mensajes", 0)
+    positivos_total = resultado.get("positivos", 0)
+    resultado["tasa_omision"] = resultado.get("omitidos", 0) / mensajes if mensajes else 0.0
+    resultado["recall"] = (
+        1 - resultado.get("positivos_omitidos", 0) / positivos_total if positivos_total else 1.0
+    )
+    return resultado, perdidos
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    from basedatos import ConexionSQLite
+
+    ruta = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "serenity.db")
+    umbral = float(os.getenv("PREFILTRO_UMBRAL", "0"))
+    max_tokens = int(os.getenv("PREFILTRO_MAX_TOKENS_BENIGNO", "0"))
+    resultado, perdidos = evaluar_historico(ConexionSQLite(ruta), PrefiltroRiesgo(umbral=umbral, max_tokens_benigno=max_tokens))
+    for clave, valor in resultado.items():
+        print(f"{clave:>20}: {valor:.3f}" if isinstance(valor, float) else f"{clave:>20}: {valor}")
+    for id_, mensaje in perdidos[:20]:
+        print(f"  ✗ [{id_}] {mensaje}")
@@ -1,37 +1,53 @@
+import arranque
+
 import os
 import sys
+import asyncio
 import json
 import re
-import sqlite3
-import tempfile
 import logging
+import threading
+import time
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
 
 from dotenv import load_dotenv
 from html import escape
-from openai import OpenAI
-from twilio.rest import Client as TwilioClient
-
-import pandas as pd
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
-
-from telegram import (
-    Update,
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-)
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    ContextTypes,
-    filters,
-)
+
+import metricas
+import trazas
+from basedatos import ConexionSQLite, registrar_sentencia
+from cache_conversaciones import CacheVentanas
+from despachador import DespachadorAlertas
+from migraciones import aplicar_migraciones, version_actual
+from prefiltro_riesgo import PrefiltroRiesgo
+from exportacion import CacheExportacion, exportar_conversaciones
+from planificador_llm import PlanificadorLLM
+from contadores import ContadoresEnLote
+from escritor import EscritorDiferido
+from estado_conversacion import EstadoConversacion
+from archivo import Archivador, directorio_archivo
+from trabajos_perfil import PlanificadorPerfiles, horas_tranquilas
+from contexto import ResumenesConversacion, ajustar_turnos, construir_mensajes, contar_tokens, recortar, sin_resumir
+
+# python-telegram-bot se necesita antes de atender cualquier update, así que se
+# carga al inicio (medido). openai, twilio, smtplib/email y el servidor web se
+# cargan en su primer uso con arranque.importar().
+with arranque.medir("telegram"):
+    from telegram import (
+        Update,
+        InlineKeyboardButton,
+        InlineKeyboardMarkup,
+    )
+    from telegram.ext import (
+        Application,
+        CommandHandler,
+        MessageHandler,
+        CallbackQueryHandler,
+        ContextTypes,
+        filters,
+    )
+    from planificador import PlanificadorPorUsuario, clave_usuario
 
 load_dotenv()
 
@@ -40,7 +56,8 @@ if getattr(sys, "frozen", False):
 else:
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-db_file = os.path.join(BASE_DIR, "serenity.db")
+db_file = os.getenv("SERENITY_DB") or os.path.join(BASE_DIR, "serenity.db")
+db = ConexionSQLite(db_file)
 JSON_PATH = os.path.join(BASE_DIR, "info.json")
 
 TOKEN_TELEGRAM = os.getenv("TELEGRAM_TOKEN", "")
@@ -51,6 +68,12 @@ TWILIO_SID = os.getenv("TWILIO_SID", "")
 TWILIO_TOKEN = os.getenv("TWILIO_TOKEN", "")
 TWILIO_WHATSAPP_FROM = os.getenv("TWILIO_WHATSAPP_FROM", "")
 TWILIO_WHATSAPP_TO = os.getenv("TWILIO_WHATSAPP_TO", "")
+# URLs alternativas para apuntar a servidores de prueba (ver carga.py).
+TWILIO_API_URL = os.getenv("TWILIO_API_URL", "")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PUERTO = int(os.getenv("SMTP_PUERTO", "465"))
+SMTP_SSL = os.getenv("SMTP_SSL", "1") == "1"
 
 COOLDOWN_DIAS = int(os.getenv("COOLDOWN_DIAS_INFO", "3"))
 LINK_UNACAR = os.getenv(
@@ -60,208 +83,245 @@ LINK_UNACAR = os.getenv(
 
 RISK_COOLDOWN_MINUTES = 0
 
-client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
-twilio_client = TwilioClient(TWILIO_SID, TWILIO_TOKEN) if TWILIO_SID and TWILIO_TOKEN else None
+ALERTAS_MAX_INTENTOS = int(os.getenv("ALERTAS_MAX_INTENTOS", "6"))
+ALERTAS_ESPERA_BASE = float(os.getenv("ALERTAS_ESPERA_BASE", "30"))
+SMTP_INACTIVIDAD = float(os.getenv("SMTP_INACTIVIDAD", "240"))
+EXPORTACION_FORMATO = os.getenv("EXPORTACION_FORMATO", "xlsx")
+# Caché incremental de exportaciones (un CSV por usuario con su conversación):
+# desactivada salvo EXPORTACION_CACHE=1. Por defecto en "exportaciones" junto a
+# la base; se poda por antigüedad y tamaño y se borra cuando el usuario elimina sus datos.
+EXPORTACION_CACHE = os.getenv("EXPORTACION_CACHE", "0") == "1"
+EXPORTACION_CACHE_DIR = os.getenv("EXPORTACION_CACHE_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(db_file)), "exportaciones"
+)
+EXPORTACION_CACHE_MAX_MB = float(os.getenv("EXPORTACION_CACHE_MAX_MB", "200"))
+EXPORTACION_CACHE_DIAS = float(os.getenv("EXPORTACION_CACHE_DIAS", "7"))
+
+# Escritura de conversaciones con group commit: "grupo" (espera su commit),
+# "diferido" (no espera) o "inmediato" (una transacción por mensaje).
+ESCRITURA_MODO = os.getenv("ESCRITURA_MODO", "grupo")
+ESCRITURA_MAX_FILAS = int(os.getenv("ESCRITURA_MAX_FILAS", "200"))
+ESCRITURA_MAX_ESPERA_MS = float(os.getenv("ESCRITURA_MAX_ESPERA_MS", "0"))
+
+# Turnos con más de ARCHIVO_DIAS días pasan a archivos mensuales y se borran de
+# la base activa. Desactivado por defecto (0); activarlo es una decisión explícita.
+ARCHIVO_DIAS = int(os.getenv("ARCHIVO_DIAS", "0"))
+ARCHIVO_INTERVALO_HORAS = float(os.getenv("ARCHIVO_INTERVALO_HORAS", "24"))
+
+# Trazas por update en JSON lines (formato Zipkin v2); vacío = desactivadas.
+# Se conservan una fracción TRAZAS_MUESTREO, las lentas, las que fallan y las de alertas.
+TRAZAS_ARCHIVO = os.getenv("TRAZAS_ARCHIVO", "")
+TRAZAS_MUESTREO = float(os.getenv("TRAZAS_MUESTREO", "0.05"))
+TRAZAS_LENTO_MS = float(os.getenv("TRAZAS_LENTO_MS", "5000"))
+
+# Varios procesos: con SERENITY_WORKERS > 0 este proceso es el ingreso (recibe
+# el webhook y reparte por usuario con hash consistente) y lanza N workers en
+# 127.0.0.1:WORKERS_PUERTO_BASE+i. Con WORKERS_URLS (separadas por coma) reparte
+# a workers que se lanzan aparte con SERENITY_MODO=worker.
+SERENITY_WORKERS = int(os.getenv("SERENITY_WORKERS", "0"))
+WORKERS_URLS = [u.strip().rstrip("/") for u in os.getenv("WORKERS_URLS", "").split(",") if u.strip()]
+WORKERS_PUERTO_BASE = int(os.getenv("WORKERS_PUERTO_BASE", "10100"))
+SERENITY_MODO = os.getenv("SERENITY_MODO") or ("ingreso" if SERENITY_WORKERS or WORKERS_URLS else "unico")
+SERENITY_WORKER = os.getenv("SERENITY_WORKER", "0")
+WORKER_HOST = os.getenv("WORKER_HOST", "127.0.0.1")
+# La bandeja de alertas corre en el ingreso y los workers solo insertan filas,
+# así que en ese modo se revisa más seguido.
+ALERTAS_INTERVALO_INGRESO = float(os.getenv("ALERTAS_INTERVALO_INGRESO", "2"))
+
+CACHE_HISTORIAL_POR_USUARIO = int(os.getenv("CACHE_HISTORIAL_POR_USUARIO", "20"))
+CACHE_HISTORIAL_MAX_USUARIOS = int(os.getenv("CACHE_HISTORIAL_MAX_USUARIOS", "5000"))
+CACHE_HISTORIAL_MAX_MB = float(os.getenv("CACHE_HISTORIAL_MAX_MB", "32"))
+CACHE_HISTORIAL_TTL = float(os.getenv("CACHE_HISTORIAL_TTL", "1800"))
+
+# Presupuesto de contexto (tokens) por tipo de llamada y tope por mensaje individual.
+CONTEXTO_TOKENS_CHAT = int(os.getenv("CONTEXTO_TOKENS_CHAT", "1500"))
+CONTEXTO_TOKENS_DEPENDENCIA = int(os.getenv("CONTEXTO_TOKENS_DEPENDENCIA", "2000"))
+CONTEXTO_TOKENS_PERFIL = int(os.getenv("CONTEXTO_TOKENS_PERFIL", "1500"))
+CONTEXTO_TOKENS_MENSAJE = int(os.getenv("CONTEXTO_TOKENS_MENSAJE", "300"))
+# El resumen de turnos antiguos se regenera cada RESUMEN_CADA mensajes nuevos,
+# dejando fuera los últimos RESUMEN_MANTENER, que se envían completos.
+RESUMEN_CADA = int(os.getenv("RESUMEN_CADA", "10"))
+RESUMEN_MANTENER = int(os.getenv("RESUMEN_MANTENER", "6"))
+
+# Perfiles emocionales en segundo plano: cada PERFIL_CADA mensajes, en lotes,
+# solo dentro de PERFIL_HORAS_TRANQUILAS ("1-6"; vacío = a cualquier hora).
+PERFIL_CADA = int(os.getenv("PERFIL_CADA", "20"))
+PERFIL_LOTE = int(os.getenv("PERFIL_LOTE", "50"))
+PERFIL_CONCURRENCIA = int(os.getenv("PERFIL_CONCURRENCIA", "3"))
+PERFIL_HORAS_TRANQUILAS = os.getenv("PERFIL_HORAS_TRANQUILAS", "1-6")
+PERFIL_INTERVALO = float(os.getenv("PERFIL_INTERVALO", "600"))
+
+# Evalúa el riesgo del mensaje en paralelo con la generación de la respuesta.
+RIESGO_EN_PARALELO = os.getenv("RIESGO_EN_PARALELO", "1") == "1"
+
+# Pre-filtro léxico antes de detectar_riesgo: "1" activo, "sombra" solo mide, "0" apagado.
+PREFILTRO_RIESGO = os.getenv("PREFILTRO_RIESGO", "1")
+PREFILTRO_UMBRAL = float(os.getenv("PREFILTRO_UMBRAL", "0"))
+PREFILTRO_MAX_TOKENS_BENIGNO = int(os.getenv("PREFILTRO_MAX_TOKENS_BENIGNO", "0"))
+
+# "separado": respuesta y riesgo en llamadas distintas. "combinado": una sola
+# llamada con salida estructurada que devuelve la respuesta y el JSON de riesgo.
+MODO_LLM = os.getenv("MODO_LLM", "separado")
+
+# Respuesta en streaming: se envía un marcador y se edita conforme llegan los tokens.
+RESPUESTA_STREAMING = os.getenv("RESPUESTA_STREAMING", "0") == "1"
+STREAMING_INTERVALO_EDICION = float(os.getenv("STREAMING_INTERVALO_EDICION", "1.5"))
+STREAMING_MIN_CARACTERES = int(os.getenv("STREAMING_MIN_CARACTERES", "40"))
+LIMITE_MENSAJE_TELEGRAM = 4096
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Permite apuntar a un servidor compatible local (p. ej. un LLM de prueba).
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+OPENAI_TIMEOUT_ANALISIS = float(os.getenv("OPENAI_TIMEOUT_ANALISIS", "60"))
+
+# Límites de la organización en OpenAI (0 = sin límite) y fracción de cada
+# límite que las tareas de baja prioridad (dependencia, perfil) dejan libre.
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+OPENAI_RESERVA_PRIORITARIA = float(os.getenv("OPENAI_RESERVA_PRIORITARIA", "0.2"))
+# Con varios procesos cada uno lleva sus propios cubos, así que el límite se
+# reparte: el ingreso (solo perfiles) se queda con OPENAI_FRACCION_INGRESO y
+# cada worker con una parte igual del resto. Los workers lanzados aparte
+# (WORKERS_URLS) necesitan SERENITY_WORKERS=N para saber entre cuántos dividir.
+OPENAI_FRACCION_INGRESO = float(os.getenv("OPENAI_FRACCION_INGRESO", "0.1"))
+
+
+def fraccion_limites_openai():
+    if SERENITY_MODO == "ingreso":
+        return OPENAI_FRACCION_INGRESO
+    if SERENITY_MODO == "worker":
+        return (1 - OPENAI_FRACCION_INGRESO) / max(SERENITY_WORKERS, 1)
+    return 1.0
+
+
+def limite_openai(limite):
+    """Parte del límite de la organización que le toca a este proceso (0 sigue siendo sin límite)."""
+    return max(1, int(limite * fraccion_limites_openai())) if limite else 0
+
+# Clientes creados en su primer uso (ver cliente_openai / cliente_twilio).
+client = None
+twilio_client = None
 
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+    format="%(asctime)s [%(levelname)s] "
+    + (f"worker{SERENITY_WORKER} " if SERENITY_MODO == "worker" else "")
+    + "%(name)s: %(message)s",
 )
 logger = logging.getLogger("serenity")
 
 
+_base_verificada = False
+
+
 def crear_base_datos():
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS usuarios (
-            id INTEGER PRIMARY KEY,
-            user_name TEXT,
-            ultima_alerta TEXT,
-            UNIQUE(user_name)
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS conversaciones (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            user_message TEXT,
-            bot_message TEXT,
-            timestamp TEXT,
-            FOREIGN KEY (user_id) REFERENCES usuarios (id)
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS datos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            nombre TEXT,
-            numero TEXT,
-            correo_institucional TEXT,
-            fecha TEXT,
-            facultad TEXT,
-            FOREIGN KEY (user_id) REFERENCES usuarios (id)
-        )
-    """)
+    """Aplica las migraciones pendientes una sola vez por proceso."""
+    global _base_verificada
+    if _base_verificada:
+        return
+    aplicadas = aplicar_migraciones(db)
+    _base_verificada = True
+    logger.info(f"✅ Base de datos verificada (v{version_actual(db)}, {aplicadas} migraciones aplicadas)")
 
-    try:
-        cursor.execute("ALTER TABLE datos ADD COLUMN facultad TEXT")
-    except Exception:
-        pass
 
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS dependencias (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,
-            nivel_dependencia TEXT,
-            puntaje_total INTEGER DEFAULT 0,
-            ultima_evaluacion TEXT,
-            contador_mensajes INTEGER DEFAULT 0,
-            FOREIGN KEY (user_id) REFERENCES usuarios (id)
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS historial_dependencias (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            nivel_dependencia TEXT,
-            puntaje_total INTEGER DEFAULT 0,
-            fecha_evaluacion TEXT,
-            FOREIGN KEY (user_id) REFERENCES usuarios (id)
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS alertas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            tipo_alerta TEXT,
-            nivel TEXT,
-            descripcion TEXT,
-            fecha TEXT,
-            enviada_correo INTEGER DEFAULT 0,
-            enviada_whatsapp INTEGER DEFAULT 0,
-            datos_autorizados INTEGER DEFAULT 0,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS perfil_emocional (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            fecha TEXT,
-            estado_emocional_predominante TEXT,
-            patrones_expresion TEXT,
-            intencion_divulgacion TEXT,
-            rasgos_personalidad TEXT,
-            necesidades_esperadas TEXT,
-            recomendaciones TEXT,
-            FOREIGN KEY (user_id) REFERENCES usuarios (id)
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS psicologos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nombre TEXT NOT NULL,
-            usuario TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            activo INTEGER DEFAULT 1
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS psicologos_facultades (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            psicologo_id INTEGER NOT NULL,
-            facultad TEXT NOT NULL,
-            FOREIGN KEY (psicologo_id) REFERENCES psicologos(id)
-        )
-    """)
+SQL_INSERTAR_USUARIO = registrar_sentencia(
+    "insertar_usuario",
+    "INSERT OR IGNORE INTO usuarios (id, user_name, ultima_alerta) VALUES (?, ?, ?)",
+)
+SQL_INSERTAR_MENSAJE = registrar_sentencia("insertar_mensaje", """
+    INSERT INTO conversaciones (user_id, user_message, bot_message, timestamp)
+    VALUES (?, ?, ?, ?)
+""")
+SQL_HISTORIAL = registrar_sentencia("historial", """
+    SELECT user_message, bot_message, timestamp
+    FROM conversaciones WHERE user_id=?
+    ORDER BY id DESC LIMIT ?
+""")
+SQL_INSERTAR_ALERTA = registrar_sentencia("insertar_alerta", """
+    INSERT INTO alertas (usuario_id, tipo_alerta, nivel, descripcion, fecha, enviada_correo, enviada_whatsapp)
+    VALUES (?, ?, ?, ?, datetime('now', 'localtime'), ?, ?)
+""")
+SQL_ULTIMA_ALERTA_CLINICA = registrar_sentencia(
+    "ultima_alerta_clinica", "SELECT ultima_alerta FROM estadisticas_usuario WHERE user_id=?"
+)
+SQL_ULTIMA_INFO = registrar_sentencia("ultima_info", "SELECT ultima_alerta FROM usuarios WHERE id=?")
+SQL_ACTUALIZAR_ULTIMA_INFO = registrar_sentencia(
+    "actualizar_ultima_info", "UPDATE usuarios SET ultima_alerta=? WHERE id=?"
+)
+SQL_DATOS_USUARIO = registrar_sentencia(
+    "datos_usuario",
+    "SELECT nombre, numero, correo_institucional, facultad FROM datos WHERE user_id=? ORDER BY id DESC LIMIT 1",
+)
+SQL_ULTIMA_ALERTA_CON_DATOS = registrar_sentencia("ultima_alerta_con_datos", """
+    SELECT fecha FROM alertas
+    WHERE usuario_id=? AND datos_autorizados=1
+    ORDER BY datetime(fecha) DESC
+    LIMIT 1
+""")
+SQL_MARCAR_DATOS_AUTORIZADOS = registrar_sentencia(
+    "marcar_datos_autorizados", "UPDATE alertas SET datos_autorizados=? WHERE id=?"
+)
 
-    conn.commit()
-    conn.close()
-    logger.info("✅ Base de datos verificada")
 
+def _historial_db(user_id, limite):
+    datos = db.todos(SQL_HISTORIAL, (user_id, limite))
+    return datos[::-1]
 
-def registrar_mensaje_db(user_id, user_name, user_message, bot_message):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    timestamp = datetime.now().isoformat()
-    cursor.execute(
-        "INSERT OR IGNORE INTO usuarios (id, user_name, ultima_alerta) VALUES (?, ?, ?)",
-        (user_id, user_name, None)
-    )
-    cursor.execute("""
-        INSERT INTO conversaciones (user_id, user_message, bot_message, timestamp)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, user_message, bot_message, timestamp))
-    conn.commit()
-    conn.close()
 
+cache_historial = CacheVentanas(
+    _historial_db,
+    por_usuario=CACHE_HISTORIAL_POR_USUARIO,
+    max_usuarios=CACHE_HISTORIAL_MAX_USUARIOS,
+    max_bytes=int(CACHE_HISTORIAL_MAX_MB * 1024 * 1024),
+    ttl=CACHE_HISTORIAL_TTL,
+)
 
-def obtener_historial_usuario(user_id, limite=5):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT user_message, bot_message, timestamp
-        FROM conversaciones WHERE user_id=?
-        ORDER BY id DESC LIMIT ?
-    """, (user_id, limite))
-    datos = cursor.fetchall()
-    conn.close()
-    return datos[::-1]
 
+escritor = EscritorDiferido(
+    db, modo=ESCRITURA_MODO, max_filas=ESCRITURA_MAX_FILAS, max_espera_ms=ESCRITURA_MAX_ESPERA_MS
+)
 
-def contar_mensajes_usuario(user_id):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM conversaciones WHERE user_id=?", (user_id,))
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+# context.user_data de los handlers del flujo de consentimiento se guarda en
+# SQLite (ver estado_conversacion.py): sobrevive reinicios y cambios de worker.
+estado_conversaciones = EstadoConversacion(db)
+
+
+async def registrar_mensaje_db(user_id, user_name, user_message, bot_message):
+    timestamp = datetime.now().isoformat()
+    with metricas.Etapa("guardar_turno"):
+        await escritor.escribir([
+            (SQL_INSERTAR_USUARIO, (user_id, user_name, None)),
+            (SQL_INSERTAR_MENSAJE, (user_id, user_message, bot_message, timestamp)),
+        ])
+    cache_historial.agregar(user_id, (user_message, bot_message, timestamp))
+
+
+def obtener_historial_usuario(user_id, limite=5):
+    return cache_historial.obtener(user_id, limite)
 
 
 def registrar_alerta(usuario_id, tipo_alerta, nivel, descripcion, enviada_correo=0, enviada_whatsapp=0):
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO alertas (usuario_id, tipo_alerta, nivel, descripcion, fecha, enviada_correo, enviada_whatsapp)
-            VALUES (?, ?, ?, ?, datetime('now', 'localtime'), ?, ?)
-        """, (usuario_id, tipo_alerta, nivel, descripcion, enviada_correo, enviada_whatsapp))
-        alerta_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return alerta_id
+        return db.ejecutar(
+            SQL_INSERTAR_ALERTA,
+            (usuario_id, tipo_alerta, nivel, descripcion, enviada_correo, enviada_whatsapp),
+        )
     except Exception as e:
         logger.error(f"[Alertas] Error registrando alerta: {e}")
         return None
 
 
 def puede_generar_alerta_clinica(user_id):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute("SELECT fecha FROM alertas WHERE usuario_id=? ORDER BY id DESC LIMIT 1", (user_id,))
-    fila = cursor.fetchone()
-    conn.close()
-    if not fila:
+    fila = db.uno(SQL_ULTIMA_ALERTA_CLINICA, (user_id,))
+    if not fila or not fila[0]:
         return True
     ultima = datetime.fromisoformat(fila[0])
     return (datetime.now() - ultima) >= timedelta(minutes=RISK_COOLDOWN_MINUTES)
 
 
 def puede_enviar_info_psicologia(user_id):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute("SELECT ultima_alerta FROM usuarios WHERE id=?", (user_id,))
-    fila = cursor.fetchone()
-    conn.close()
+    fila = db.uno(SQL_ULTIMA_INFO, (user_id,))
     if fila and fila[0]:
         ultima = datetime.fromisoformat(fila[0])
         return (datetime.now() - ultima).days >= COOLDOWN_DIAS
@@ -269,25 +329,11 @@ def puede_enviar_info_psicologia(user_id):
 
 
 def actualizar_ultima_alerta(user_id):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE usuarios SET ultima_alerta=? WHERE id=?",
-        (datetime.now().isoformat(), user_id)
-    )
-    conn.commit()
-    conn.close()
+    db.ejecutar(SQL_ACTUALIZAR_ULTIMA_INFO, (datetime.now().isoformat(), user_id))
 
 
 def obtener_datos_usuario(user_id):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT nombre, numero, correo_institucional, facultad FROM datos WHERE user_id=? ORDER BY id DESC LIMIT 1",
-        (user_id,)
-    )
-    fila = cursor.fetchone()
-    conn.close()
+    fila = db.uno(SQL_DATOS_USUARIO, (user_id,))
     if fila:
         return {
             "nombre": fila[0],
@@ -304,19 +350,7 @@ def obtener_fecha_ultima_alerta_con_datos(user_id):
     Devuelve la fecha de la última alerta donde datos_autorizados = 1, o None.
     """
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT fecha FROM alertas
-            WHERE usuario_id=? AND datos_autorizados=1
-            ORDER BY datetime(fecha) DESC
-            LIMIT 1
-            """,
-            (user_id,)
-        )
-        fila = cursor.fetchone()
-        conn.close()
+        fila = db.uno(SQL_ULTIMA_ALERTA_CON_DATOS, (user_id,))
         if fila and fila[0]:
             return datetime.fromisoformat(fila[0])
     except Exception as e:
@@ -344,50 +378,258 @@ def debe_pedir_datos(user_id):
     return dias_transcurridos >= 15
 
 
-def marcar_alerta_enviada(alerta_id, datos_autorizados):
+def marcar_datos_autorizados(alerta_id, datos_autorizados):
     """
-    Marca una alerta como enviada por correo y WhatsApp,
-    y actualiza si los datos fueron autorizados (1) o no (0).
+    Actualiza si los datos fueron autorizados (1) o no (0) para la alerta.
+    Los flags enviada_correo / enviada_whatsapp los marca el despachador
+    cuando cada canal confirma la entrega.
     """
     if not alerta_id:
         return
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            UPDATE alertas
-            SET datos_autorizados=?, enviada_correo=1, enviada_whatsapp=1
-            WHERE id=?
-            """,
-            (1 if datos_autorizados else 0, alerta_id)
-        )
-        conn.commit()
-        conn.close()
+        db.ejecutar(SQL_MARCAR_DATOS_AUTORIZADOS, (1 if datos_autorizados else 0, alerta_id))
     except Exception as e:
         logger.error(f"[Alertas] Error actualizando alerta: {e}")
 
 
-def openai_chat(messages, temperature=0.7):
-    if not client:
+# Los clientes se piden desde hilos (asyncio.to_thread del despachador): se
+# configuran completos en una variable local y recién ahí se publican.
+_clientes_lock = threading.Lock()
+
+
+def cliente_openai():
+    global client
+    if client is None and OPENAI_API_KEY:
+        with _clientes_lock:
+            if client is None:
+                openai = arranque.importar("openai")
+                # Sin reintentos del SDK: todas las llamadas pasan por planificador_llm,
+                # que reintenta los 429 y descuenta cada intento de los token buckets.
+                client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=0)
+    return client
+
+
+def cliente_twilio():
+    global twilio_client
+    if twilio_client is None and TWILIO_SID and TWILIO_TOKEN:
+        with _clientes_lock:
+            if twilio_client is None:
+                twilio_rest = arranque.importar("twilio.rest")
+                nuevo = twilio_rest.Client(TWILIO_SID, TWILIO_TOKEN)
+                if TWILIO_API_URL:
+                    nuevo.api.base_url = TWILIO_API_URL
+                twilio_client = nuevo
+    return twilio_client
+
+
+PROMPT_SERENITY = (
+    "Eres Serenity, un acompañante emocional cálido y empático. Validas emociones, haces preguntas suaves "
+    "y evitas diagnosticar o medicar. No te salgas del contexto psicologico y bienestar emocional. No respondas preguntas relacionadas a matematicas, programación historia o otras cosas."
+)
+
+# Consumo acumulado por tipo de llamada, para comparar MODO_LLM separado/combinado.
+CONSUMO_LLM = defaultdict(Counter)
+planificador_llm = PlanificadorLLM(
+    rpm=limite_openai(OPENAI_RPM), tpm=limite_openai(OPENAI_TPM), reserva=OPENAI_RESERVA_PRIORITARIA,
+    consumo=CONSUMO_LLM,
+)
+
+
+def estimar_tokens(messages, respuesta=400):
+    """Estimación gruesa (4 caracteres por token) para reservar cupo antes de la llamada."""
+    return sum(len(m.get("content") or "") for m in messages) // 4 + respuesta
+
+
+async def completar(messages, temperature=0, timeout=OPENAI_TIMEOUT, tipo="otro", **opciones):
+    """
+    Llama al modelo sin bloquear el event loop. El timeout es por llamada:
+    una respuesta lenta solo retiene al usuario que la pidió. La llamada
+    espera turno en planificador_llm según la prioridad de `tipo`.
+    """
+    resp = await planificador_llm.ejecutar(
+        tipo,
+        lambda: cliente_openai().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            temperature=temperature,
+            timeout=timeout,
+            **opciones,
+        ),
+        tokens_estimados=estimar_tokens(messages),
+    )
+    return resp.choices[0].message.content
+
+
+async def openai_chat(messages, temperature=0.7):
+    if not cliente_openai():
         return "Lo siento, ahora mismo no puedo generar respuestas."
+    inicio = time.perf_counter()
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=temperature
-        )
-        return resp.choices[0].message.content
+        respuesta = await completar(messages, temperature=temperature, tipo="chat")
     except Exception as e:
         logger.error(f"[OpenAI] Error: {e}")
+        metricas.registrar_etapa("openai_chat", inicio, "error")
         return "⚠️ Estoy teniendo dificultades para responder ahora mismo."
+    metricas.registrar_etapa("openai_chat", inicio)
+    return respuesta
 
 
-def detectar_riesgo(user_id, mensaje_actual):
-    if not client:
+async def resumir_conversacion(resumen_anterior, filas):
+    """Incorpora los turnos `filas` al resumen acumulado del usuario."""
+    transcripcion = "\n".join(
+        f"Usuario: {recortar(u, CONTEXTO_TOKENS_MENSAJE)}\nSerenity: {recortar(b, CONTEXTO_TOKENS_MENSAJE)}"
+        for _id, u, b, _fecha in filas
+    )
+    prompt = f"""
+Actualiza el resumen de la conversación entre un estudiante y Serenity, un acompañante emocional.
+Conserva lo importante para acompañarlo a largo plazo: situaciones personales, emociones
+recurrentes, personas y temas mencionados, avances y preocupaciones. Omite saludos y detalles
+triviales. Escribe en tercera persona, en un solo párrafo de máximo 150 palabras.
+
+Resumen anterior:
+{resumen_anterior or "(sin resumen previo)"}
+
+Nuevos turnos:
+{transcripcion}
+"""
+    content = await completar(
+        [{"role": "user", "content": prompt}], temperature=0, timeout=OPENAI_TIMEOUT_ANALISIS,
+        tipo="resumen",
+    )
+    return content.strip()
+
+
+resumenes = ResumenesConversacion(
+    db, resumir_conversacion, mantener=RESUMEN_MANTENER, cada=RESUMEN_CADA
+)
+
+
+class EditorProgresivo:
+    """
+    Muestra una respuesta en streaming editando un solo mensaje de Telegram.
+    Las ediciones se agrupan: como máximo una cada `intervalo` segundos y solo
+    si llegaron al menos `min_caracteres` nuevos, respetando RetryAfter.
+    """
+
+    def __init__(self, update, intervalo=None, min_caracteres=None):
+        self.update = update
+        self.intervalo = STREAMING_INTERVALO_EDICION if intervalo is None else intervalo
+        self.min_caracteres = STREAMING_MIN_CARACTERES if min_caracteres is None else min_caracteres
+        self.texto = ""
+        self._mensaje = None
+        self._mostrado = ""
+        self._siguiente_edicion = 0.0
+
+    async def iniciar(self):
+        try:
+            await self.update.effective_chat.send_action("typing")
+        except Exception:
+            pass
+        self._mensaje = await self.update.message.reply_text("…")
+        self._siguiente_edicion = time.monotonic() + self.intervalo
+
+    async def agregar(self, fragmento):
+        self.texto += fragmento
+        if (
+            time.monotonic() >= self._siguiente_edicion
+            and len(self.texto) - len(self._mostrado) >= self.min_caracteres
+            and len(self._mostrado) < LIMITE_MENSAJE_TELEGRAM
+        ):
+            await self._editar(self.texto[:LIMITE_MENSAJE_TELEGRAM - 2] + " …")
+
+    async def finalizar(self, texto=None):
+        if texto is not None:
+            self.texto = texto
+        primero, resto = self.texto[:LIMITE_MENSAJE_TELEGRAM], self.texto[LIMITE_MENSAJE_TELEGRAM:]
+        await self._editar(primero, final=True)
+        while resto:
+            await self.update.message.reply_text(resto[:LIMITE_MENSAJE_TELEGRAM])
+            resto = resto[LIMITE_MENSAJE_TELEGRAM:]
+
+    async def _editar(self, texto, final=False):
+        if not texto.strip() or texto == self._mostrado:
+            return
+        from telegram.error import BadRequest, RetryAfter
+
+        while True:
+            try:
+                await self._mensaje.edit_text(texto)
+                self._mostrado = texto
+                break
+            except RetryAfter as e:
+                espera = float(getattr(e, "retry_after", 1))
+                logger.warning(f"[Streaming] Telegram pidió esperar {espera:.0f}s entre ediciones")
+                if not final:
+                    self._siguiente_edicion = time.monotonic() + espera
+                    return
+                await asyncio.sleep(espera)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    logger.error(f"[Streaming] Error editando mensaje: {e}")
+                break
+        self._siguiente_edicion = time.monotonic() + self.intervalo
+
+
+async def responder_en_streaming(update, messages, temperature=0.7):
+    """Genera la respuesta en streaming editando el mensaje; devuelve el texto final."""
+    editor = EditorProgresivo(update)
+    await editor.iniciar()
+    try:
+        stream = await planificador_llm.ejecutar(
+            "chat",
+            lambda: cliente_openai().chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                temperature=temperature,
+                timeout=OPENAI_TIMEOUT,
+                stream=True,
+            ),
+            tokens_estimados=estimar_tokens(messages),
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                await editor.agregar(chunk.choices[0].delta.content)
+    except Exception as e:
+        logger.error(f"[OpenAI] Error en streaming: {e}")
+        if not editor.texto.strip():
+            editor.texto = "⚠️ Estoy teniendo dificultades para responder ahora mismo."
+    await editor.finalizar()
+    return editor.texto
+
+
+async def responder(update, messages):
+    """Genera la respuesta al usuario y la envía; devuelve el texto para guardarlo."""
+    with metricas.Etapa("respuesta"):
+        if RESPUESTA_STREAMING and cliente_openai():
+            return await responder_en_streaming(update, messages)
+        bot_reply = await openai_chat(messages, temperature=0.7)
+        with metricas.Etapa("telegram_envio"):
+            await update.message.reply_text(bot_reply)
+        return bot_reply
+
+
+prefiltro_riesgo = None
+if PREFILTRO_RIESGO != "0":
+    prefiltro_riesgo = PrefiltroRiesgo(
+        umbral=PREFILTRO_UMBRAL,
+        max_tokens_benigno=PREFILTRO_MAX_TOKENS_BENIGNO,
+        sombra=PREFILTRO_RIESGO == "sombra",
+    )
+
+
+async def detectar_riesgo(user_id, mensaje_actual, historial=None):
+    if not cliente_openai():
         return False, None, "OpenAI no configurado", None
+    inicio = time.perf_counter()
     try:
-        historial = obtener_historial_usuario(user_id, limite=7)
+        if historial is None:
+            historial = obtener_historial_usuario(user_id, limite=7)
+
+        if prefiltro_riesgo:
+            decision = prefiltro_riesgo.evaluar(mensaje_actual, [u for u, _b, _f in historial])
+            if not decision.escalar:
+                metricas.registrar_etapa("detectar_riesgo", inicio, "prefiltro")
+                return False, "ninguno", f"Pre-filtro: {decision.motivo}", None
         contexto = "".join(
             [f"{i}. [{fecha}] Usuario: {msg}\n" for i, (msg, _b, fecha) in enumerate(historial, 1)]
         )
@@ -410,13 +652,8 @@ Contexto:
 Mensaje actual del usuario: {mensaje_actual}
 """
 
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-
-        content = resp.choices[0].message.content.strip()
+        content = await completar([{"role": "user", "content": prompt}], temperature=0, tipo="riesgo")
+        content = content.strip()
         content = content.replace("\n", " ").replace("\r", " ")
         m = re.search(r"\{.*\}", content, re.DOTALL)
         json_text = m.group(0) if m else None
@@ -428,61 +665,135 @@ Mensaje actual del usuario: {mensaje_actual}
             except Exception:
                 pass
 
-        riesgo_flag = parsed.get("RIESGO", "NO").upper().startswith("S")
-        tema = parsed.get("TEMA", "ninguno").lower()
-        razon = parsed.get("RAZON", "")
+        evaluacion = registrar_evaluacion_riesgo(user_id, parsed)
+        metricas.registrar_etapa("detectar_riesgo", inicio, "riesgo" if evaluacion[0] else "sin_riesgo")
+        return evaluacion
+
+    except Exception as e:
+        logger.error(f"[Riesgo] Error: {e}")
+        metricas.registrar_etapa("detectar_riesgo", inicio, "error")
+        return False, None, "Error", None
+
+
+def registrar_evaluacion_riesgo(user_id, parsed):
+    """
+    Interpreta el JSON RIESGO/TEMA/RAZON (de detectar_riesgo o del modo
+    combinado) y registra la alerta si corresponde.
+    """
+    riesgo_flag = str(parsed.get("RIESGO", "NO")).upper().startswith("S")
+    tema = str(parsed.get("TEMA", "ninguno")).lower()
+    razon = parsed.get("RAZON", "")
+
+    alerta_id = None
+    if riesgo_flag and puede_generar_alerta_clinica(user_id):
+        tipo_alerta = f"riesgo {tema}" if tema != "ninguno" else "riesgo psicológico"
+        nivel = "crítico" if tema == "suicidio" else "alto"
+        alerta_id = registrar_alerta(user_id, tipo_alerta, nivel, razon)
+        trazas.atributo("alerta_id", alerta_id)
+        trazas.forzar()
 
-        alerta_id = None
-        if riesgo_flag and puede_generar_alerta_clinica(user_id):
-            tipo_alerta = f"riesgo {tema}" if tema != "ninguno" else "riesgo psicológico"
-            nivel = "crítico" if tema == "suicidio" else "alto"
-            alerta_id = registrar_alerta(user_id, tipo_alerta, nivel, razon)
+    return riesgo_flag, tema, razon, alerta_id
 
-        return riesgo_flag, tema, razon, alerta_id
 
+INSTRUCCIONES_COMBINADO = """
+Además de responder, evalúa como psicólogo clínico preventivo si el ÚLTIMO mensaje del usuario,
+en el contexto de la conversación, muestra señales de riesgo actual de: suicidio, drogadicción,
+violencia familiar, abuso sexual o depresión severa. Si el mensaje muestra calma, saludo,
+agradecimiento o cambio de tema → NO hay riesgo.
+
+Responde SOLO con un JSON válido con EXACTAMENTE estas claves:
+{"respuesta":"<tu respuesta para el usuario>","RIESGO":"SI/NO","TEMA":"suicidio/drogadiccion/violencia/abuso/depresion/ninguno","RAZON":"..."}
+"""
+
+
+async def responder_y_evaluar(user_id, mensajes, mensaje_actual, historial):
+    """
+    Modo combinado: una sola llamada devuelve la respuesta empática y la
+    evaluación de riesgo. Si la salida no trae un JSON utilizable, se recurre
+    a la evaluación de riesgo separada para no perder sensibilidad.
+    """
+    if not cliente_openai():
+        return "Lo siento, ahora mismo no puedo generar respuestas.", (False, None, "OpenAI no configurado", None)
+
+    combinados = [dict(mensajes[0], content=mensajes[0]["content"] + "\n" + INSTRUCCIONES_COMBINADO)] + mensajes[1:]
+    parsed = None
+    try:
+        content = await completar(
+            combinados, temperature=0.7, tipo="combinado", response_format={"type": "json_object"}
+        )
+        parsed = json.loads(content)
+    except Exception as e:
+        logger.error(f"[OpenAI] Error en modo combinado: {e}")
+
+    if not isinstance(parsed, dict) or not str(parsed.get("respuesta", "")).strip():
+        respuesta, riesgo = await asyncio.gather(
+            openai_chat(mensajes, temperature=0.7),
+            detectar_riesgo(user_id, mensaje_actual, historial),
+        )
+        return respuesta, riesgo
+
+    try:
+        riesgo = registrar_evaluacion_riesgo(user_id, parsed)
     except Exception as e:
         logger.error(f"[Riesgo] Error: {e}")
-        return False, None, "Error", None
+        riesgo = (False, None, "Error", None)
+    return str(parsed["respuesta"]).strip(), riesgo
+
+
+DEPENDENCIA_CADA = int(os.getenv("DEPENDENCIA_CADA", "15"))
+
+contadores_dependencia = ContadoresEnLote(
+    db,
+    leer="SELECT contador_mensajes FROM dependencias WHERE user_id=?",
+    escribir="""
+        INSERT INTO dependencias (user_id, nivel_dependencia, ultima_evaluacion, contador_mensajes)
+        VALUES (?1, 'baja', ?3, ?2)
+        ON CONFLICT(user_id) DO UPDATE SET contador_mensajes=excluded.contador_mensajes
+    """,
+    intervalo=float(os.getenv("CONTADORES_INTERVALO", "30")),
+)
 
 
-def detectar_dependencia(user_id):
-    if not client:
+def _items_validos(items):
+    try:
+        items = [int(x) for x in items]
+    except (TypeError, ValueError):
+        return None
+    if len(items) != 8 or not all(1 <= x <= 5 for x in items):
+        return None
+    return items
+
+
+async def detectar_dependencia(user_id):
+    """
+    Cada DEPENDENCIA_CADA mensajes actualiza la escala de 8 ítems con solo los
+    turnos nuevos desde la evaluación anterior y los puntajes previos por ítem.
+    """
+    if not cliente_openai():
         return None
+    inicio = time.perf_counter()
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT nivel_dependencia, contador_mensajes FROM dependencias WHERE user_id=?",
-            (user_id,)
-        )
-        fila = cursor.fetchone()
-        nivel_actual, contador = fila if fila else (None, 0)
-        contador += 1
-
-        LIMITE_MENSAJES = 15
-        if contador < LIMITE_MENSAJES:
-            if fila:
-                cursor.execute(
-                    "UPDATE dependencias SET contador_mensajes=? WHERE user_id=?",
-                    (contador, user_id)
-                )
-            else:
-                cursor.execute("""
-                    INSERT INTO dependencias (user_id, nivel_dependencia, ultima_evaluacion, contador_mensajes)
-                    VALUES (?, ?, ?, ?)
-                """, (user_id, "baja", datetime.now().isoformat(), contador))
-            conn.commit()
-            conn.close()
+        if contadores_dependencia.incrementar(user_id) < DEPENDENCIA_CADA:
             return None
 
-        cursor.execute("""
-            SELECT user_message, bot_message FROM conversaciones WHERE user_id=?
-            ORDER BY id DESC LIMIT 15
+        anterior = db.uno("""
+            SELECT items, puntaje_total, nivel_dependencia, hasta_id FROM historial_dependencias
+            WHERE user_id=? ORDER BY id DESC LIMIT 1
         """, (user_id,))
-        historial = cursor.fetchall()
-        conn.close()
+        items_previos, total_previo, nivel_previo, hasta_id = anterior if anterior else (None, None, None, None)
+        items_previos = _items_validos(json.loads(items_previos)) if items_previos else None
+
+        if hasta_id:
+            turnos = db.todos("""
+                SELECT user_message, bot_message, timestamp FROM conversaciones
+                WHERE user_id=? AND id>? ORDER BY id DESC LIMIT ?
+            """, (user_id, hasta_id, DEPENDENCIA_CADA * 3))[::-1]
+        else:
+            turnos = obtener_historial_usuario(user_id, limite=DEPENDENCIA_CADA)
+        historial = ajustar_turnos(turnos, CONTEXTO_TOKENS_DEPENDENCIA, CONTEXTO_TOKENS_MENSAJE)
+        ultimo_id = db.uno("SELECT MAX(id) FROM conversaciones WHERE user_id=?", (user_id,))[0]
 
-        mensajes = "\n".join([f"Usuario: {u}\nSerenity: {b}" for u, b in reversed(historial)])
+        mensajes = "\n".join([f"Usuario: {u}\nSerenity: {b}" for u, b, _ in historial])
 #1. Necesidad frecuente de usarlo.
 #2. Dificultad para dejar de usarlo.
 #3. Conexión emocional hacia el chatbot.
@@ -491,6 +802,14 @@ def detectar_dependencia(user_id):
 #6. Pensar frecuentemente en conversaciones.
 #7. Uso para sentirse comprendido(a).
 #8. Creencia de depender demasiado.
+        if items_previos:
+            previa = (
+                f"Evaluación anterior: items={items_previos}, total={total_previo}, nivel={nivel_previo}.\n"
+                "Actualízala con la evidencia de los turnos nuevos; si un ítem no tiene evidencia nueva, "
+                "conserva su puntaje anterior."
+            )
+        else:
+            previa = "No hay evaluación anterior."
         prompt = f"""
 Evalúa el nivel de dependencia emocional hacia un chatbot en escala 1-5 según estos ítems:
 1. Si no puedo usar chatbots de IA, me sentiría ansioso o incómodo.
@@ -502,19 +821,20 @@ Evalúa el nivel de dependencia emocional hacia un chatbot en escala 1-5 según
 7. Cada vez dedicio más tiempo a los chatbots de IA. 
 8. Para mí, la vida sin chatbots de IA sería un inconveniente.
 
+{previa}
+
 Responde SOLO en JSON:
 {{"items":[n1...n8],"total":X,"nivel":"baja"|"media"|"alta"}}
 
-Conversación:
+Conversación nueva:
 {mensajes}
 """
 
-        r = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
+        content = await completar(
+            [{"role": "user", "content": prompt}], temperature=0, timeout=OPENAI_TIMEOUT_ANALISIS,
+            tipo="dependencia",
         )
-        content = r.choices[0].message.content.strip().replace("\n", " ").replace("\r", " ")
+        content = content.strip().replace("\n", " ").replace("\r", " ")
         m = re.search(r"\{.*\}", content)
         j = m.group(0) if m else None
 
@@ -525,55 +845,65 @@ Conversación:
             except Exception:
                 pass
 
-        total = int(parsed.get("total", 8))
+        items = _items_validos(parsed.get("items")) or items_previos
+        total = sum(items) if items else int(parsed.get("total", 8))
         nivel = parsed.get("nivel", "baja").lower()
         if nivel not in ["baja", "media", "alta"]:
             nivel = "baja"
+        delta = total - total_previo if total_previo is not None else None
+        if delta is None or delta == 0:
+            tendencia = "estable"
+        else:
+            tendencia = "aumenta" if delta > 0 else "disminuye"
+        items_json = json.dumps(items) if items else None
 
         fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO dependencias (user_id, nivel_dependencia, puntaje_total, ultima_evaluacion, contador_mensajes)
-            VALUES (?, ?, ?, ?, 0)
-            ON CONFLICT(user_id) DO UPDATE SET
-                nivel_dependencia=excluded.nivel_dependencia,
-                puntaje_total=excluded.puntaje_total,
-                ultima_evaluacion=excluded.ultima_evaluacion,
-                contador_mensajes=0
-        """, (user_id, nivel, total, fecha))
-
-        cursor.execute("""
-            INSERT INTO historial_dependencias (user_id, nivel_dependencia, puntaje_total, fecha_evaluacion)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, nivel, total, fecha))
-
-        conn.commit()
-        conn.close()
+        with db.transaccion() as cursor:
+            cursor.execute("""
+                INSERT INTO dependencias (user_id, nivel_dependencia, puntaje_total, ultima_evaluacion,
+                                          contador_mensajes, items, delta, tendencia, hasta_id)
+                VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    nivel_dependencia=excluded.nivel_dependencia,
+                    puntaje_total=excluded.puntaje_total,
+                    ultima_evaluacion=excluded.ultima_evaluacion,
+                    contador_mensajes=0,
+                    items=excluded.items,
+                    delta=excluded.delta,
+                    tendencia=excluded.tendencia,
+                    hasta_id=excluded.hasta_id
+            """, (user_id, nivel, total, fecha, items_json, delta, tendencia, ultimo_id))
+
+            cursor.execute("""
+                INSERT INTO historial_dependencias (user_id, nivel_dependencia, puntaje_total, fecha_evaluacion,
+                                                    items, delta, tendencia, hasta_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, nivel, total, fecha, items_json, delta, tendencia, ultimo_id))
+        contadores_dependencia.reiniciar(user_id)
+        metricas.registrar_etapa("detectar_dependencia", inicio)
         return nivel
     except Exception as e:
         logger.error(f"[Dependencia] Error: {e}")
+        metricas.registrar_etapa("detectar_dependencia", inicio, "error")
         return None
 
 
-def analizar_perfil_emocional(user_id):
-    if not client:
+async def analizar_perfil_emocional(user_id):
+    if not cliente_openai():
         return None
     try:
-        conn = sqlite3.connect(db_file)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT user_message FROM conversaciones WHERE user_id=? ORDER BY id DESC LIMIT 20",
-            (user_id,)
-        )
-        filas = cur.fetchall()
-        conn.close()
-
-        msgs = [f[0] for f in filas[::-1]]
-        if not msgs:
+        # Lectura directa: el perfil corre en segundo plano y no debe ocupar la caché de activos.
+        turnos = _historial_db(user_id, 20)
+        if not turnos:
             return None
 
-        context = "\n".join([f"- {m}" for m in msgs])
+        # Solo los mensajes del usuario que el resumen todavía no cubre.
+        resumen, hasta_fecha = resumenes.obtener(user_id)
+        turnos = [(u, "", fecha) for u, _b, fecha in sin_resumir(turnos, hasta_fecha)]
+        elegidos = ajustar_turnos(turnos, CONTEXTO_TOKENS_PERFIL - contar_tokens(resumen), CONTEXTO_TOKENS_MENSAJE)
+        context = "\n".join([f"- {u}" for u, _b, _ in elegidos])
+        if resumen:
+            context = f"(Resumen de conversaciones anteriores: {resumen})\n{context}"
 
         prompt = f"""
 Genera un perfil emocional breve con EXACTAMENTE estas claves en JSON:
@@ -590,12 +920,11 @@ Mensajes:
 {context}
 """
 
-        r = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
+        content = await completar(
+            [{"role": "user", "content": prompt}], temperature=0, timeout=OPENAI_TIMEOUT_ANALISIS,
+            tipo="perfil",
         )
-        content = r.choices[0].message.content.strip().replace("\n", " ").replace("\r", " ")
+        content = content.strip().replace("\n", " ").replace("\r", " ")
         m = re.search(r"\{.*\}", content)
         j = m.group(0) if m else None
 
@@ -634,9 +963,7 @@ Mensajes:
 
 def guardar_perfil_emocional(user_id, perfil):
     try:
-        conn = sqlite3.connect(db_file)
-        cur = conn.cursor()
-        cur.execute("""
+        db.ejecutar("""
             INSERT INTO perfil_emocional (
                 user_id, fecha, estado_emocional_predominante, patrones_expresion,
                 intencion_divulgacion, rasgos_personalidad, necesidades_esperadas, recomendaciones
@@ -650,15 +977,91 @@ def guardar_perfil_emocional(user_id, perfil):
             perfil.get("necesidades_esperadas", ""),
             perfil.get("recomendaciones", ""),
         ))
-        conn.commit()
-        conn.close()
     except Exception as e:
         logger.error(f"[Perfil] Error guardando: {e}")
 
 
+archivador = Archivador(
+    db, directorio_archivo(db_file), dias=ARCHIVO_DIAS, intervalo=ARCHIVO_INTERVALO_HORAS * 3600
+)
+
+planificador_perfiles = PlanificadorPerfiles(
+    db,
+    analizar_perfil_emocional,
+    guardar_perfil_emocional,
+    cada=PERFIL_CADA,
+    lote=PERFIL_LOTE,
+    concurrencia=PERFIL_CONCURRENCIA,
+    horas=horas_tranquilas(PERFIL_HORAS_TRANQUILAS),
+    intervalo=PERFIL_INTERVALO,
+)
+
+
+class SesionSMTP:
+    """
+    Sesión SMTP_SSL que se mantiene abierta entre alertas. Se verifica con NOOP
+    antes de reutilizarla y se reabre si el servidor la cerró o lleva inactiva
+    más de `inactividad` segundos.
+    """
+
+    def __init__(self, host, puerto, usuario, password, inactividad=SMTP_INACTIVIDAD, ssl=True):
+        self.host = host
+        self.puerto = puerto
+        self.ssl = ssl
+        self.usuario = usuario
+        self.password = password
+        self.inactividad = inactividad
+        self._smtp = None
+        self._ultimo_uso = 0.0
+        self._lock = threading.Lock()
+
+    def _conectar(self):
+        self.cerrar()
+        smtplib = arranque.importar("smtplib")
+        clase = smtplib.SMTP_SSL if self.ssl else smtplib.SMTP
+        smtp = clase(self.host, self.puerto, timeout=30)
+        smtp.login(self.usuario, self.password)
+        self._smtp = smtp
+
+    def _sesion_viva(self):
+        if self._smtp is None or time.monotonic() - self._ultimo_uso > self.inactividad:
+            return False
+        try:
+            return self._smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    def enviar(self, remitente, destinatarios, mensaje):
+        smtplib = arranque.importar("smtplib")
+        with self._lock:
+            if not self._sesion_viva():
+                self._conectar()
+            try:
+                self._smtp.sendmail(remitente, destinatarios, mensaje)
+            except smtplib.SMTPServerDisconnected:
+                self._conectar()
+                self._smtp.sendmail(remitente, destinatarios, mensaje)
+            self._ultimo_uso = time.monotonic()
+
+    def cerrar(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+
+sesion_smtp = SesionSMTP(SMTP_HOST, SMTP_PUERTO, GMAIL_USER, GMAIL_PASS, ssl=SMTP_SSL)
+cache_exportacion = CacheExportacion(
+    EXPORTACION_CACHE_DIR, max_mb=EXPORTACION_CACHE_MAX_MB, max_dias=EXPORTACION_CACHE_DIAS
+) if EXPORTACION_CACHE else None
+
+
 def enviar_alerta_correo(user_id, user_name, historial, tema_alerta, mensaje_activador, datos_usuario, alerta_id):
+    """Devuelve False si el correo no está configurado; lanza excepción si falla el envío."""
     if not GMAIL_USER or not GMAIL_PASS:
-        return
+        return False
 
     cuerpo = f"🚨 ALERTA DE ALTO RIESGO: {tema_alerta.upper()} 🚨\n\n"
     cuerpo += f"👤 Usuario (Telegram): {user_name}\n"
@@ -677,17 +1080,18 @@ def enviar_alerta_correo(user_id, user_name, historial, tema_alerta, mensaje_act
         cuerpo += "\nℹ Usuario no autorizó compartir datos.\n"
 
     try:
-        conn = sqlite3.connect(db_file)
-        df = pd.read_sql_query(
-            "SELECT * FROM conversaciones WHERE user_id=? ORDER BY id ASC",
-            conn,
-            params=(user_id,)
+        adjunto, nombre_adjunto, _mime = exportar_conversaciones(
+            db, user_id, formato=EXPORTACION_FORMATO, cache=cache_exportacion
         )
-        conn.close()
-        excel_path = os.path.join(tempfile.gettempdir(), f"alerta_{user_id}.xlsx")
-        df.to_excel(excel_path, index=False)
-    except Exception:
-        excel_path = None
+        nombre_adjunto = f"alerta_{user_id}_{alerta_id}_{nombre_adjunto}"
+    except Exception as e:
+        logger.error(f"[Correo] Error exportando conversación: {e}")
+        adjunto = None
+
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.base import MIMEBase
+    from email import encoders
 
     msg_email = MIMEMultipart()
     msg_email["Subject"] = f"Alerta de riesgo - Usuario {user_name} - Tema: {tema_alerta}"
@@ -695,43 +1099,81 @@ def enviar_alerta_correo(user_id, user_name, historial, tema_alerta, mensaje_act
     msg_email["To"] = GMAIL_USER
     msg_email.attach(MIMEText(cuerpo, "plain"))
 
-    if excel_path and os.path.isfile(excel_path):
-        with open(excel_path, "rb") as f:
-            part = MIMEBase("application", "octet-stream")
-            part.set_payload(f.read())
+    if adjunto:
+        part = MIMEBase("application", "octet-stream")
+        part.set_payload(adjunto)
         encoders.encode_base64(part)
         part.add_header(
             "Content-Disposition",
-            f'attachment; filename="{os.path.basename(excel_path)}"'
+            f'attachment; filename="{nombre_adjunto}"'
         )
         msg_email.attach(part)
 
-    try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            smtp.login(GMAIL_USER, GMAIL_PASS)
-            smtp.sendmail(GMAIL_USER, [GMAIL_USER], msg_email.as_string())
-    except Exception as e:
-        logger.error(f"[Correo] Error enviando: {e}")
+    with metricas.Etapa("smtp"):
+        sesion_smtp.enviar(GMAIL_USER, [GMAIL_USER], msg_email.as_string())
+    return True
 
 
-def enviar_alerta_whatsapp(user_id, user_name, tema_alerta, mensaje_activador, alerta_id):
-    if not twilio_client:
-        return
-    try:
-        cuerpo = (
-            f"🚨 *ALERTA DE ALTO RIESGO ({tema_alerta.upper()})* 🚨\n\n"
-            f"👤 Usuario: {user_name}\n"
-            f"🗨️ Mensaje de alerta:\n{mensaje_activador}\n\n"
-            f"📅 Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-            "Revisa correo para más información."
-        )
-        twilio_client.messages.create(
+def enviar_alerta_whatsapp(user_id, user_name, tema_alerta, mensaje_activador, alerta_id, fecha=None):
+    """Devuelve False si Twilio no está configurado; lanza excepción si falla el envío."""
+    twilio = cliente_twilio()
+    if not twilio:
+        return False
+    fecha = fecha or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cuerpo = (
+        f"🚨 *ALERTA DE ALTO RIESGO ({tema_alerta.upper()})* 🚨\n\n"
+        f"👤 Usuario: {user_name}\n"
+        f"🗨️ Mensaje de alerta:\n{mensaje_activador}\n\n"
+        f"📅 Fecha: {fecha}\n"
+        "Revisa correo para más información."
+    )
+    with metricas.Etapa("twilio"):
+        twilio.messages.create(
             body=cuerpo,
             from_=TWILIO_WHATSAPP_FROM,
             to=TWILIO_WHATSAPP_TO
         )
+    return True
+
+
+def _canal_correo(p):
+    with trazas.tramo("alerta.correo", padre=p.get("traza"), alerta_id=p["alerta_id"]):
+        return enviar_alerta_correo(
+            p["user_id"], p["user_name"], p["historial"], p["tema"], p["mensaje"], p["datos_usuario"], p["alerta_id"]
+        )
+
+
+def _canal_whatsapp(p):
+    with trazas.tramo("alerta.whatsapp", padre=p.get("traza"), alerta_id=p["alerta_id"]):
+        return enviar_alerta_whatsapp(
+            p["user_id"], p["user_name"], p["tema"], p["mensaje"], p["alerta_id"], p.get("fecha")
+        )
+
+
+despachador = DespachadorAlertas(
+    db,
+    {"correo": _canal_correo, "whatsapp": _canal_whatsapp},
+    max_intentos=ALERTAS_MAX_INTENTOS,
+    espera_base=ALERTAS_ESPERA_BASE,
+)
+
+
+def encolar_alerta(user_id, user_name, historial, tema_alerta, mensaje_activador, datos_usuario, alerta_id):
+    """Encola la alerta en la bandeja de salida; el despachador la envía en segundo plano."""
+    try:
+        despachador.encolar(alerta_id, {
+            "user_id": user_id,
+            "user_name": user_name,
+            "historial": historial,
+            "tema": tema_alerta,
+            "mensaje": mensaje_activador,
+            "datos_usuario": datos_usuario,
+            "alerta_id": alerta_id,
+            "fecha": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "traza": trazas.contexto(),
+        })
     except Exception as e:
-        logger.error(f"[WhatsApp] Error: {e}")
+        logger.error(f"[Alertas] Error encolando alerta {alerta_id}: {e}")
 
 
 async def responder_info_psicologia(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -804,6 +1246,7 @@ def teclado_facultades():
     ])
 
 
+@estado_conversaciones.envolver
 async def consentimiento_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -815,6 +1258,7 @@ async def consentimiento_callback(update: Update, context: ContextTypes.DEFAULT_
         return
 
     alerta_id = dato_riesgo.get("alerta_id")
+    trazas.enlazar(dato_riesgo.get("traza"), alerta_id=alerta_id)
 
     if query.data == "consent_si":
         context.user_data["estado"] = "esperando_nombre"
@@ -823,7 +1267,7 @@ async def consentimiento_callback(update: Update, context: ContextTypes.DEFAULT_
 
     if query.data == "consent_no":
         context.user_data["estado"] = None
-        enviar_alerta_correo(
+        encolar_alerta(
             user.id,
             user.first_name,
             dato_riesgo["historial"],
@@ -832,14 +1276,7 @@ async def consentimiento_callback(update: Update, context: ContextTypes.DEFAULT_
             None,
             alerta_id,
         )
-        enviar_alerta_whatsapp(
-            user.id,
-            user.first_name,
-            dato_riesgo["tema"],
-            dato_riesgo["mensaje"],
-            alerta_id,
-        )
-        marcar_alerta_enviada(alerta_id, datos_autorizados=0)
+        marcar_datos_autorizados(alerta_id, datos_autorizados=0)
         actualizar_ultima_alerta(user.id)
         await query.edit_message_text("Entiendo.\nSi quieres, podemos seguir hablando de lo que sientes.")
         return
@@ -891,6 +1328,7 @@ async def manejo_datos_usuario(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
 
+@estado_conversaciones.envolver
 async def callback_facultad(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -922,22 +1360,19 @@ async def callback_facultad(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["estado"] = None
         return
     try:
-        conn = sqlite3.connect(db_file)
-        cur = conn.cursor()
-        cur.execute(
+        db.ejecutar(
             "INSERT INTO datos (user_id, nombre, numero, correo_institucional, fecha, facultad) VALUES (?, ?, ?, ?, ?, ?)",
             (user.id, nombre, numero, correo_inst, datetime.now().isoformat(), facultad),
         )
-        conn.commit()
-        conn.close()
     except Exception as e:
         logger.error(f"[Datos] Error guardando datos con facultad: {e}")
 
     dato_riesgo = context.user_data.pop("riesgo_data", {})
     alerta_id = dato_riesgo.get("alerta_id")
+    trazas.enlazar(dato_riesgo.get("traza"), alerta_id=alerta_id)
     datos_usuario = obtener_datos_usuario(user.id)
 
-    enviar_alerta_correo(
+    encolar_alerta(
         user.id,
         user.first_name,
         dato_riesgo.get("historial", []),
@@ -946,15 +1381,7 @@ async def callback_facultad(update: Update, context: ContextTypes.DEFAULT_TYPE):
         datos_usuario,
         alerta_id,
     )
-    enviar_alerta_whatsapp(
-        user.id,
-        user.first_name,
-        dato_riesgo.get("tema", "riesgo"),
-        dato_riesgo.get("mensaje", ""),
-        alerta_id,
-    )
-
-    marcar_alerta_enviada(alerta_id, datos_autorizados=1)
+    marcar_datos_autorizados(alerta_id, datos_autorizados=1)
     actualizar_ultima_alerta(user.id)
 
     context.user_data["estado"] = None
@@ -1005,11 +1432,13 @@ async def callback_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if query.data == "del_yes":
         user_id = query.from_user.id
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM datos WHERE user_id=?", (user_id,))
-        conn.commit()
-        conn.close()
+        db.ejecutar("DELETE FROM datos WHERE user_id=?", (user_id,))
+        # El estado del flujo guarda nombre, número y correo capturados (y riesgo_data).
+        estado_conversaciones.borrar(user_id)
+        context.user_data.clear()
+        despachador.olvidar_datos(user_id)
+        if cache_exportacion:
+            cache_exportacion.borrar(user_id)
         await query.edit_message_text(
             "Tus datos fueron eliminados correctamente.\nPodemos seguir platicando cuando gustes."
         )
@@ -1020,83 +1449,98 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_input = (update.message.text or "").strip()
 
-    historial = obtener_historial_usuario(user.id, limite=7)
-    mensajes = [{
-        "role": "system",
-        "content": (
-            "Eres Serenity, un acompañante emocional cálido y empático. Validas emociones, haces preguntas suaves "
-            "y evitas diagnosticar o medicar. No te salgas del contexto psicologico y bienestar emocional. No respondas preguntas relacionadas a matematicas, programación historia o otras cosas."
-        )
-    }]
-
-    for u_msg, b_msg, _ in historial:
-        mensajes.append({"role": "user", "content": u_msg})
-        mensajes.append({"role": "assistant", "content": b_msg})
-    mensajes.append({"role": "user", "content": user_input})
+    with metricas.Etapa("historial"):
+        turnos = obtener_historial_usuario(user.id, limite=CACHE_HISTORIAL_POR_USUARIO)
+        resumen, hasta_fecha = resumenes.obtener(user.id)
+    mensajes = construir_mensajes(
+        PROMPT_SERENITY, resumen, sin_resumir(turnos, hasta_fecha), user_input,
+        CONTEXTO_TOKENS_CHAT, CONTEXTO_TOKENS_MENSAJE,
+    )
+    historial = turnos[-7:]
 
-    bot_reply = openai_chat(mensajes, temperature=0.7)
+    if MODO_LLM == "combinado":
+        bot_reply, (riesgo, tema, razon, alerta_id) = await responder_y_evaluar(
+            user.id, mensajes, user_input, historial
+        )
+        await registrar_mensaje_db(user.id, user.first_name, user_input, bot_reply)
+        await update.message.reply_text(bot_reply)
+        if riesgo:
+            await atender_riesgo(update, context, historial, user_input, tema, alerta_id)
+    elif RIESGO_EN_PARALELO:
+        tarea_respuesta = asyncio.create_task(responder(update, mensajes))
+        try:
+            riesgo, tema, razon, alerta_id = await detectar_riesgo(user.id, user_input, historial)
+            if riesgo:
+                await atender_riesgo(update, context, historial, user_input, tema, alerta_id)
+        except BaseException:
+            tarea_respuesta.cancel()
+            raise
+        bot_reply = await tarea_respuesta
+        await registrar_mensaje_db(user.id, user.first_name, user_input, bot_reply)
+    else:
+        bot_reply = await responder(update, mensajes)
+        await registrar_mensaje_db(user.id, user.first_name, user_input, bot_reply)
 
-    registrar_mensaje_db(user.id, user.first_name, user_input, bot_reply)
-    await update.message.reply_text(bot_reply)
+        riesgo, tema, razon, alerta_id = await detectar_riesgo(user.id, user_input)
+        if riesgo:
+            await atender_riesgo(update, context, historial, user_input, tema, alerta_id)
 
-    riesgo, tema, razon, alerta_id = detectar_riesgo(user.id, user_input)
-    if riesgo:
-        riesgo_info = {
-            "historial": historial,
-            "tema": tema,
-            "mensaje": user_input,
-            "alerta_id": alerta_id
-        }
-        context.user_data["riesgo_data"] = riesgo_info
+    if cliente_openai():
+        resumenes.programar(user.id)
 
-        if debe_pedir_datos(user.id):
-            await update.message.reply_text(
-                "Lo que compartes es muy importante, por eso quiero que puedas recibir apoyo personalizado,\n"
-                "¿Autorizas a compartir tus datos para que puedan apoyarte directamente?",
-                reply_markup=boton_consentimiento(),
-            )
-        else:
-            datos_usuario = obtener_datos_usuario(user.id)
-            enviar_alerta_correo(
-                user.id,
-                user.first_name,
-                historial,
-                tema,
-                user_input,
-                datos_usuario,
-                alerta_id,
-            )
-            enviar_alerta_whatsapp(
-                user.id,
-                user.first_name,
-                tema,
-                user_input,
-                alerta_id,
-            )
-            marcar_alerta_enviada(alerta_id, datos_autorizados=1)
-            actualizar_ultima_alerta(user.id)
-
-#            await update.message.reply_text(
-#                "Lo que compartes es muy importante.\n"
-#                "He usado los datos que ya me habías autorizado anteriormente para que el área psicopedagógica pueda "
-#                "contactarte y brindarte apoyo.\n\n"
-#                "Si en algún momento quieres que tus datos se eliminen, puedes usar la opción \"Eliminar mis datos\" en /menu."
-#            )
-
-    nivel_dep = detectar_dependencia(user.id)
+    nivel_dep = await detectar_dependencia(user.id)
     if nivel_dep == "alta":
         await update.message.reply_text(
             "Me alegra que podamos hablar, pero también es importante apoyarte en personas cercanas o profesionales.\n"
             "¿Quieres que te comparta algunos recursos?"
         )
 
-    total_msgs = contar_mensajes_usuario(user.id)
-    if total_msgs and total_msgs % 20 == 0:
-        perfil = analizar_perfil_emocional(user.id)
-        if perfil:
-            guardar_perfil_emocional(user.id, perfil)
+
+async def atender_riesgo(update: Update, context: ContextTypes.DEFAULT_TYPE, historial, user_input, tema, alerta_id):
+    """
+    Pide consentimiento o despacha la alerta en cuanto el clasificador de riesgo
+    responde, sin esperar a que termine la respuesta conversacional.
+    """
+    user = update.effective_user
+    riesgo_info = {
+        "historial": historial,
+        "tema": tema,
+        "mensaje": user_input,
+        "alerta_id": alerta_id,
+        # Para enlazar el consentimiento (otro update, otra traza) con esta.
+        "traza": trazas.contexto(),
+    }
+    context.user_data["riesgo_data"] = riesgo_info
+
+    if debe_pedir_datos(user.id):
+        await update.message.reply_text(
+            "Lo que compartes es muy importante, por eso quiero que puedas recibir apoyo personalizado,\n"
+            "¿Autorizas a compartir tus datos para que puedan apoyarte directamente?",
+            reply_markup=boton_consentimiento(),
+        )
+    else:
+        datos_usuario = obtener_datos_usuario(user.id)
+        encolar_alerta(
+            user.id,
+            user.first_name,
+            historial,
+            tema,
+            user_input,
+            datos_usuario,
+            alerta_id,
+        )
+        marcar_datos_autorizados(alerta_id, datos_autorizados=1)
+        actualizar_ultima_alerta(user.id)
+
+#        await update.message.reply_text(
+#            "Lo que compartes es muy importante.\n"
+#            "He usado los datos que ya me habías autorizado anteriormente para que el área psicopedagógica pueda "
+#            "contactarte y brindarte apoyo.\n\n"
+#            "Si en algún momento quieres que tus datos se eliminen, puedes usar la opción \"Eliminar mis datos\" en /menu."
+#        )
 
 
+@estado_conversaciones.envolver
 async def manejar_mensaje(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("estado") in ["esperando_nombre", "esperando_numero", "esperando_correo", "esperando_facultad"]:
         await manejo_datos_usuario(update, context)
@@ -1104,7 +1548,6 @@ async def manejar_mensaje(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await chat(update, context)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    crear_base_datos()
     await update.message.reply_text(
         "<b>Aviso de privacidad</b>\n\n"
         "Hola 👋 Soy <b>Serenity</b>, un acompañante emocional.\n\n"
@@ -1114,64 +1557,252 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Gracias por tu confianza.",
         parse_mode="HTML"
     )
-    
-import asyncio
-from flask import Flask, request
+
 
 WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")
 WEBHOOK_PATH = f"/webhook/{TOKEN_TELEGRAM}"
 WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
-
-flask_app = Flask(__name__)
+WEBHOOK_PUERTO = int(os.getenv("PORT", "10000"))
+WEBHOOK_COLA_MAX = int(os.getenv("WEBHOOK_COLA_MAX", "1000"))
+# Updates procesados a la vez (usuarios distintos); los de un mismo usuario van en orden.
+UPDATES_CONCURRENTES = int(os.getenv("UPDATES_CONCURRENTES", "16"))
 
 telegram_app = None
 
 
-@flask_app.route("/", methods=["GET"])
-def home():
-    return "Serenity está vivo 💙", 200
-
-
-@flask_app.route(WEBHOOK_PATH, methods=["POST"])
-def webhook_handler():
-    if request.method == "POST":
-        try:
-            update = Update.de_json(request.get_json(force=True), telegram_app.bot)
-            telegram_app.update_queue.put_nowait(update)
-        except Exception as e:
-            logger.error(f"[Webhook] Error al procesar actualización: {e}")
-        return "OK", 200
-
-
 async def configurar_webhook():
     await telegram_app.bot.delete_webhook()
     await telegram_app.bot.set_webhook(url=WEBHOOK_URL)
     logger.info(f"🌐 Webhook configurado en: {WEBHOOK_URL}")
 
-async def main():
+def registrar_handlers(app):
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("menu", comando_menu))
+    app.add_handler(CallbackQueryHandler(callback_menu, pattern="menu_.*|del_.*"))
+    app.add_handler(CallbackQueryHandler(consentimiento_callback, pattern="consent_.*"))
+    app.add_handler(CallbackQueryHandler(callback_facultad, pattern="fac_.*"))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, manejar_mensaje))
+
+
+def archivo_trazas():
+    """Cada worker escribe su propio archivo (trazas.worker0.jsonl, ...) para no intercalar líneas."""
+    if not TRAZAS_ARCHIVO or SERENITY_MODO != "worker":
+        return TRAZAS_ARCHIVO
+    base, extension = os.path.splitext(TRAZAS_ARCHIVO)
+    return f"{base}.worker{SERENITY_WORKER}{extension}"
+
+
+def iniciar_servicios(compartidos=True):
+    """
+    Arranca las tareas de segundo plano (escritor, alertas, contadores, archivo,
+    perfiles). Las `compartidas` (bandeja de alertas, archivo y perfiles)
+    recorren toda la base y corren en un solo proceso: el único o el ingreso.
+    """
+    trazas.configurar(archivo_trazas(), TRAZAS_MUESTREO, TRAZAS_LENTO_MS)
+    escritor.iniciar()
+    contadores_dependencia.iniciar()
+    if not compartidos:
+        return
+    despachador.iniciar()
+    if ARCHIVO_DIAS:
+        archivador.iniciar()
+    if cliente_openai():
+        planificador_perfiles.iniciar()
+
+
+async def detener_servicios():
+    """Detiene las tareas de segundo plano; el escritor al final para volcar lo pendiente."""
+    await despachador.detener()
+    await contadores_dependencia.detener()
+    await planificador_perfiles.detener()
+    await archivador.detener()
+    await escritor.detener()
+    trazas.cerrar()
+
+
+def registrar_medidores(planificador, servidor=None):
+    """Valores que /metrics lee en cada scrape (no cuestan nada en el camino caliente)."""
+    metricas.medidor("serenity_updates_pendientes", "Updates en cola esperando handler.",
+                     lambda: planificador.pendientes)
+    metricas.medidor("serenity_updates_en_proceso", "Updates ejecutándose en un handler.",
+                     lambda: planificador.en_proceso)
+    metricas.medidor("serenity_updates_usuarios_en_cola", "Usuarios con updates en cola.",
+                     lambda: planificador.estadisticas(top=0)["usuarios_en_cola"])
+    metricas.medidor("serenity_alertas_pendientes", "Envíos de alerta pendientes en la bandeja de salida.",
+                     lambda: {(canal,): n for canal, n in db.todos(
+                         "SELECT canal, COUNT(*) FROM alertas_envios WHERE estado='pendiente' GROUP BY canal")},
+                     etiquetas=("canal",))
+    metricas.medidor("serenity_openai_en_cola", "Llamadas al modelo esperando turno, por prioridad.",
+                     lambda: planificador_llm.estadisticas()["en_cola_por_prioridad"], etiquetas=("prioridad",))
+    metricas.medidor("serenity_escritor_pendientes", "Sentencias esperando el próximo group commit.",
+                     lambda: escritor.estadisticas()["pendientes"])
+    metricas.medidor("serenity_sqlite_esperas_bloqueo_total", "Veces que se esperó el bloqueo de la conexión SQLite.",
+                     lambda: db.bloqueo.esperas, tipo="counter")
+    metricas.medidor("serenity_sqlite_espera_bloqueo_segundos_total", "Segundos esperando el bloqueo de SQLite.",
+                     lambda: db.bloqueo.segundos, tipo="counter")
+    if servidor is not None:
+        metricas.medidor("serenity_webhook_rechazadas_total", "Updates rechazados con 429 por cola llena.",
+                         lambda: servidor.rechazadas, tipo="counter")
+
+
+def registrar_medidores_ingreso(enrutador, servidor, supervisor=None):
+    metricas.medidor("serenity_ingreso_en_cola", "Updates esperando reenvío, por worker.",
+                     lambda: {(url,): w["en_cola"] for url, w in enrutador.estadisticas()["workers"].items()},
+                     etiquetas=("worker",))
+    metricas.medidor("serenity_ingreso_reenviados_total", "Updates entregados a cada worker.",
+                     lambda: {(url,): n for url, n in enrutador.reenviados.items()},
+                     etiquetas=("worker",), tipo="counter")
+    metricas.medidor("serenity_ingreso_reintentos_total", "Reenvíos fallidos (worker ocupado o caído).",
+                     lambda: enrutador.reintentos, tipo="counter")
+    metricas.medidor("serenity_webhook_rechazadas_total", "Updates rechazados con 429 por cola llena.",
+                     lambda: servidor.rechazadas, tipo="counter")
+    if supervisor is not None:
+        metricas.medidor("serenity_workers_reinicios_total", "Veces que se relanzó un worker.",
+                         lambda: supervisor.reinicios, tipo="counter")
+
+
+def crear_aplicacion(planificador=None):
+    constructor = Application.builder().token(TOKEN_TELEGRAM)
+    if TELEGRAM_API_URL:
+        constructor = constructor.base_url(f"{TELEGRAM_API_URL}/bot")
+    if planificador is not None:
+        constructor = constructor.concurrent_updates(planificador)
+    return constructor.build()
+
+
+def esperar_senal():
+    """Evento que se activa con SIGTERM/SIGINT (el supervisor y Render detienen con SIGTERM)."""
+    import signal
+
+    evento = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for senal in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(senal, evento.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    return evento
+
+
+async def ejecutar_bot(detener):
+    """Modo único (todo en un proceso) o worker (recibe updates ya repartidos por el ingreso)."""
     global telegram_app
 
-    crear_base_datos()
+    worker = SERENITY_MODO == "worker"
+    planificador = PlanificadorPorUsuario(UPDATES_CONCURRENTES, capacidad=WEBHOOK_COLA_MAX)
+    telegram_app = crear_aplicacion(planificador=planificador)
+    planificador.conectar(telegram_app)
+    registrar_handlers(telegram_app)
 
-    if not TOKEN_TELEGRAM:
-        raise RuntimeError("Falta TELEGRAM_TOKEN en variables de entorno")
+    await telegram_app.initialize()
+    if not worker:
+        await configurar_webhook()
+    await telegram_app.start()
+    iniciar_servicios(compartidos=not worker)
+
+    servidor = arranque.importar("servidor_webhook").ServidorWebhook(
+        decodificar=lambda datos: Update.de_json(datos, telegram_app.bot),
+        destino=planificador,
+        ruta=WEBHOOK_PATH,
+        host=WORKER_HOST if worker else "0.0.0.0",
+        puerto=WEBHOOK_PUERTO,
+        metricas=metricas.exponer,
+    )
+    registrar_medidores(planificador, servidor)
+    await servidor.iniciar()
+    arranque.reporte_arranque()
+    if worker:
+        vigilancia = asyncio.create_task(arranque.importar("enrutador").vigilar_supervisor(detener))
 
-    telegram_app = Application.builder().token(TOKEN_TELEGRAM).build()
+    try:
+        await detener.wait()
+    finally:
+        if worker:
+            vigilancia.cancel()
+        await servidor.detener()
+        await detener_servicios()
+        await telegram_app.stop()
+        await telegram_app.shutdown()
+
+
+def decodificar_ingreso(datos):
+    """El ingreso solo necesita la clave de usuario; reenvía el JSON tal como llegó."""
+    return clave_usuario(Update.de_json(datos, None)), datos
+
+
+async def ejecutar_ingreso(detener):
+    """
+    Recibe el webhook de Telegram y reparte cada update a su worker. Corre
+    también las tareas compartidas (alertas, archivo, perfiles); los workers
+    atienden los handlers y escriben en la misma base SQLite (WAL).
+    """
+    global telegram_app
 
-    telegram_app.add_handler(CommandHandler("start", start))
-    telegram_app.add_handler(CommandHandler("menu", comando_menu))
-    telegram_app.add_handler(CallbackQueryHandler(callback_menu, pattern="menu_.*|del_.*"))
-    telegram_app.add_handler(CallbackQueryHandler(consentimiento_callback, pattern="consent_.*"))
-    telegram_app.add_handler(CallbackQueryHandler(callback_facultad, pattern="fac_.*"))
-    telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, manejar_mensaje))
+    enrutador_mod = arranque.importar("enrutador")
+    supervisor = None
+    urls = WORKERS_URLS
+    if not urls:
+        supervisor = enrutador_mod.SupervisorWorkers(
+            SERENITY_WORKERS, WORKERS_PUERTO_BASE, os.path.abspath(__file__), host=WORKER_HOST
+        )
+        urls = supervisor.urls()
+        supervisor.iniciar()
+    enrutador = enrutador_mod.Enrutador(urls, WEBHOOK_PATH, capacidad=WEBHOOK_COLA_MAX)
+    enrutador.iniciar()
+
+    despachador.intervalo = min(despachador.intervalo, ALERTAS_INTERVALO_INGRESO)
+    iniciar_servicios()
+
+    servidor = arranque.importar("servidor_webhook").ServidorWebhook(
+        decodificar=decodificar_ingreso,
+        destino=enrutador,
+        ruta=WEBHOOK_PATH,
+        puerto=WEBHOOK_PUERTO,
+        metricas=metricas.exponer,
+    )
+    registrar_medidores_ingreso(enrutador, servidor, supervisor)
+    await servidor.iniciar()
 
+    telegram_app = crear_aplicacion()
     await telegram_app.initialize()
     await configurar_webhook()
-    await telegram_app.start()
+    logger.info(f"[Ingreso] Repartiendo updates entre {len(urls)} workers")
+    arranque.reporte_arranque()
 
-    flask_app.run(host="0.0.0.0", port=10000)
+    try:
+        await detener.wait()
+    finally:
+        await servidor.detener()
+        await enrutador.detener()
+        if supervisor is not None:
+            await supervisor.detener()
+        await detener_servicios()
+        await telegram_app.shutdown()
+
+
+async def main():
+    crear_base_datos()
+
+    if not TOKEN_TELEGRAM:
+        raise RuntimeError("Falta TELEGRAM_TOKEN en variables de entorno")
+
+    if SERENITY_MODO != "unico":
+        logger.info(
+            f"[OpenAI] Límites de este proceso: {planificador_llm.solicitudes.capacidad} rpm, "
+            f"{planificador_llm.tokens.capacidad} tpm ({fraccion_limites_openai():.0%} de la organización)"
+        )
+    detener = esperar_senal()
+    try:
+        if SERENITY_MODO == "ingreso":
+            await ejecutar_ingreso(detener)
+        else:
+            await ejecutar_bot(detener)
+    finally:
+        db.cerrar()
 
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
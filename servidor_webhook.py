@@ -0,0 +1,77 @@
+import logging
+
+from aiohttp import web
+
+logger = logging.getLogger("serenity.webhook")
+
+
+class ServidorWebhook:
+    """
+    Servidor HTTP asyncio para el webhook de Telegram, en el mismo loop que
+    la Application.
+
+    Cada POST se decodifica y se entrega a `destino.encolar(update)`, que no
+    bloquea y devuelve False si su cola acotada está llena; en ese caso se
+    responde 429 (Telegram reintenta más tarde). Mientras el servidor arranca
+    o se detiene se responde 503. GET / devuelve `destino.estadisticas()`
+    para health checks y, si se pasa `metricas` (una función que devuelve el
+    texto), GET /metrics las expone en formato Prometheus.
+    """
+
+    def __init__(self, decodificar, destino, ruta, host="0.0.0.0", puerto=10000, metricas=None):
+        self.decodificar = decodificar
+        self.metricas = metricas
+        self.destino = destino
+        self.ruta = ruta
+        self.host = host
+        self.puerto = puerto
+        self.rechazadas = 0
+        self.aceptando = False
+        self._runner = None
+
+    def crear_app(self):
+        app = web.Application(client_max_size=1024 * 1024)
+        app.router.add_get("/", self.salud)
+        if self.metricas:
+            app.router.add_get("/metrics", self.exponer_metricas)
+        app.router.add_post(self.ruta, self.recibir)
+        return app
+
+    async def iniciar(self):
+        self._runner = web.AppRunner(self.crear_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.puerto).start()
+        self.aceptando = True
+        logger.info(f"[Webhook] Escuchando en {self.host}:{self.puerto}")
+
+    async def detener(self, espera=10):
+        """Deja de aceptar, espera a que se vacíe la cola (hasta `espera` segundos) y cierra."""
+        self.aceptando = False
+        await self.destino.vaciar(espera)
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def recibir(self, request):
+        if not self.aceptando:
+            return web.Response(status=503, headers={"Retry-After": "5"})
+        try:
+            update = self.decodificar(await request.json())
+        except Exception as e:
+            logger.error(f"[Webhook] Actualización inválida: {e}")
+            return web.Response(status=400)
+        if not self.destino.encolar(update):
+            self.rechazadas += 1
+            logger.warning("[Webhook] Cola llena, se rechaza la actualización")
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        return web.Response(text="OK")
+
+    async def exponer_metricas(self, request):
+        return web.Response(
+            body=self.metricas().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    async def salud(self, request):
+        estado = {"estado": "ok" if self.aceptando else "detenido", "rechazadas": self.rechazadas}
+        estado.update(self.destino.estadisticas())
+        return web.json_response(estado, status=200 if self.aceptando else 503)
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# Los módulos del bot viven en la raíz del repositorio (sin paquete).
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from basedatos import ConexionSQLite  # noqa: E402
+from migraciones import aplicar_migraciones  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Base temporal con todas las migraciones aplicadas."""
+    conexion = ConexionSQLite(str(tmp_path / "serenity.db"))
+    aplicar_migraciones(conexion)
+    yield conexion
+    conexion.cerrar()
@@ -0,0 +1,72 @@
+import os
+from datetime import datetime, timedelta
+
+from archivo import Archivador, historial_completo, ruta_mes
+
+
+def _conversar(db, user_id, fechas):
+    db.ejecutar("INSERT OR IGNORE INTO usuarios (id, user_name) VALUES (?, ?)", (user_id, f"u{user_id}"))
+    for i, fecha in enumerate(fechas):
+        db.ejecutar(
+            "INSERT INTO conversaciones (user_id, user_message, bot_message, timestamp) VALUES (?, ?, 'r', ?)",
+            (user_id, f"m{i}", fecha.isoformat()),
+        )
+
+
+def _historial(db, directorio, user_id, desde_id=0):
+    with db.lector() as conn:
+        return list(historial_completo(conn, directorio, user_id, desde_id))
+
+
+def _poblar(db):
+    viejas = [datetime(2025, 1, 5), datetime(2025, 1, 20), datetime(2025, 2, 3), datetime(2025, 3, 9)]
+    recientes = [datetime.now() - timedelta(days=1), datetime.now()]
+    # Intercalados como llegarían: los timestamps crecen con el id.
+    for fecha in viejas:
+        _conversar(db, 1, [fecha])
+        _conversar(db, 2, [fecha])
+    for fecha in recientes:
+        _conversar(db, 1, [fecha])
+        _conversar(db, 2, [fecha])
+
+
+def test_archivar_no_cambia_el_historial_completo(db, tmp_path):
+    directorio = str(tmp_path / "archivo")
+    _poblar(db)
+    antes = {u: _historial(db, directorio, u) for u in (1, 2)}
+
+    archivador = Archivador(db, directorio, dias=180, lote=3)
+    assert archivador.archivar() == 8
+    assert archivador.archivar() == 0
+
+    assert db.uno("SELECT COUNT(*) FROM conversaciones")[0] == 4
+    assert sorted(os.listdir(directorio)) == [
+        "conversaciones_2025-01.db", "conversaciones_2025-02.db", "conversaciones_2025-03.db",
+    ]
+    assert db.todos("SELECT mes, filas FROM archivo_conversaciones WHERE user_id=1 ORDER BY mes") == [
+        ("2025-01", 2), ("2025-02", 1), ("2025-03", 1),
+    ]
+    for user_id in (1, 2):
+        assert _historial(db, directorio, user_id) == antes[user_id]
+        # desde_id se respeta también en los meses archivados.
+        desde = antes[user_id][1][0]
+        assert _historial(db, directorio, user_id, desde) == antes[user_id][2:]
+
+
+def test_archivado_interrumpido_no_duplica_filas(db, tmp_path):
+    directorio = str(tmp_path / "archivo")
+    _poblar(db)
+    antes = _historial(db, directorio, 1)
+
+    archivador = Archivador(db, directorio, dias=180)
+    # Corte entre la copia y la transacción que borra y registra el catálogo.
+    filas = db.todos("SELECT id, user_id, user_message, bot_message, timestamp FROM conversaciones "
+                     "WHERE timestamp < '2025-02'")
+    archivador._copiar("2025-01", filas)
+    assert _historial(db, directorio, 1) == antes
+
+    # La siguiente pasada termina el trabajo sin duplicar.
+    archivador.archivar()
+    assert _historial(db, directorio, 1) == antes
+    assert db.uno("SELECT filas FROM archivo_conversaciones WHERE user_id=1 AND mes='2025-01'")[0] == 2
+    assert os.path.isfile(ruta_mes(directorio, "2025-01"))
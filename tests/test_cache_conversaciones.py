@@ -0,0 +1,116 @@
+from datetime import datetime
+
+import cache_conversaciones
+from cache_conversaciones import CacheVentanas, _tamano
+
+
+class Reloj:
+    def __init__(self):
+        self.ahora = 1000.0
+
+    def monotonic(self):
+        return self.ahora
+
+
+def _cargador(filas_por_usuario):
+    llamadas = []
+
+    def cargar(user_id, limite):
+        llamadas.append((user_id, limite))
+        return filas_por_usuario.get(user_id, [])[-limite:]
+
+    cargar.llamadas = llamadas
+    return cargar
+
+
+def _filas(n, texto="mensaje"):
+    return [(f"{texto} {i}", f"respuesta {i}", f"2026-01-01T00:00:{i:02d}") for i in range(n)]
+
+
+def test_desaloja_por_cantidad_de_usuarios_en_orden_lru():
+    cargar = _cargador({1: _filas(3), 2: _filas(3), 3: _filas(3)})
+    cache = CacheVentanas(cargar, por_usuario=5, max_usuarios=2)
+    cache.obtener(1, 5)
+    cache.obtener(2, 5)
+    cache.obtener(1, 5)  # 1 pasa a ser el más reciente
+    cache.obtener(3, 5)  # sale 2
+
+    assert cache.estadisticas()["usuarios"] == 2
+    cargar.llamadas.clear()
+    cache.obtener(1, 5)
+    cache.obtener(3, 5)
+    assert cargar.llamadas == []
+    cache.obtener(2, 5)
+    assert cargar.llamadas == [(2, 5)]
+
+
+def test_desaloja_por_bytes():
+    filas = _filas(4)
+    por_usuario = sum(_tamano(f) for f in filas)
+    cargar = _cargador({1: filas, 2: filas, 3: filas})
+    cache = CacheVentanas(cargar, por_usuario=10, max_bytes=2 * por_usuario)
+    for user_id in (1, 2, 3):
+        cache.obtener(user_id, 10)
+
+    estadisticas = cache.estadisticas()
+    assert estadisticas["usuarios"] == 2
+    assert estadisticas["bytes"] == 2 * por_usuario
+
+    # Un turno más en la ventana de 3 excede el tope y desaloja a 2.
+    cache.agregar(3, ("otro", "más", "2026-01-01T00:01:00"))
+    assert cache.estadisticas()["usuarios"] == 1
+    assert cache.estadisticas()["bytes"] <= cache.max_bytes
+
+
+def test_expira_por_ttl(monkeypatch):
+    reloj = Reloj()
+    monkeypatch.setattr(cache_conversaciones, "time", reloj)
+    cargar = _cargador({1: _filas(2), 2: _filas(2)})
+    cache = CacheVentanas(cargar, por_usuario=5, ttl=60)
+    cache.obtener(1, 5)
+    reloj.ahora += 30
+    cache.obtener(2, 5)
+
+    reloj.ahora += 45  # 1 lleva 75 s sin uso, 2 lleva 45 s
+    cache.purgar()
+    assert cache.estadisticas()["usuarios"] == 1
+
+    cargar.llamadas.clear()
+    cache.obtener(2, 5)
+    assert cargar.llamadas == []
+    reloj.ahora += 61
+    cache.obtener(2, 5)
+    assert cargar.llamadas == [(2, 5)]
+
+
+def test_write_through_coincide_con_la_base(db):
+    db.ejecutar("INSERT INTO usuarios (id, user_name) VALUES (1, 'u1')")
+
+    def historial_db(user_id, limite):
+        filas = db.todos(
+            "SELECT user_message, bot_message, timestamp FROM conversaciones "
+            "WHERE user_id=? ORDER BY id DESC LIMIT ?",
+            (user_id, limite),
+        )
+        return filas[::-1]
+
+    def guardar(i):
+        fila = (f"hola {i}", f"respuesta {i}", datetime(2026, 1, 1, 0, 0, i).isoformat())
+        db.ejecutar(
+            "INSERT INTO conversaciones (user_id, user_message, bot_message, timestamp) VALUES (1, ?, ?, ?)",
+            fila,
+        )
+        cache.agregar(1, fila)
+
+    cache = CacheVentanas(historial_db, por_usuario=4)
+    for i in range(2):
+        guardar(i)
+    assert cache.obtener(1, 4) == historial_db(1, 4)
+
+    # La ventana se llena y empieza a rotar sin volver a la base.
+    for i in range(2, 7):
+        guardar(i)
+        for limite in (1, 3, 4):
+            assert cache.obtener(1, limite) == historial_db(1, limite)
+    assert cache.estadisticas()["fallos"] == 1
+    assert cache.estadisticas()["bytes"] == sum(_tamano(f) for f in historial_db(1, 4))
@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+from contadores import ContadoresEnLote
+
+LEER = "SELECT contador_mensajes FROM dependencias WHERE user_id=?"
+ESCRIBIR = """
+    INSERT INTO dependencias (user_id, nivel_dependencia, ultima_evaluacion, contador_mensajes)
+    VALUES (?1, 'baja', ?3, ?2)
+    ON CONFLICT(user_id) DO UPDATE SET contador_mensajes=excluded.contador_mensajes
+"""
+
+
+def _en_base(db, user_id):
+    fila = db.uno(LEER, (user_id,))
+    return fila[0] if fila else None
+
+
+def test_volcar_escribe_los_totales_incrementados(db):
+    contadores = ContadoresEnLote(db, LEER, ESCRIBIR)
+    for _ in range(3):
+        contadores.incrementar(1)
+    contadores.incrementar(2, 5)
+    assert _en_base(db, 1) is None
+
+    assert contadores.volcar() == 2
+    assert (_en_base(db, 1), _en_base(db, 2)) == (3, 5)
+    assert contadores.volcar() == 0
+
+    # Tras volcar se relee el valor de la base y se sigue sumando.
+    assert contadores.incrementar(1) == 4
+    contadores.volcar()
+    assert _en_base(db, 1) == 4
+
+
+def test_se_vuelca_al_llegar_a_max_pendientes(db):
+    contadores = ContadoresEnLote(db, LEER, ESCRIBIR, max_pendientes=3)
+    contadores.incrementar(1)
+    contadores.incrementar(2)
+    assert _en_base(db, 1) is None
+    contadores.incrementar(3)
+    assert [_en_base(db, u) for u in (1, 2, 3)] == [1, 1, 1]
+
+
+def test_un_volcado_fallido_conserva_los_incrementos(db, monkeypatch):
+    contadores = ContadoresEnLote(db, LEER, ESCRIBIR)
+    contadores.incrementar(1, 2)
+
+    def falla():
+        raise RuntimeError("base ocupada")
+
+    with monkeypatch.context() as m:
+        m.setattr(db, "transaccion", falla)
+        with pytest.raises(RuntimeError):
+            contadores.volcar()
+
+    contadores.incrementar(1)
+    assert contadores.volcar() == 1
+    assert _en_base(db, 1) == 3
+
+
+def test_incrementos_concurrentes_con_volcados(db):
+    contadores = ContadoresEnLote(db, LEER, ESCRIBIR)
+    hilos, por_hilo = 4, 300
+    listo = threading.Event()
+
+    def incrementar():
+        for _ in range(por_hilo):
+            contadores.incrementar(1)
+
+    def volcar():
+        while not listo.is_set():
+            contadores.volcar()
+
+    volcador = threading.Thread(target=volcar)
+    volcador.start()
+    trabajadores = [threading.Thread(target=incrementar) for _ in range(hilos)]
+    for hilo in trabajadores:
+        hilo.start()
+    for hilo in trabajadores:
+        hilo.join()
+    listo.set()
+    volcador.join()
+    contadores.volcar()
+
+    assert _en_base(db, 1) == hilos * por_hilo
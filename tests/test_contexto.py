@@ -0,0 +1,77 @@
+import asyncio
+
+from contexto import ResumenesConversacion, ajustar_turnos, contar_tokens, sin_resumir
+
+
+def _turnos(n):
+    return [(f"mensaje {i}", f"respuesta {i}", f"2026-01-01T00:00:{i:02d}") for i in range(n)]
+
+
+def _costo(turno):
+    return contar_tokens(turno[0]) + contar_tokens(turno[1]) + 8
+
+
+def test_ajustar_turnos_conserva_los_mas_recientes_en_orden():
+    turnos = _turnos(10)
+    presupuesto = sum(_costo(t) for t in turnos[-3:])
+    assert ajustar_turnos(turnos, presupuesto, 100) == turnos[-3:]
+    assert ajustar_turnos(turnos, presupuesto - 1, 100) == turnos[-2:]
+    assert ajustar_turnos(turnos, 0, 100) == []
+    assert ajustar_turnos(turnos, 10_000, 100) == turnos
+
+
+def test_ajustar_turnos_recorta_mensajes_largos():
+    largo = "palabra " * 500
+    elegidos = ajustar_turnos([(largo, "ok", "2026-01-01")], 1000, 20)
+    assert len(elegidos) == 1
+    assert elegidos[0][0].endswith("[…]")
+    assert contar_tokens(elegidos[0][0]) <= 25
+    assert elegidos[0][1:] == ("ok", "2026-01-01")
+
+
+def test_sin_resumir_descarta_lo_incluido_en_el_resumen():
+    turnos = _turnos(5)
+    assert sin_resumir(turnos, None) == turnos
+    assert sin_resumir(turnos, turnos[2][2]) == turnos[3:]
+    assert sin_resumir(turnos, "2027-01-01") == []
+
+
+def _conversar(db, user_id, i):
+    db.ejecutar("INSERT OR IGNORE INTO usuarios (id, user_name) VALUES (?, ?)", (user_id, f"u{user_id}"))
+    db.ejecutar(
+        "INSERT INTO conversaciones (user_id, user_message, bot_message, timestamp) VALUES (?, 'm', 'r', ?)",
+        (user_id, f"2026-01-01T00:00:{i:02d}"),
+    )
+
+
+def test_programar_solo_consulta_la_base_cuando_toca(db):
+    consultas = []
+    uno = db.uno
+
+    def uno_contado(sentencia, params=()):
+        consultas.append(sentencia)
+        return uno(sentencia, params)
+
+    db.uno = uno_contado
+    lotes = []
+
+    async def resumir(anterior, filas):
+        lotes.append([f[0] for f in filas])
+        return f"{anterior}+{len(filas)}"
+
+    async def escenario():
+        resumenes = ResumenesConversacion(db, resumir, mantener=2, cada=3)
+        for i in range(1, 13):
+            _conversar(db, 1, i)
+            resumenes.programar(1)
+            await asyncio.gather(*resumenes._tareas)
+        return resumenes
+
+    asyncio.run(escenario())
+    # Solo los mensajes 1, 5, 8 y 11 consultan la base (resumen + conteo); en
+    # los demás la cuenta en memoria dice que todavía no toca.
+    assert len(consultas) == 8
+    assert lotes == [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    resumen, hasta_fecha = ResumenesConversacion(db, resumir).obtener(1)
+    assert resumen == "+3+3+3"
+    assert hasta_fecha == "2026-01-01T00:00:09"
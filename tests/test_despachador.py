@@ -0,0 +1,125 @@
+import json
+import asyncio
+from datetime import datetime, timedelta
+
+from despachador import DespachadorAlertas
+
+
+def _alerta(db, user_id=7):
+    db.ejecutar("INSERT OR IGNORE INTO usuarios (id, user_name) VALUES (?, ?)", (user_id, f"u{user_id}"))
+    return db.ejecutar(
+        "INSERT INTO alertas (usuario_id, tipo_alerta, descripcion, fecha) VALUES (?, 'riesgo', 'x', ?)",
+        (user_id, datetime.now().isoformat()),
+    )
+
+
+def _payload(alerta_id):
+    return {"alerta_id": alerta_id, "datos_usuario": {"nombre": "Ana", "numero": "555"}, "historial": "..."}
+
+
+def _envios(db, alerta_id):
+    filas = db.todos(
+        "SELECT canal, estado, intentos, proximo_intento, ultimo_error, payload FROM alertas_envios "
+        "WHERE alerta_id=? ORDER BY canal",
+        (alerta_id,),
+    )
+    return {f[0]: f[1:] for f in filas}
+
+
+def _vencer(db):
+    """Adelanta el próximo intento de todos los pendientes (sin esperar el backoff)."""
+    db.ejecutar("UPDATE alertas_envios SET proximo_intento=? WHERE estado='pendiente'",
+                (datetime.now().isoformat(),))
+
+
+class CanalFalla:
+    """Canal que lanza una excepción las primeras `fallas` veces y luego entrega."""
+
+    def __init__(self, fallas):
+        self.fallas = fallas
+        self.llamadas = []
+
+    def __call__(self, payload):
+        self.llamadas.append(payload)
+        if len(self.llamadas) <= self.fallas:
+            raise ConnectionError("canal caído")
+        return True
+
+
+def test_reintenta_con_backoff_creciente(db):
+    canal = CanalFalla(fallas=2)
+    despachador = DespachadorAlertas(db, {"correo": canal}, espera_base=10)
+    alerta_id = _alerta(db)
+    despachador.encolar(alerta_id, _payload(alerta_id))
+
+    antes = datetime.now()
+    assert asyncio.run(despachador.procesar_pendientes()) == 1
+    estado, intentos, proximo, error, payload = _envios(db, alerta_id)["correo"]
+    assert (estado, intentos, error) == ("pendiente", 1, "canal caído")
+    assert payload is not None
+    espera = datetime.fromisoformat(proximo) - antes
+    assert timedelta(seconds=8) <= espera <= timedelta(seconds=13)
+
+    # Todavía no vence: no se reintenta.
+    assert asyncio.run(despachador.procesar_pendientes()) == 0
+
+    _vencer(db)
+    antes = datetime.now()
+    asyncio.run(despachador.procesar_pendientes())
+    estado, intentos, proximo, _, _ = _envios(db, alerta_id)["correo"]
+    assert (estado, intentos) == ("pendiente", 2)
+    assert datetime.fromisoformat(proximo) - antes >= timedelta(seconds=16)
+
+    _vencer(db)
+    asyncio.run(despachador.procesar_pendientes())
+    estado, intentos, _, error, payload = _envios(db, alerta_id)["correo"]
+    assert (estado, intentos, error, payload) == ("enviado", 3, None, None)
+    assert len(canal.llamadas) == 3
+
+
+def test_un_canal_entrega_y_otro_falla(db):
+    despachador = DespachadorAlertas(db, {"correo": lambda p: True, "whatsapp": CanalFalla(fallas=99)})
+    alerta_id = _alerta(db)
+    despachador.encolar(alerta_id, _payload(alerta_id))
+
+    assert asyncio.run(despachador.procesar_pendientes()) == 2
+    envios = _envios(db, alerta_id)
+    assert envios["correo"][0] == "enviado"
+    assert envios["whatsapp"][0] == "pendiente"
+    assert envios["whatsapp"][3] == "canal caído"
+    assert envios["whatsapp"][4] is not None
+    assert db.uno("SELECT enviada_correo, enviada_whatsapp FROM alertas WHERE id=?", (alerta_id,)) == (1, 0)
+
+
+def test_estados_finales_borran_el_payload(db):
+    despachador = DespachadorAlertas(
+        db,
+        {"correo": lambda p: False, "whatsapp": CanalFalla(fallas=99)},
+        max_intentos=1,
+    )
+    alerta_id = _alerta(db)
+    despachador.encolar(alerta_id, _payload(alerta_id))
+
+    asyncio.run(despachador.procesar_pendientes())
+    envios = _envios(db, alerta_id)
+    assert envios["correo"][0] == "omitido"
+    assert envios["whatsapp"][0] == "fallido"
+    assert envios["correo"][4] is None and envios["whatsapp"][4] is None
+    assert db.uno("SELECT enviada_correo, enviada_whatsapp FROM alertas WHERE id=?", (alerta_id,)) == (0, 0)
+
+
+def test_olvidar_datos_solo_toca_pendientes_del_usuario(db):
+    despachador = DespachadorAlertas(db, {"correo": lambda p: True, "whatsapp": CanalFalla(fallas=99)})
+    propia = _alerta(db, user_id=7)
+    ajena = _alerta(db, user_id=8)
+    despachador.encolar(propia, _payload(propia))
+    despachador.encolar(ajena, _payload(ajena))
+    asyncio.run(despachador.procesar_pendientes())
+
+    # Quedan pendientes los whatsapp de ambas alertas; solo se limpia el del usuario 7.
+    assert despachador.olvidar_datos(7) == 1
+
+    datos = json.loads(_envios(db, propia)["whatsapp"][4])
+    assert datos["datos_usuario"] is None
+    assert datos["historial"] == "..."
+    assert json.loads(_envios(db, ajena)["whatsapp"][4])["datos_usuario"] == {"nombre": "Ana", "numero": "555"}
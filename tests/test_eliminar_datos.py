@@ -0,0 +1,72 @@
+import os
+import json
+import asyncio
+import importlib
+from types import SimpleNamespace
+
+import pytest
+
+from migraciones import aplicar_migraciones
+
+
+@pytest.fixture(scope="module")
+def serenity(tmp_path_factory):
+    """serenity.py importado con su base apuntando a un archivo temporal."""
+    ruta = str(tmp_path_factory.mktemp("serenity") / "serenity.db")
+    anterior = os.environ.get("SERENITY_DB")
+    os.environ["SERENITY_DB"] = ruta
+    try:
+        modulo = importlib.import_module("serenity")
+    finally:
+        if anterior is None:
+            os.environ.pop("SERENITY_DB", None)
+        else:
+            os.environ["SERENITY_DB"] = anterior
+    assert modulo.db.ruta == ruta
+    aplicar_migraciones(modulo.db)
+    yield modulo
+    modulo.db.cerrar()
+
+
+def _callback(user_id, data):
+    respuestas = []
+
+    async def answer():
+        pass
+
+    async def edit_message_text(texto, **_):
+        respuestas.append(texto)
+
+    query = SimpleNamespace(
+        data=data, from_user=SimpleNamespace(id=user_id), answer=answer, edit_message_text=edit_message_text
+    )
+    return SimpleNamespace(callback_query=query), respuestas
+
+
+def test_del_yes_borra_datos_estado_y_contacto_pendiente(serenity):
+    db = serenity.db
+    user_id = 7
+    db.ejecutar("INSERT INTO usuarios (id, user_name) VALUES (?, 'ana')", (user_id,))
+    db.ejecutar(
+        "INSERT INTO datos (user_id, nombre, numero, correo_institucional, fecha) VALUES (?, 'Ana', '555', 'a@x', '')",
+        (user_id,),
+    )
+    serenity.estado_conversaciones.guardar(
+        user_id, {"estado": "esperando_correo", "nombre": "Ana", "numero": "555"}
+    )
+    alerta_id = db.ejecutar(
+        "INSERT INTO alertas (usuario_id, tipo_alerta, fecha) VALUES (?, 'riesgo', '')", (user_id,)
+    )
+    serenity.despachador.encolar(alerta_id, {"datos_usuario": {"nombre": "Ana"}}, canales=["correo"])
+
+    update, respuestas = _callback(user_id, "del_yes")
+    context = SimpleNamespace(user_data={"estado": "esperando_correo", "nombre": "Ana"})
+    asyncio.run(serenity.callback_menu(update, context))
+
+    assert db.uno("SELECT COUNT(*) FROM datos WHERE user_id=?", (user_id,))[0] == 0
+    assert db.uno("SELECT COUNT(*) FROM estado_conversacion WHERE user_id=?", (user_id,))[0] == 0
+    assert serenity.estado_conversaciones.cargar(user_id) == {}
+    assert context.user_data == {}
+    payload = db.uno("SELECT payload FROM alertas_envios WHERE alerta_id=?", (alerta_id,))[0]
+    assert json.loads(payload)["datos_usuario"] is None
+    assert "eliminados" in respuestas[0]
@@ -0,0 +1,115 @@
+import asyncio
+from collections import Counter
+
+from aiohttp import web
+
+from enrutador import AnilloConsistente, Enrutador
+
+NODOS = [f"http://127.0.0.1:{10100 + i}" for i in range(4)]
+CLAVES = range(20_000)
+
+
+def _asignacion(anillo):
+    return {clave: anillo.nodo(clave) for clave in CLAVES}
+
+
+def test_anillo_es_determinista_y_reparte_parejo():
+    asignacion = _asignacion(AnilloConsistente(NODOS))
+    assert asignacion == _asignacion(AnilloConsistente(list(reversed(NODOS))))
+    por_nodo = Counter(asignacion.values())
+    assert set(por_nodo) == set(NODOS)
+    assert max(por_nodo.values()) < 1.5 * len(CLAVES) / len(NODOS)
+
+
+def test_agregar_un_nodo_solo_mueve_su_parte():
+    antes = _asignacion(AnilloConsistente(NODOS))
+    nuevo = "http://127.0.0.1:10104"
+    despues = _asignacion(AnilloConsistente(NODOS + [nuevo]))
+    movidas = [clave for clave in CLAVES if antes[clave] != despues[clave]]
+    # Toda clave que cambia de dueño va al nodo nuevo, y son ~1/5 del total.
+    assert all(despues[clave] == nuevo for clave in movidas)
+    assert 0.1 < len(movidas) / len(CLAVES) < 0.3
+
+
+def test_quitar_un_nodo_solo_mueve_sus_claves():
+    antes = _asignacion(AnilloConsistente(NODOS))
+    despues = _asignacion(AnilloConsistente(NODOS[:-1]))
+    for clave in CLAVES:
+        if antes[clave] != NODOS[-1]:
+            assert despues[clave] == antes[clave]
+
+
+class Worker:
+    """Webhook de prueba: registra lo recibido y rechaza con 503 los primeros `rechazos` POST."""
+
+    def __init__(self, rechazos=0):
+        self.recibidos = []
+        self.rechazos = rechazos
+        self._runner = None
+        self.url = None
+
+    async def _webhook(self, request):
+        datos = await request.json()
+        if self.rechazos:
+            self.rechazos -= 1
+            return web.Response(status=503, headers={"Retry-After": "0.05"})
+        await asyncio.sleep(0.001)
+        self.recibidos.append(datos)
+        return web.Response(text="ok")
+
+    async def iniciar(self):
+        app = web.Application()
+        app.router.add_post("/webhook", self._webhook)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        sitio = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await sitio.start()
+        puerto = sitio._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{puerto}"
+
+    async def detener(self):
+        await self._runner.cleanup()
+
+
+def test_orden_fifo_por_usuario_con_reintentos():
+    async def escenario():
+        workers = [Worker(rechazos=3), Worker(), Worker(rechazos=1)]
+        for worker in workers:
+            await worker.iniciar()
+        enrutador = Enrutador([w.url for w in workers], "/webhook")
+        enrutador.iniciar()
+        for n in range(30):
+            for user_id in range(1, 9):
+                assert enrutador.encolar((user_id, {"user_id": user_id, "n": n}))
+        await enrutador.vaciar(espera=10)
+        await enrutador.detener()
+        for worker in workers:
+            await worker.detener()
+        return workers, enrutador
+
+    workers, enrutador = asyncio.run(escenario())
+    assert enrutador.pendientes == 0
+    # Los puertos son aleatorios: cuenta solo los 503 que de verdad se devolvieron.
+    assert enrutador.reintentos == 4 - sum(w.rechazos for w in workers)
+    vistos = set()
+    for worker in workers:
+        por_usuario = {}
+        for datos in worker.recibidos:
+            por_usuario.setdefault(datos["user_id"], []).append(datos["n"])
+        for user_id, ns in por_usuario.items():
+            # Cada usuario llega a un solo worker, completo y en orden.
+            assert user_id not in vistos
+            vistos.add(user_id)
+            assert ns == list(range(30))
+    assert vistos == set(range(1, 9))
+
+
+def test_capacidad_llena_rechaza_sin_bloquear():
+    async def escenario():
+        enrutador = Enrutador(["http://127.0.0.1:9"], "/webhook", capacidad=2)
+        enrutador.iniciar()
+        aceptados = [enrutador.encolar((1, {"n": n})) for n in range(3)]
+        await enrutador.detener()
+        return aceptados
+
+    assert asyncio.run(escenario()) == [True, True, False]
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from escritor import EscritorDiferido
+
+
+def _mensaje(user_id, i):
+    return [
+        ("INSERT OR IGNORE INTO usuarios (id, user_name) VALUES (?, ?)", (user_id, f"u{user_id}")),
+        ("INSERT INTO conversaciones (user_id, user_message, bot_message, timestamp) VALUES (?, ?, 'r', '')",
+         (user_id, f"m{i}")),
+    ]
+
+
+INVALIDA = [("INSERT INTO tabla_que_no_existe VALUES (1)", ())]
+
+
+def _confirmados(db, user_id):
+    """Lee con una conexión aparte: solo ve lo que ya se confirmó."""
+    with db.lector() as conn:
+        return [f[0] for f in conn.execute(
+            "SELECT user_message FROM conversaciones WHERE user_id=? ORDER BY id", (user_id,)
+        )]
+
+
+def test_grupo_confirma_antes_de_volver_y_conserva_el_orden(db):
+    async def escenario():
+        escritor = EscritorDiferido(db, modo="grupo")
+        escritor.iniciar()
+
+        async def handler(user_id):
+            for i in range(20):
+                await escritor.escribir(_mensaje(user_id, i))
+                # Al volver escribir() el turno ya está confirmado.
+                assert _confirmados(db, user_id)[-1] == f"m{i}"
+
+        await asyncio.gather(*(handler(u) for u in range(1, 11)))
+        await escritor.detener()
+        return escritor.contadores
+
+    contadores = asyncio.run(escenario())
+    for user_id in range(1, 11):
+        assert _confirmados(db, user_id) == [f"m{i}" for i in range(20)]
+    assert contadores["filas"] == 400
+    # Los handlers comparten commits.
+    assert contadores["commits"] < 200
+
+
+def test_diferido_vuelca_todo_al_detener(db):
+    async def escenario():
+        escritor = EscritorDiferido(db, modo="diferido", max_espera_ms=50)
+        escritor.iniciar()
+        for i in range(30):
+            await escritor.escribir(_mensaje(1, i))
+        await escritor.detener()
+
+    asyncio.run(escenario())
+    assert _confirmados(db, 1) == [f"m{i}" for i in range(30)]
+
+
+def test_grupo_aisla_la_operacion_que_falla(db):
+    async def escenario():
+        escritor = EscritorDiferido(db, modo="grupo", max_espera_ms=50)
+        escritor.iniciar()
+        resultados = await asyncio.gather(
+            escritor.escribir(_mensaje(1, 0)),
+            escritor.escribir(INVALIDA),
+            escritor.escribir(_mensaje(1, 1)),
+            return_exceptions=True,
+        )
+        await escritor.detener()
+        return resultados, escritor.contadores
+
+    resultados, contadores = asyncio.run(escenario())
+    assert resultados[0] is None and resultados[2] is None
+    assert "tabla_que_no_existe" in str(resultados[1])
+    assert _confirmados(db, 1) == ["m0", "m1"]
+    assert contadores["errores"] == 1
+
+
+def test_diferido_descarta_solo_la_operacion_invalida(db):
+    async def escenario():
+        escritor = EscritorDiferido(db, modo="diferido", max_espera_ms=50)
+        escritor.iniciar()
+        await escritor.escribir(_mensaje(1, 0))
+        await escritor.escribir(INVALIDA)
+        await escritor.escribir(_mensaje(1, 1))
+        await escritor.detener()
+        return escritor.contadores
+
+    contadores = asyncio.run(escenario())
+    assert _confirmados(db, 1) == ["m0", "m1"]
+    assert contadores["errores"] == 1
+
+
+def test_inmediato_propaga_el_error(db):
+    async def escenario():
+        escritor = EscritorDiferido(db, modo="inmediato")
+        await escritor.escribir(_mensaje(1, 0))
+        with pytest.raises(Exception, match="tabla_que_no_existe"):
+            await escritor.escribir(INVALIDA)
+
+    asyncio.run(escenario())
+    assert _confirmados(db, 1) == ["m0"]
@@ -0,0 +1,63 @@
+import os
+import csv
+import io
+import time
+
+from exportacion import CacheExportacion, exportar_conversaciones
+
+
+def _conversar(db, user_id, n):
+    db.ejecutar("INSERT OR IGNORE INTO usuarios (id, user_name) VALUES (?, ?)", (user_id, f"u{user_id}"))
+    for i in range(n):
+        db.ejecutar(
+            "INSERT INTO conversaciones (user_id, user_message, bot_message, timestamp) VALUES (?, ?, ?, ?)",
+            (user_id, f"hola {i}", f"respuesta {i}", f"2026-01-01T00:00:{i:02d}"),
+        )
+
+
+def _csv(db, user_id, cache=None):
+    datos, _, _ = exportar_conversaciones(db, user_id, formato="csv", cache=cache)
+    return list(csv.reader(io.StringIO(datos.decode("utf-8-sig"))))
+
+
+def test_cache_incremental_igual_a_exportar_directo(db, tmp_path):
+    cache = CacheExportacion(str(tmp_path / "exportaciones"))
+    _conversar(db, 1, 3)
+    assert _csv(db, 1, cache) == _csv(db, 1)
+    _conversar(db, 1, 2)
+    filas = _csv(db, 1, cache)
+    assert filas == _csv(db, 1)
+    assert len(filas) == 6
+
+
+def test_borrar_elimina_la_cache_del_usuario(db, tmp_path):
+    cache = CacheExportacion(str(tmp_path / "exportaciones"))
+    _conversar(db, 1, 2)
+    _conversar(db, 2, 2)
+    _csv(db, 1, cache)
+    _csv(db, 2, cache)
+
+    cache.borrar(1)
+    assert sorted(os.listdir(cache.directorio)) == ["conversaciones_2.csv", "conversaciones_2.json"]
+    # Se reconstruye completa en la siguiente exportación.
+    assert _csv(db, 1, cache) == _csv(db, 1)
+
+
+def test_podar_por_antiguedad_y_tamano(db, tmp_path):
+    cache = CacheExportacion(str(tmp_path / "exportaciones"), max_dias=1)
+    for user_id in (1, 2, 3):
+        _conversar(db, user_id, 5)
+        cache.sincronizar(db, user_id)
+
+    hace_dos_dias = time.time() - 2 * 86400
+    os.utime(cache._rutas(1)[1], (hace_dos_dias, hace_dos_dias))
+    assert cache.podar() == 1
+    assert not os.path.exists(cache._rutas(1)[0])
+
+    # Con un tope menor que lo que ocupan 2 y 3 se va el usado hace más tiempo.
+    hace_una_hora = time.time() - 3600
+    os.utime(cache._rutas(2)[1], (hace_una_hora, hace_una_hora))
+    cache.max_bytes = os.path.getsize(cache._rutas(3)[0])
+    assert cache.podar() == 1
+    assert not os.path.exists(cache._rutas(2)[0])
+    assert os.path.exists(cache._rutas(3)[0])
@@ -0,0 +1,73 @@
+import pytest
+
+import metricas
+
+
+@pytest.fixture
+def registro(monkeypatch):
+    """Registro vacío: exponer() solo ve las métricas creadas en la prueba."""
+    monkeypatch.setattr(metricas, "REGISTRO", [])
+    return metricas.REGISTRO
+
+
+def test_histograma_acumula_por_bucket(registro):
+    h = metricas.histograma("prueba_segundos", "Duración.", ("etapa",), buckets=(0.1, 1, 10))
+    for valor in (0.05, 0.1, 0.5, 3, 100):
+        h.observar(valor, "chat")
+
+    assert list(h.lineas()) == [
+        'prueba_segundos_bucket{etapa="chat",le="0.1"} 2',
+        'prueba_segundos_bucket{etapa="chat",le="1"} 3',
+        'prueba_segundos_bucket{etapa="chat",le="10"} 4',
+        'prueba_segundos_bucket{etapa="chat",le="+Inf"} 5',
+        'prueba_segundos_sum{etapa="chat"} 103.65',
+        'prueba_segundos_count{etapa="chat"} 5',
+    ]
+
+
+def test_exponer_formato_de_texto(registro):
+    c = metricas.contador("prueba_total", "Eventos.", ("tipo",))
+    c.inc(1, "a")
+    c.inc(2, "a")
+    c.inc(0.5, 'con "comillas"\\y\nsalto')
+    metricas.medidor("prueba_en_cola", "En cola.", lambda: 7)
+    metricas.medidor("prueba_por_worker", "Por worker.", lambda: {"w0": 1, ("w1",): 2}, ("worker",))
+    metricas.medidor("prueba_rota", "Falla al leer.", lambda: 1 / 0)
+
+    assert metricas.exponer() == "\n".join([
+        "# HELP prueba_total Eventos.",
+        "# TYPE prueba_total counter",
+        'prueba_total{tipo="a"} 3',
+        'prueba_total{tipo="con \\"comillas\\"\\\\y\\nsalto"} 0.5',
+        "# HELP prueba_en_cola En cola.",
+        "# TYPE prueba_en_cola gauge",
+        "prueba_en_cola 7",
+        "# HELP prueba_por_worker Por worker.",
+        "# TYPE prueba_por_worker gauge",
+        'prueba_por_worker{worker="w0"} 1',
+        'prueba_por_worker{worker="w1"} 2',
+        "# HELP prueba_rota Falla al leer.",
+        "# TYPE prueba_rota gauge",
+    ]) + "\n"
+
+
+def test_registrar_con_el_mismo_nombre_reemplaza(registro):
+    metricas.medidor("prueba", "Vieja.", lambda: 1)
+    metricas.medidor("prueba", "Nueva.", lambda: 2)
+    assert [m.ayuda for m in registro] == ["Nueva."]
+
+
+def test_etapa_registra_el_resultado(monkeypatch):
+    h = metricas.Histograma("prueba_etapa_segundos", "Etapas.", ("etapa", "resultado"))
+    monkeypatch.setattr(metricas, "ETAPAS", h)
+
+    with metricas.Etapa("smtp"):
+        pass
+    with metricas.Etapa("smtp") as e:
+        e.resultado = "omitido"
+    with pytest.raises(ValueError):
+        with metricas.Etapa("smtp"):
+            raise ValueError("x")
+
+    assert sorted(clave for clave in h._series) == [("smtp", "error"), ("smtp", "ok"), ("smtp", "omitido")]
+    assert metricas.resumen_etapas().keys() == {"smtp/error", "smtp/ok", "smtp/omitido"}
@@ -0,0 +1,10 @@
+from migraciones import MIGRACIONES, aplicar_migraciones, verificar_planes, version_actual
+
+
+def test_migra_hasta_la_ultima_version(db):
+    assert version_actual(db) == MIGRACIONES[-1][0]
+    assert aplicar_migraciones(db) == 0
+
+
+def test_consultas_calientes_usan_su_indice(db):
+    assert verificar_planes(db) == []
@@ -0,0 +1,102 @@
+import asyncio
+from types import SimpleNamespace
+
+from planificador import PlanificadorPorUsuario
+
+
+def _update(user_id, n):
+    return SimpleNamespace(update_id=n, effective_user=SimpleNamespace(id=user_id), message=SimpleNamespace())
+
+
+class Handler:
+    """Registra el orden de cada usuario y cuántos updates corren a la vez."""
+
+    def __init__(self, espera=0.01):
+        self.espera = espera
+        self.orden = {}
+        self.activos = set()
+        self.max_activos = 0
+        self.solapados = False
+
+    async def __call__(self, update):
+        clave = update.effective_user.id
+        if clave in self.activos:
+            self.solapados = True
+        self.activos.add(clave)
+        self.max_activos = max(self.max_activos, len(self.activos))
+        await asyncio.sleep(self.espera)
+        self.orden.setdefault(clave, []).append(update.update_id)
+        self.activos.discard(clave)
+
+
+def _planificador(handler, **kwargs):
+    planificador = PlanificadorPorUsuario(**kwargs)
+    planificador.procesar = handler
+    return planificador
+
+
+def test_orden_por_usuario_y_concurrencia_entre_usuarios():
+    async def escenario():
+        handler = Handler()
+        planificador = _planificador(handler, max_concurrentes=4)
+        for n in range(5):
+            for user_id in (1, 2, 3):
+                assert planificador.encolar(_update(user_id, user_id * 100 + n))
+        await planificador.vaciar(espera=5)
+        return handler, planificador
+
+    handler, planificador = asyncio.run(escenario())
+    assert not handler.solapados
+    for user_id in (1, 2, 3):
+        assert handler.orden[user_id] == [user_id * 100 + n for n in range(5)]
+    assert handler.max_activos == 3
+    assert planificador.procesados == 15
+    assert planificador.pendientes == 0
+
+
+def test_respeta_max_concurrentes():
+    async def escenario():
+        handler = Handler()
+        planificador = _planificador(handler, max_concurrentes=2)
+        for user_id in range(6):
+            planificador.encolar(_update(user_id, user_id))
+        await planificador.vaciar(espera=5)
+        return handler
+
+    assert asyncio.run(escenario()).max_activos == 2
+
+
+def test_capacidad_rechaza_y_se_libera():
+    async def escenario():
+        handler = Handler()
+        planificador = _planificador(handler, capacidad=3)
+        aceptados = [planificador.encolar(_update(1, n)) for n in range(3)]
+        aceptados.append(planificador.encolar(_update(2, 99)))
+        await planificador.vaciar(espera=5)
+        aceptados.append(planificador.encolar(_update(2, 100)))
+        await planificador.vaciar(espera=5)
+        return handler, aceptados
+
+    handler, aceptados = asyncio.run(escenario())
+    assert aceptados == [True, True, True, False, True]
+    assert handler.orden == {1: [0, 1, 2], 2: [100]}
+
+
+def test_un_error_no_detiene_la_cola_del_usuario():
+    async def escenario():
+        vistos = []
+
+        async def handler(update):
+            vistos.append(update.update_id)
+            if update.update_id == 1:
+                raise RuntimeError("falla")
+
+        planificador = _planificador(handler)
+        for n in range(3):
+            planificador.encolar(_update(1, n))
+        await planificador.vaciar(espera=5)
+        return vistos, planificador
+
+    vistos, planificador = asyncio.run(escenario())
+    assert vistos == [0, 1, 2]
+    assert planificador.pendientes == 0
@@ -0,0 +1,106 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from planificador_llm import PlanificadorLLM
+
+
+class Limite429(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__("rate limit")
+        self.response = SimpleNamespace(headers={"retry-after": str(retry_after)})
+
+
+def _sin_cupo(planificador):
+    planificador.solicitudes.disponibles = 0
+
+
+def test_sale_primero_la_mayor_prioridad():
+    async def escenario():
+        planificador = PlanificadorLLM(rpm=6000, reserva=0)
+        _sin_cupo(planificador)
+        orden = []
+
+        def llamada(tipo):
+            async def llamar():
+                orden.append(tipo)
+            return llamar
+
+        await asyncio.gather(*(
+            planificador.ejecutar(tipo, llamada(tipo)) for tipo in ("perfil", "dependencia", "chat", "riesgo")
+        ))
+        return orden
+
+    assert asyncio.run(escenario()) == ["riesgo", "chat", "dependencia", "perfil"]
+
+
+def test_baja_prioridad_respeta_la_reserva_sin_descartarse():
+    async def escenario():
+        planificador = PlanificadorLLM(rpm=6000, reserva=0.2)
+        _sin_cupo(planificador)
+
+        async def llamar():
+            return "ok"
+
+        perfil = asyncio.create_task(planificador.ejecutar("perfil", llamar))
+        riesgo = await asyncio.wait_for(planificador.ejecutar("riesgo", llamar), timeout=1)
+        await asyncio.sleep(0.2)
+        diferido = not perfil.done()
+
+        # Con el bucket lleno la llamada diferida sale.
+        planificador.solicitudes.disponibles = planificador.solicitudes.capacidad
+        planificador._evento.set()
+        return riesgo, diferido, await asyncio.wait_for(perfil, timeout=1)
+
+    assert asyncio.run(escenario()) == ("ok", True, "ok")
+
+
+def test_un_429_pausa_todas_las_llamadas():
+    async def escenario():
+        planificador = PlanificadorLLM(rpm=6000)
+        momentos = {}
+
+        async def chat():
+            if "fallo" not in momentos:
+                momentos["fallo"] = time.monotonic()
+                raise Limite429(retry_after=0.3)
+            momentos["chat"] = time.monotonic()
+            return "chat"
+
+        async def riesgo():
+            momentos["riesgo"] = time.monotonic()
+            return "riesgo"
+
+        async def riesgo_despues():
+            await asyncio.sleep(0.05)
+            return await planificador.ejecutar("riesgo", riesgo)
+
+        resultados = await asyncio.gather(planificador.ejecutar("chat", chat), riesgo_despues())
+        return resultados, momentos, planificador.consumo
+
+    resultados, momentos, consumo = asyncio.run(escenario())
+    assert resultados == ["chat", "riesgo"]
+    assert momentos["riesgo"] - momentos["fallo"] >= 0.3
+    assert momentos["chat"] - momentos["fallo"] >= 0.3
+    assert consumo["chat"]["reintentos"] == 1
+    assert consumo["chat"]["llamadas"] == 1
+
+
+def test_agota_los_reintentos_y_propaga_el_429():
+    async def escenario():
+        planificador = PlanificadorLLM(rpm=6000, max_reintentos=2)
+
+        async def siempre_429():
+            raise Limite429(retry_after=0.01)
+
+        with pytest.raises(Limite429):
+            await planificador.ejecutar("chat", siempre_429)
+        return planificador.consumo["chat"]
+
+    consumo = asyncio.run(escenario())
+    assert consumo["reintentos"] == 2
+    assert consumo["errores"] == 1
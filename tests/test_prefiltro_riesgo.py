@@ -0,0 +1,48 @@
+import pytest
+
+from prefiltro_riesgo import PrefiltroRiesgo
+
+# Mensajes que el pre-filtro nunca debe omitir, aunque no haya coincidencias
+# en el léxico ni en el historial: la decisión queda en manos del LLM.
+NUNCA_OMITIR = [
+    "no estoy bien",
+    "No estoy nada bien",
+    "no muy bien",
+    "como estas? no bien",
+    "ya no",
+    "nunca",
+    "nada",
+    "estoy",
+    "todo bien",
+    "si",
+    "ok",
+]
+
+BENIGNOS = [
+    "hola",
+    "Hola, buenos días",
+    "muchas gracias",
+    "gracias, hasta mañana",
+]
+
+
+@pytest.mark.parametrize("mensaje", NUNCA_OMITIR)
+def test_nunca_omite_negaciones_ni_acuses(mensaje):
+    assert PrefiltroRiesgo().evaluar(mensaje).escalar
+
+
+@pytest.mark.parametrize("mensaje", ["no estoy bien", "nada", "ya no"])
+def test_negacion_escala_aun_con_limite_de_palabras(mensaje):
+    assert PrefiltroRiesgo(max_tokens_benigno=5).evaluar(mensaje).escalar
+
+
+@pytest.mark.parametrize("mensaje", BENIGNOS)
+def test_omite_saludos_y_agradecimientos(mensaje):
+    decision = PrefiltroRiesgo().evaluar(mensaje)
+    assert not decision.escalar
+    assert decision.motivo == "mensaje benigno"
+
+
+def test_contexto_reciente_con_riesgo_escala():
+    decision = PrefiltroRiesgo().evaluar("gracias", ["a veces pienso en quitarme la vida"])
+    assert decision.escalar
@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime
+
+from migraciones import _m012_marca_inicial_perfiles
+from trabajos_perfil import PlanificadorPerfiles
+
+
+def _conversar(db, user_id, n):
+    with db.transaccion() as cursor:
+        cursor.executemany(
+            "INSERT INTO conversaciones (user_id, user_message, bot_message, timestamp) VALUES (?, 'm', 'r', ?)",
+            [(user_id, datetime.now().isoformat())] * n,
+        )
+
+
+class LLMPrueba:
+    """LLM local: devuelve un perfil fijo, o falla para los usuarios de `fallan`."""
+
+    def __init__(self, fallan=()):
+        self.fallan = set(fallan)
+        self.llamadas = []
+
+    async def __call__(self, user_id):
+        self.llamadas.append(user_id)
+        await asyncio.sleep(0)
+        if user_id in self.fallan:
+            raise RuntimeError("modelo caído")
+        return {"estado_emocional_predominante": "calma"}
+
+
+def _trabajos(db):
+    return db.todos("SELECT user_id, marca, estado, intentos FROM trabajos_perfil ORDER BY user_id, marca")
+
+
+def test_ciclo_con_llm_de_prueba(db):
+    _conversar(db, 1, 45)
+    _conversar(db, 2, 10)
+    llm = LLMPrueba()
+    guardados = {}
+    planificador = PlanificadorPerfiles(db, llm, guardados.__setitem__, cada=20)
+
+    assert asyncio.run(planificador.ciclo(forzar=True)) == 1
+    assert guardados == {1: {"estado_emocional_predominante": "calma"}}
+    assert _trabajos(db) == [(1, 40, "hecho", 1)]
+
+    # Recolectar de nuevo no duplica; cruzar el siguiente múltiplo sí crea otro.
+    assert planificador.recolectar() == 0
+    _conversar(db, 1, 15)
+    assert asyncio.run(planificador.ciclo(forzar=True)) == 1
+    assert _trabajos(db)[-1] == (1, 60, "hecho", 1)
+    assert llm.llamadas == [1, 1]
+
+
+def test_fallidos_se_reintentan_hasta_max_intentos(db):
+    _conversar(db, 1, 20)
+    _conversar(db, 2, 20)
+    planificador = PlanificadorPerfiles(db, LLMPrueba(fallan={2}), lambda u, p: None, cada=20, max_intentos=3)
+
+    asyncio.run(planificador.ciclo(forzar=True))
+    assert _trabajos(db) == [(1, 20, "hecho", 1), (2, 20, "fallido", 3)]
+    assert planificador.estado() == {"hecho": 1, "fallido": 1}
+
+
+def test_fuera_de_horas_tranquilas_solo_recolecta(db):
+    _conversar(db, 1, 20)
+    hora = datetime.now().hour
+    planificador = PlanificadorPerfiles(db, LLMPrueba(), lambda u, p: None, cada=20,
+                                        horas=((hora + 1) % 24, (hora + 2) % 24))
+    assert asyncio.run(planificador.ciclo()) == 0
+    assert _trabajos(db) == [(1, 20, "pendiente", 0)]
+
+
+def test_usuarios_existentes_no_regeneran_su_perfil_al_desplegar(db):
+    _conversar(db, 1, 45)
+    _conversar(db, 2, 5)
+    with db.transaccion() as cursor:
+        _m012_marca_inicial_perfiles(cursor)
+    planificador = PlanificadorPerfiles(db, LLMPrueba(), lambda u, p: None, cada=20)
+
+    assert planificador.recolectar() == 0
+    _conversar(db, 1, 14)  # 59: todavía no cruza 60
+    assert planificador.recolectar() == 0
+    _conversar(db, 1, 1)
+    _conversar(db, 2, 15)
+    assert planificador.recolectar() == 2
+    assert [t[:3] for t in _trabajos(db) if t[2] == "pendiente"] == [(1, 60, "pendiente"), (2, 20, "pendiente")]
@@ -0,0 +1,124 @@
+import json
+import time
+
+import pytest
+
+import trazas
+
+
+@pytest.fixture
+def trazador(tmp_path, monkeypatch):
+    """Trazador propio escribiendo en un archivo temporal; leer() cierra y devuelve los spans."""
+    nuevo = trazas.Trazador()
+    monkeypatch.setattr(trazas, "_trazador", nuevo)
+    ruta = str(tmp_path / "trazas.jsonl")
+
+    def configurar(muestreo=0.0, lento_ms=60_000):
+        nuevo.configurar(ruta, muestreo=muestreo, lento_ms=lento_ms)
+        return nuevo
+
+    def leer():
+        nuevo.cerrar()
+        return trazas.cargar(ruta)
+
+    configurar.leer = leer
+    yield configurar
+    nuevo.cerrar()
+
+
+def _update(hijo=None):
+    with trazas.raiz("update.mensaje", user_id=1) as raiz:
+        with trazas.tramo("db.uno"):
+            pass
+        if hijo:
+            hijo()
+    return raiz.traza.trace_id
+
+
+def test_sin_archivo_no_traza():
+    assert trazas.raiz("update.mensaje") is trazas.NULO
+    assert trazas.tramo("db.uno") is trazas.NULO
+
+
+def test_muestreo_por_cola(trazador):
+    t = trazador(muestreo=0.0)
+    _update()
+    assert trazador.leer() == []
+    assert t.contadores["descartados"] == 1
+
+
+def test_se_conservan_las_sorteadas(trazador):
+    trazador(muestreo=1.0)
+    trace_id = _update()
+    spans = trazador.leer()
+    assert [s["name"] for s in spans] == ["db.uno", "update.mensaje"]
+    assert {s["traceId"] for s in spans} == {trace_id}
+    hijo, raiz = spans
+    assert hijo["parentId"] == raiz["id"] and "parentId" not in raiz
+    assert raiz["tags"] == {"user_id": "1"}
+
+
+def test_se_conservan_las_forzadas(trazador):
+    trazador()
+    _update(hijo=trazas.forzar)
+    assert len(trazador.leer()) == 2
+
+
+def test_se_conservan_las_que_fallan(trazador):
+    trazador()
+
+    def falla():
+        with trazas.tramo("openai.chat"):
+            raise TimeoutError("sin respuesta")
+
+    with pytest.raises(TimeoutError):
+        _update(hijo=falla)
+    spans = {s["name"]: s for s in trazador.leer()}
+    assert spans["openai.chat"]["tags"]["error"] == "TimeoutError: sin respuesta"
+    assert "update.mensaje" in spans
+
+
+def test_se_conservan_las_lentas(trazador):
+    trazador(lento_ms=20)
+    _update()
+    _update(hijo=lambda: time.sleep(0.03))
+    spans = trazador.leer()
+    assert len(spans) == 2
+    assert spans[-1]["duration"] >= 20_000
+
+
+def test_tramos_despues_de_decidir_siguen_la_decision(trazador):
+    trazador()
+    contextos = []
+    _update(hijo=lambda: (trazas.forzar(), contextos.append(trazas.contexto())))
+
+    # La bandeja de salida continúa la traza más tarde, ya decidida.
+    with trazas.tramo("alerta.correo", padre=contextos[0], alerta_id=5):
+        pass
+    spans = trazador.leer()
+    correo = spans[-1]
+    assert correo["name"] == "alerta.correo"
+    assert correo["traceId"] == spans[0]["traceId"]
+    assert correo["parentId"] == contextos[0]["span_id"]
+
+
+def _escribir(ruta, spans):
+    with open(ruta, "w", encoding="utf-8") as f:
+        for span in spans:
+            f.write(json.dumps(span) + "\n")
+
+
+def test_cargar_por_alerta_sigue_los_enlaces(tmp_path):
+    origen = {"traceId": "t1", "id": "a", "name": "update.mensaje", "tags": {}}
+    alerta = {"traceId": "t2", "id": "b", "name": "alerta.correo",
+              "tags": {"alerta_id": "5", "enlace.traceId": "t1", "enlace.spanId": "a"}}
+    otra = {"traceId": "t3", "id": "c", "name": "update.mensaje", "tags": {"alerta_id": "6"}}
+    _escribir(tmp_path / "worker0.jsonl", [origen, otra])
+    _escribir(tmp_path / "worker1.jsonl", [alerta])
+    rutas = [str(tmp_path / "worker0.jsonl"), str(tmp_path / "worker1.jsonl")]
+
+    assert len(trazas.cargar(rutas)) == 3
+    assert {s["traceId"] for s in trazas.cargar(rutas, alerta_id=5)} == {"t1", "t2"}
+    assert {s["traceId"] for s in trazas.cargar(rutas, alerta_id=6)} == {"t3"}
+    assert trazas.cargar(rutas, trace_id="t1") == [origen]
+    assert trazas.cargar(rutas, alerta_id=99) == []
@@ -0,0 +1,197 @@
+import sys
+import asyncio
+import logging
+from datetime import datetime
+
+logger = logging.getLogger("serenity.trabajos_perfil")
+
+SQL_RECOLECTAR = """
+    INSERT OR IGNORE INTO trabajos_perfil (user_id, marca, estado, intentos, creado)
+    SELECT e.user_id, (e.total_mensajes / ?1) * ?1, 'pendiente', 0, ?2
+    FROM estadisticas_usuario e
+    WHERE e.total_mensajes >= ?1
+      AND NOT EXISTS (
+          SELECT 1 FROM trabajos_perfil t
+          WHERE t.user_id = e.user_id AND t.marca >= (e.total_mensajes / ?1) * ?1
+      )
+"""
+
+# Un pendiente con una marca más nueva del mismo usuario ya no hace falta.
+SQL_OMITIR_SUPERADOS = """
+    UPDATE trabajos_perfil SET estado='omitido'
+    WHERE estado='pendiente' AND EXISTS (
+        SELECT 1 FROM trabajos_perfil t
+        WHERE t.user_id = trabajos_perfil.user_id AND t.marca > trabajos_perfil.marca
+    )
+"""
+
+
+def horas_tranquilas(texto):
+    """"1-6" -> (1, 6); "" -> None (sin restricción). El rango puede cruzar la medianoche ("22-6")."""
+    if not texto:
+        return None
+    inicio, fin = (int(x) for x in texto.split("-"))
+    return inicio, fin
+
+
+def en_horas_tranquilas(rango, ahora=None):
+    if rango is None:
+        return True
+    hora = (ahora or datetime.now()).hour
+    inicio, fin = rango
+    if inicio <= fin:
+        return inicio <= hora < fin
+    return hora >= inicio or hora < fin
+
+
+class PlanificadorPerfiles:
+    """
+    Genera los perfiles emocionales en segundo plano (tabla trabajos_perfil).
+
+    recolectar() crea un trabajo por cada usuario que cruzó un múltiplo de
+    `cada` mensajes; la marca (mensajes redondeados a `cada`) junto con
+    UNIQUE(user_id, marca) hace que recolectar varias veces no duplique
+    trabajos. procesar_lote() toma hasta `lote` pendientes y los ejecuta con
+    a lo sumo `concurrencia` análisis a la vez, solo dentro de las horas
+    tranquilas. Un trabajo fallido se reintenta hasta `max_intentos`.
+    Los usuarios que ya existían al crear la cola parten de la marca que
+    siembra la migración 12, así que solo la actividad nueva genera trabajos.
+
+    `analizar(user_id)` es una corrutina que devuelve el perfil (dict) o None
+    y `guardar(user_id, perfil)` lo persiste; ambos son inyectables, así que
+    se puede probar con un LLM local de prueba.
+    """
+
+    def __init__(self, db, analizar, guardar, cada=20, lote=50, concurrencia=3,
+                 horas=None, intervalo=600, max_intentos=3):
+        self.db = db
+        self.analizar = analizar
+        self.guardar = guardar
+        self.cada = cada
+        self.lote = lote
+        self.concurrencia = concurrencia
+        self.horas = horas
+        self.intervalo = intervalo
+        self.max_intentos = max_intentos
+        self._tarea = None
+
+    def recolectar(self):
+        with self.db.transaccion() as cursor:
+            cursor.execute(SQL_RECOLECTAR, (self.cada, datetime.now().isoformat()))
+            nuevos = cursor.rowcount
+            cursor.execute(SQL_OMITIR_SUPERADOS)
+        if nuevos:
+            logger.info(f"[Perfiles] {nuevos} trabajos nuevos")
+        return nuevos
+
+    def reanudar(self):
+        """Devuelve a la cola los trabajos que quedaron en curso tras un reinicio."""
+        self.db.ejecutar("UPDATE trabajos_perfil SET estado='pendiente' WHERE estado='en_curso'")
+
+    async def procesar_lote(self):
+        filas = self.db.todos("""
+            SELECT id, user_id, marca, intentos FROM trabajos_perfil
+            WHERE estado='pendiente' ORDER BY id LIMIT ?
+        """, (self.lote,))
+        if not filas:
+            return 0
+        with self.db.transaccion() as cursor:
+            cursor.executemany(
+                "UPDATE trabajos_perfil SET estado='en_curso', iniciado=? WHERE id=?",
+                [(datetime.now().isoformat(), fila[0]) for fila in filas],
+            )
+        semaforo = asyncio.Semaphore(self.concurrencia)
+
+        async def ejecutar(trabajo_id, user_id, marca, intentos):
+            async with semaforo:
+                await self._ejecutar(trabajo_id, user_id, marca, intentos)
+
+        await asyncio.gather(*(ejecutar(*fila) for fila in filas))
+        return len(filas)
+
+    async def _ejecutar(self, trabajo_id, user_id, marca, intentos):
+        intentos += 1
+        try:
+            perfil = await self.analizar(user_id)
+            if not perfil:
+                raise RuntimeError("el análisis no devolvió perfil")
+            self.guardar(user_id, perfil)
+        except Exception as e:
+            estado = "fallido" if intentos >= self.max_intentos else "pendiente"
+            logger.error(f"[Perfiles] Trabajo {trabajo_id} (usuario {user_id}, marca {marca}): {e}")
+            self.db.ejecutar(
+                "UPDATE trabajos_perfil SET estado=?, intentos=?, error=? WHERE id=?",
+                (estado, intentos, str(e), trabajo_id),
+            )
+            return
+        self.db.ejecutar(
+            "UPDATE trabajos_perfil SET estado='hecho', intentos=?, terminado=?, error=NULL WHERE id=?",
+            (intentos, datetime.now().isoformat(), trabajo_id),
+        )
+
+    async def ciclo(self, forzar=False):
+        """Recolecta y, si es hora tranquila (o `forzar`), procesa lotes hasta vaciar la cola."""
+        self.recolectar()
+        procesados = 0
+        while forzar or en_horas_tranquilas(self.horas):
+            n = await self.procesar_lote()
+            if not n:
+                break
+            procesados += n
+        return procesados
+
+    def iniciar(self):
+        self.reanudar()
+        self._tarea = asyncio.create_task(self._bucle())
+        return self._tarea
+
+    async def detener(self):
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+
+    async def _bucle(self):
+        while True:
+            try:
+                await self.ciclo()
+            except Exception as e:
+                logger.error(f"[Perfiles] Error en el ciclo: {e}")
+            await asyncio.sleep(self.intervalo)
+
+    def estado(self):
+        return dict(self.db.todos("SELECT estado, COUNT(*) FROM trabajos_perfil GROUP BY estado"))
+
+
+if __name__ == "__main__":
+    # Uso: python trabajos_perfil.py
+    # Corre un ciclo completo con un LLM de prueba sobre una base temporal con
+    # usuarios sintéticos; nunca toca la base real (la prueba está en tests/).
+    import os
+    import tempfile
+    from basedatos import ConexionSQLite
+    from migraciones import aplicar_migraciones
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    usuarios = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with tempfile.TemporaryDirectory() as directorio:
+        db = ConexionSQLite(os.path.join(directorio, "perfiles.db"))
+        aplicar_migraciones(db)
+        with db.transaccion() as cursor:
+            cursor.executemany(
+                "INSERT INTO conversaciones (user_id, user_message, bot_message, timestamp) VALUES (?, 'hola', 'hola', ?)",
+                [(u, datetime.now().isoformat()) for u in range(1, usuarios + 1) for _ in range(25)],
+            )
+
+        async def analizar_prueba(user_id):
+            await asyncio.sleep(0.05)
+            return {"estado_emocional_predominante": "prueba", "recomendaciones": "perfil generado sin LLM"}
+
+        guardados = []
+        planificador = PlanificadorPerfiles(db, analizar_prueba, lambda u, p: guardados.append(u))
+        procesados = asyncio.run(planificador.ciclo(forzar=True))
+        print(f"{procesados} trabajos procesados; estado: {planificador.estado()}")
+        db.cerrar()
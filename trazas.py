@@ -0,0 +1,277 @@
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextvars
+
+logger = logging.getLogger("serenity.trazas")
+
+# Tramo activo en la tarea/hilo actual (asyncio.to_thread copia el contexto).
+_ACTUAL = contextvars.ContextVar("serenity_tramo", default=None)
+
+SERVICIO = "serenity"
+
+
+def _id(bits):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Traza:
+    """
+    Tramos de un mismo update. Se guardan en memoria hasta que termina la
+    raíz y ahí se decide (muestreo por cola): se conserva si salió sorteada,
+    si hubo un error, si tardó más de `lento_ms` o si se forzó (alertas).
+    Los tramos que terminan después de decidir se escriben o descartan
+    directamente.
+    """
+
+    __slots__ = ("trace_id", "tramos", "decidida", "conservar", "forzada", "error")
+
+    def __init__(self, trace_id=None, conservar=False):
+        self.trace_id = trace_id or _id(128)
+        self.tramos = []
+        self.decidida = False
+        self.conservar = conservar
+        self.forzada = conservar
+        self.error = False
+
+
+class Tramo:
+    __slots__ = ("nombre", "traza", "span_id", "padre_id", "inicio", "atributos", "raiz", "_token", "_t0")
+
+    def __init__(self, nombre, traza, padre_id=None, raiz=False, atributos=None):
+        self.nombre = nombre
+        self.traza = traza
+        self.span_id = _id(64)
+        self.padre_id = padre_id
+        self.raiz = raiz
+        self.atributos = atributos or {}
+        self._token = None
+
+    def atributo(self, clave, valor):
+        self.atributos[clave] = valor
+
+    def __enter__(self):
+        self.inicio = time.time()
+        self._t0 = time.perf_counter()
+        self._token = _ACTUAL.set(self)
+        return self
+
+    def __exit__(self, tipo_error, error, _traza):
+        duracion = time.perf_counter() - self._t0
+        try:
+            _ACTUAL.reset(self._token)
+        except ValueError:
+            # Salida en otro contexto (p. ej. un generador cerrado desde otra tarea).
+            pass
+        if tipo_error is not None and not issubclass(tipo_error, GeneratorExit):
+            self.atributos["error"] = f"{tipo_error.__name__}: {error}"
+            self.traza.error = True
+        _trazador.terminar(self, duracion)
+        return False
+
+    def zipkin(self, duracion):
+        """Formato Zipkin v2 (lo importan Zipkin, Jaeger y otros visores)."""
+        span = {
+            "traceId": self.traza.trace_id,
+            "id": self.span_id,
+            "name": self.nombre,
+            "timestamp": int(self.inicio * 1_000_000),
+            "duration": max(1, int(duracion * 1_000_000)),
+            "localEndpoint": {"serviceName": SERVICIO},
+            "tags": {k: " ".join(str(v).split())[:300] for k, v in self.atributos.items() if v is not None},
+        }
+        if self.padre_id:
+            span["parentId"] = self.padre_id
+        return span
+
+
+class _Nulo:
+    """Tramo vacío para cuando no hay traza activa o el trazado está apagado."""
+
+    __slots__ = ()
+    span_id = None
+
+    def atributo(self, clave, valor):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULO = _Nulo()
+
+
+class Trazador:
+    def __init__(self):
+        self.archivo = ""
+        self.muestreo = 0.0
+        self.lento = 0.0
+        self.contadores = {"escritos": 0, "descartados": 0}
+        self._cola = None
+        self._hilo = None
+
+    @property
+    def activo(self):
+        return bool(self.archivo)
+
+    def configurar(self, archivo, muestreo=0.05, lento_ms=5000):
+        self.archivo = archivo
+        self.muestreo = muestreo
+        self.lento = lento_ms / 1000
+        if archivo and self._hilo is None:
+            self._cola = queue.SimpleQueue()
+            self._hilo = threading.Thread(target=self._escribir, name="trazas", daemon=True)
+            self._hilo.start()
+            logger.info(f"[Trazas] Escribiendo en {archivo} (muestreo {muestreo:.0%}, lentas > {lento_ms:.0f} ms)")
+
+    def terminar(self, tramo, duracion):
+        traza = tramo.traza
+        if traza.decidida:
+            if traza.conservar:
+                self._cola.put(tramo.zipkin(duracion))
+            return
+        traza.tramos.append((tramo, duracion))
+        if not tramo.raiz:
+            return
+        traza.decidida = True
+        traza.conservar = (
+            traza.forzada or traza.error or duracion >= self.lento or random.random() < self.muestreo
+        )
+        if traza.conservar:
+            for t, d in traza.tramos:
+                self._cola.put(t.zipkin(d))
+        else:
+            self.contadores["descartados"] += 1
+        traza.tramos = []
+
+    def _escribir(self):
+        with open(self.archivo, "a", encoding="utf-8") as f:
+            while True:
+                span = self._cola.get()
+                if span is None:
+                    f.flush()
+                    return
+                f.write(json.dumps(span, ensure_ascii=False) + "\n")
+                self.contadores["escritos"] += 1
+                if self._cola.empty():
+                    f.flush()
+
+    def cerrar(self):
+        if self._hilo is not None:
+            self._cola.put(None)
+            self._hilo.join(timeout=5)
+            self._hilo = None
+
+
+_trazador = Trazador()
+configurar = _trazador.configurar
+cerrar = _trazador.cerrar
+
+
+def raiz(nombre, **atributos):
+    """Abre la traza de un update. Sin archivo configurado devuelve un tramo vacío."""
+    if not _trazador.activo:
+        return NULO
+    return Tramo(nombre, Traza(), raiz=True, atributos=atributos)
+
+
+def tramo(nombre, padre=None, **atributos):
+    """
+    Tramo hijo del tramo activo. `padre` (un dict de contexto()) permite
+    continuar una traza en otro momento, p. ej. el envío de una alerta desde
+    la bandeja de salida. Sin traza activa ni `padre` devuelve un tramo vacío.
+    """
+    if not _trazador.activo:
+        return NULO
+    if padre:
+        traza = Traza(padre["trace_id"], conservar=padre.get("conservar", True))
+        traza.decidida = True
+        return Tramo(nombre, traza, padre["span_id"], atributos=atributos)
+    actual = _ACTUAL.get()
+    if actual is None:
+        return NULO
+    return Tramo(nombre, actual.traza, actual.span_id, atributos=atributos)
+
+
+def contexto():
+    """Identificadores del tramo activo para continuar o enlazar la traza más tarde (serializable)."""
+    actual = _ACTUAL.get()
+    if actual is None:
+        return None
+    return {"trace_id": actual.traza.trace_id, "span_id": actual.span_id, "conservar": True}
+
+
+def atributo(clave, valor):
+    actual = _ACTUAL.get()
+    if actual is not None:
+        actual.atributo(clave, valor)
+
+
+def forzar():
+    """Conserva la traza activa sin importar el muestreo (p. ej. cuando genera una alerta)."""
+    actual = _ACTUAL.get()
+    if actual is not None:
+        actual.traza.forzada = True
+
+
+def enlazar(origen, **atributos):
+    """
+    Enlaza el tramo activo con otra traza (`origen`, de contexto()) y lo
+    conserva. Zipkin no tiene enlaces, así que van como etiquetas
+    enlace.traceId / enlace.spanId.
+    """
+    actual = _ACTUAL.get()
+    if actual is None:
+        return
+    actual.traza.forzada = True
+    for clave, valor in atributos.items():
+        actual.atributo(clave, valor)
+    if origen:
+        actual.atributo("enlace.traceId", origen["trace_id"])
+        actual.atributo("enlace.spanId", origen["span_id"])
+
+
+def cargar(rutas, alerta_id=None, trace_id=None):
+    """
+    Lee uno o varios archivos de trazas (con varios procesos cada worker
+    escribe el suyo) y devuelve la lista de spans. Con `alerta_id` devuelve
+    las trazas que tocaron esa alerta y las enlazadas a ellas.
+    """
+    spans = []
+    for ruta in [rutas] if isinstance(rutas, str) else rutas:
+        with open(ruta, encoding="utf-8") as f:
+            spans.extend(json.loads(linea) for linea in f if linea.strip())
+    if alerta_id is None and trace_id is None:
+        return spans
+    trazas = set()
+    if trace_id:
+        trazas.add(trace_id)
+    if alerta_id is not None:
+        trazas |= {s["traceId"] for s in spans if s.get("tags", {}).get("alerta_id") == str(alerta_id)}
+    enlazadas = {
+        s["tags"]["enlace.traceId"] for s in spans
+        if s["traceId"] in trazas and "enlace.traceId" in s.get("tags", {})
+    }
+    trazas |= enlazadas
+    return [s for s in spans if s["traceId"] in trazas]
+
+
+if __name__ == "__main__":
+    # Uso: python trazas.py trazas*.jsonl [--alerta ID | --traza ID] > trazas.json
+    # Convierte las líneas en el arreglo JSON que aceptan Zipkin/Jaeger al importar.
+    args = sys.argv[1:]
+    if not args:
+        print("Uso: python trazas.py trazas*.jsonl [--alerta ID | --traza ID]", file=sys.stderr)
+        sys.exit(2)
+    rutas = args[: next((i for i, a in enumerate(args) if a.startswith("--")), len(args))]
+    alerta = args[args.index("--alerta") + 1] if "--alerta" in args else None
+    traza = args[args.index("--traza") + 1] if "--traza" in args else None
+    json.dump(cargar(rutas, alerta, traza), sys.stdout, ensure_ascii=False, indent=1)
+    print()